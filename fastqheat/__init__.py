@@ -1 +1,14 @@
+import typing as tp
+
 __version__ = '1.0.0'
+
+# the API is imported on first use, so that `import fastqheat` stays cheap
+_API_NAMES = ("FileResult", "RunResult", "fetch")
+
+
+def __getattr__(name: str) -> tp.Any:
+    if name in _API_NAMES:
+        from fastqheat import api
+
+        return getattr(api, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,85 +1,119 @@
-import asyncio
 import functools
 import logging
 import os
 import os.path
 import re
-import subprocess
+import stat
 import typing as tp
 from pathlib import Path
 
-import backoff
 import click
 
-import fastqheat.backend.ena as ena_module
-import fastqheat.backend.ncbi as ncbi_module
 from fastqheat import __version__
-from fastqheat.backend.ena.ena_api_client import ENAClient
+from fastqheat.backend.scheduler import SCHEDULING_POLICIES
 from fastqheat.click_utils import OrderableOption, OrderedOptsCommand, check_binary_available
 from fastqheat.config import FastQHeatConfigParser, config
-from fastqheat.exceptions import ENAClientError
-from fastqheat.utility import get_cpu_cores_count
+from fastqheat.utility import get_cpu_cores_count, parse_size
+
+# Backends are imported by the commands that use them, so that `--help`, `--version` and
+# argument errors do not load aiohttp, requests and the like.
+if tp.TYPE_CHECKING:
+    from fastqheat.backend.accessions import AccessionSource
+    from fastqheat.backend.download_cache import DownloadCache
+    from fastqheat.backend.job_store import SQLiteJobStore
+    from fastqheat.backend.sampling import SampleLimits
+    from fastqheat.backend.sharding import ShardLayout
+    from fastqheat.backend.sinks import OutputSink
 
 logger = logging.getLogger("fastqheat.main")
 
-SRR_PATTERN = re.compile(r'^(SRR|ERR|DRR)\d+$')
-SRP_PATTERN = re.compile(r'^(((SR|ER|DR)[PAXS])|(SAM(N|EA|D))|PRJ(NA|EB|DB)|(GS[EM]))\d+$')
 USABLE_CPUS_COUNT = get_cpu_cores_count()
 
-subprocess_run = backoff.on_exception(
-    backoff.constant, subprocess.CalledProcessError, max_tries=lambda: config.DEFAULT_MAX_ATTEMPTS
-)(subprocess.run)
-
-
-def _make_accession_list(terms: tp.Iterable[str]) -> list[str]:
-    """Get an accession list based on pattern of the given term."""
-    accession_list = list()
-    for term in terms:
-        # validate_accession_file may return some empty strings.
-        # Here is the easiest place to deal with it.
-        if not term:
-            continue
-        if SRR_PATTERN.search(term):
-            accession_list.append(term)
-        elif SRP_PATTERN.search(term):
-            try:
-                accession_list += ENAClient().get_srr_ids_from_srp(term)
-            except ENAClientError:
-                # We handle this error in ENAClient().get_srr_ids_from_srp(term)
-                # Here we only need to catch it in order to skip the current term and proceed
-                # with the next one instead of crushing
-                continue
-        else:
-            raise click.UsageError(f"Unknown accession pattern: {term}")
-    return accession_list
+
+def _validated(source: 'AccessionSource') -> 'AccessionSource':
+    try:
+        source.validate()
+    except ValueError as err:
+        raise click.UsageError(str(err))
+    return source
 
 
 def validate_accession(
     ctx: click.core.Context, param: click.core.Option, value: tp.Optional[str]
-) -> tp.Optional[list[str]]:
+) -> tp.Optional['AccessionSource']:
+    from fastqheat.backend.accessions import AccessionSource
+
     if not value:
         return None
-    lst = re.split('[ ,]+', value)
-    return _make_accession_list(lst)
+    return _validated(AccessionSource(terms=re.split('[ ,]+', value)))
 
 
 def validate_accession_file(
     ctx: click.core.Context,
     param: click.core.Option,
     value: tp.Optional[str],
-) -> tp.Optional[list[str]]:
+) -> tp.Optional['AccessionSource']:
+    """Check the patterns in the file, its lines are read again when the accessions are used."""
+    from fastqheat.backend.accessions import AccessionSource
+
     if not value:
         return None
-    with open(value, 'r') as f:
-        s = f.read()
-        lines = s.splitlines(keepends=False)
-    return _make_accession_list(lines)
+    return _validated(AccessionSource(files=[value]))
 
 
 def validate_config(ctx: click.Context, param: click.Option, value: str) -> FastQHeatConfigParser:
     return FastQHeatConfigParser(filename=value, click_param=param)
 
 
+def validate_bandwidth(
+    ctx: click.Context, param: click.Parameter, value: tp.Optional[str]
+) -> tp.Optional[int]:
+    from fastqheat.backend.bandwidth import parse_bandwidth
+
+    if value is None:
+        return None
+    try:
+        return parse_bandwidth(value)
+    except ValueError as err:
+        raise click.BadParameter(str(err), ctx=ctx, param=param)
+
+
+def validate_size(
+    ctx: click.Context, param: click.Parameter, value: tp.Optional[str]
+) -> tp.Optional[int]:
+    if value is None:
+        return None
+    try:
+        return parse_size(value)
+    except ValueError as err:
+        raise click.BadParameter(str(err), ctx=ctx, param=param)
+
+
+def validate_stream_targets(
+    ctx: click.Context, param: click.Parameter, value: tuple[str, ...]
+) -> tuple[str, ...]:
+    if len(value) > 2:
+        raise click.BadParameter('at most two targets can be given', ctx=ctx, param=param)
+    for target in value:
+        if target != '-' and not stat.S_ISFIFO(os.stat(target).st_mode):
+            raise click.BadParameter(f'{target} is not a named pipe', ctx=ctx, param=param)
+    return value
+
+
+def validate_output(
+    ctx: click.Context, param: click.Parameter, value: tp.Optional[str]
+) -> tp.Optional[str]:
+    from fastqheat.backend.s3 import parse_s3_url
+
+    if value is None:
+        return None
+    try:
+        parse_s3_url(value)
+    except ValueError as err:
+        raise click.BadParameter(str(err), ctx=ctx, param=param)
+    return value
+
+
 def validate_log_level(ctx: click.Context, param: click.Option, value: str) -> str:
     return value.upper()
 
@@ -138,6 +172,35 @@ def common_options(f: tp.Callable) -> tp.Callable:
         cls=OrderableOption,
         order=30,
     )(f)
+    f = click.option(
+        '--output',
+        default=None,
+        callback=validate_output,
+        help='Where to put downloaded runs instead of the working directory: an S3 URL like '
+        '"s3://bucket/prefix". Credentials are read from AWS_ACCESS_KEY_ID and '
+        'AWS_SECRET_ACCESS_KEY, S3-compatible storage is set with AWS_ENDPOINT_URL.',
+        cls=OrderableOption,
+        order=35,
+    )(f)
+    f = click.option(
+        '--shards',
+        default=None,
+        type=click.IntRange(min=1),
+        help='Split every file of a run into this many record-aligned shards, compressed in '
+        'parallel while the run is downloaded (ENA) or converted (NCBI). Blocks of '
+        f'{config.SHARD_BLOCK_READS} reads go to the shards in turn, mates are split the same '
+        'way. The shards are listed in <accession>/<accession>.shards.json.',
+        cls=OrderableOption,
+        order=36,
+    )(f)
+    f = click.option(
+        '--shard-reads',
+        default=None,
+        type=click.IntRange(min=1),
+        help='Split every file of a run into shards of this many reads instead, see --shards.',
+        cls=OrderableOption,
+        order=37,
+    )(f)
     f = click.option(
         '--attempts',
         default=config.DEFAULT_MAX_ATTEMPTS,
@@ -151,11 +214,42 @@ def common_options(f: tp.Callable) -> tp.Callable:
         '--attempts_interval',
         default=0,
         show_default=True,
-        help='Retry attempts interval in seconds in case of network error.',
+        help='Retry attempts interval in seconds in case of network error. The interval doubles '
+        'with every attempt and is randomized.',
         type=click.IntRange(min=0),
         cls=OrderableOption,
         order=50,
     )(f)
+    f = click.option(
+        '--jobs',
+        default=1,
+        show_default=True,
+        help='Number of runs to download simultaneously.',
+        type=click.IntRange(min=1),
+        cls=OrderableOption,
+        order=52,
+    )(f)
+    f = click.option(
+        '--schedule',
+        'scheduling_policy',
+        default='input',
+        show_default=True,
+        help='Order in which runs are downloaded. "largest-first" gets run sizes from ENA and '
+        'starts with the biggest runs to avoid a long tail when downloading with several jobs.',
+        type=click.Choice(list(SCHEDULING_POLICIES), case_sensitive=False),
+        cls=OrderableOption,
+        order=53,
+    )(f)
+    f = click.option(
+        '--min-free-space',
+        default=None,
+        callback=validate_size,
+        help='Keep at least this much space free in the working directory, e.g. "50G". Enables '
+        'disk space admission control: space for every run is reserved before it is started, '
+        'runs wait while there is not enough space.',
+        cls=OrderableOption,
+        order=54,
+    )(f)
     f = click.option(
         '--skip-download',
         default=False,
@@ -166,6 +260,27 @@ def common_options(f: tp.Callable) -> tp.Callable:
         cls=OrderableOption,
         order=60,
     )(f)
+    f = click.option(
+        '--resume',
+        is_flag=True,
+        default=False,
+        help='Continue an interrupted download: skip runs that have been completed and '
+        'continue the others from the last completed stage. The state of every run is kept '
+        f'in {config.STATE_FILE_NAME} in the working directory.',
+        cls=OrderableOption,
+        order=65,
+    )(f)
+    f = click.option(
+        '--on-locked',
+        default='wait',
+        show_default=True,
+        help='What to do with a run that another FastqHeat process is downloading into the same '
+        'working directory: wait for it (and reuse its files once it has been checked) or skip '
+        'it and leave it to that process.',
+        type=click.Choice(['wait', 'skip']),
+        cls=OrderableOption,
+        order=66,
+    )(f)
     f = click.option(
         '--skip-check',
         default=False,
@@ -175,6 +290,23 @@ def common_options(f: tp.Callable) -> tp.Callable:
         cls=OrderableOption,
         order=70,
     )(f)
+    f = click.option(
+        '--job-store',
+        default=None,
+        type=click.Path(dir_okay=False, path_type=Path),
+        help='SQLite database shared by several FastqHeat processes, e.g. on a network file '
+        'system. Processes started with the same accessions and job store split the runs '
+        'between them, runs of a failed process are taken over by the others.',
+        cls=OrderableOption,
+        order=72,
+    )(f)
+    f = click.option(
+        '--node-id',
+        default=None,
+        help='Name of this process in the job store. Defaults to "<hostname>:<pid>".',
+        cls=OrderableOption,
+        order=74,
+    )(f)
     f = click.option(
         '--config',
         default=get_config_path,
@@ -188,6 +320,59 @@ def common_options(f: tp.Callable) -> tp.Callable:
     return f
 
 
+def make_job_store(
+    job_store: tp.Optional[Path], node_id: tp.Optional[str]
+) -> tp.Optional['SQLiteJobStore']:
+    from fastqheat.backend.job_store import SQLiteJobStore
+
+    if job_store is None:
+        if node_id is not None:
+            raise click.UsageError('--node-id requires --job-store')
+        return None
+    return SQLiteJobStore(job_store, node_id=node_id)
+
+
+def make_output_sink(output: tp.Optional[str], working_dir: Path) -> 'OutputSink':
+    from fastqheat.backend.sinks import make_sink
+
+    try:
+        return make_sink(output, working_dir)
+    except ValueError as err:
+        raise click.UsageError(str(err))
+
+
+def make_download_cache(
+    directory: tp.Optional[Path], max_size: tp.Optional[int]
+) -> tp.Optional['DownloadCache']:
+    if directory is None:
+        return None
+    from fastqheat.backend.download_cache import DownloadCache
+
+    return DownloadCache(directory, max_size=max_size)
+
+
+def make_sample_limits(
+    max_reads: tp.Optional[int], max_bytes: tp.Optional[int]
+) -> tp.Optional['SampleLimits']:
+    if max_reads is None and max_bytes is None:
+        return None
+    from fastqheat.backend.sampling import SampleLimits
+
+    return SampleLimits(max_reads=max_reads, max_bytes=max_bytes)
+
+
+def make_shard_layout(
+    shards: tp.Optional[int], shard_reads: tp.Optional[int]
+) -> tp.Optional['ShardLayout']:
+    if shards is None and shard_reads is None:
+        return None
+    if shards is not None and shard_reads is not None:
+        raise click.UsageError('--shards cannot be used with --shard-reads')
+    from fastqheat.backend.sharding import ShardLayout
+
+    return ShardLayout(shards=shards, reads_per_shard=shard_reads)
+
+
 def get_config_path() -> str:
     return os.path.join(os.path.dirname(__file__), 'config.conf')
 
@@ -199,10 +384,17 @@ def get_metadata_file() -> str:
 @tp.no_type_check
 def combine_accessions(f: tp.Callable):
     @functools.wraps(f)
-    def wrapped(*args, accession: tp.Optional[list], accession_file: tp.Optional[list], **kwargs):
+    def wrapped(
+        *args,
+        accession: tp.Optional['AccessionSource'],
+        accession_file: tp.Optional['AccessionSource'],
+        **kwargs,
+    ):
+        from fastqheat.backend.accessions import AccessionSource
+
         if not accession and not accession_file:
             raise click.UsageError('No accessions specified')
-        accession = (accession or []) + (accession_file or [])
+        accession = (accession or AccessionSource()) + (accession_file or AccessionSource())
         return f(*args, accession=accession, **kwargs)
 
     return wrapped
@@ -210,14 +402,34 @@ def combine_accessions(f: tp.Callable):
 
 @click.group()
 @click.version_option(__version__)
-def cli() -> None:
+@click.option(
+    '--profile',
+    'profile_path',
+    default=None,
+    type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True),
+    help='Profile the command and write cProfile stats to this file. A summary, including time '
+    'spent waiting for external tools, is printed and saved next to it with a ".txt" suffix.',
+)
+@click.option(
+    '--profile-top',
+    default=25,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of the most expensive functions to include in the profile summary.',
+)
+@click.pass_context
+def cli(ctx: click.Context, profile_path: tp.Optional[str], profile_top: int) -> None:
     """
     This help message is also accessible via `python3 -m fastqheat --help`.
     Run 'python3 -m fastqheat COMMAND --help' for more information on a command.
 
     For more info see README.MD
     """
-    pass
+    if profile_path:
+        from fastqheat.profiling import Profiler
+
+        # The profiler is stopped when the group context is closed, i.e. after the command is done
+        ctx.with_resource(Profiler(profile_path, top=profile_top))
 
 
 @click.command(cls=OrderedOptsCommand)
@@ -235,11 +447,107 @@ def cli() -> None:
     '--transport',
     default='binary',
     show_default=True,
-    help='Transport (method) to be user to download data.',
-    type=click.Choice(['binary', 'ftp'], case_sensitive=False),
+    help='Transport (method) to be user to download data. "auto" chooses the fastest one for '
+    'every file and falls back to the other one if it fails.',
+    type=click.Choice(['binary', 'ftp', 'auto'], case_sensitive=False),
     cls=OrderableOption,
     order=55,
 )
+@click.option(
+    '--max-bandwidth',
+    default=None,
+    callback=validate_bandwidth,
+    help='Bandwidth budget in bits per second shared by all transfers, e.g. "300m" or "1g". '
+    f'Unlimited by default (Aspera sessions then use "{config.DEFAULT_ASPERA_RATE}").',
+    cls=OrderableOption,
+    order=56,
+)
+@click.option(
+    '--bandwidth-control-file',
+    default=None,
+    type=click.Path(exists=False, file_okay=True, dir_okay=False),
+    help='File to change the bandwidth budget of a running job. Write a new value '
+    '(e.g. "100m" or "unlimited") to it and it will be picked up within a second.',
+    cls=OrderableOption,
+    order=57,
+)
+@click.option(
+    '--aspera-batch-size',
+    default=0,
+    show_default=True,
+    help='Transfer up to this many files in one Aspera session instead of starting ascp for '
+    'every file. 0 disables batching. Only used with the binary transport.',
+    type=click.IntRange(min=0),
+    cls=OrderableOption,
+    order=58,
+)
+@click.option(
+    '--aspera-sessions',
+    default=1,
+    show_default=True,
+    help='Number of Aspera batch sessions to run in parallel.',
+    type=click.IntRange(min=1),
+    cls=OrderableOption,
+    order=59,
+)
+@click.option(
+    '--stream-to',
+    'stream_to',
+    multiple=True,
+    callback=validate_stream_targets,
+    type=click.Path(exists=True, dir_okay=False, allow_dash=True),
+    help='Stream runs to stdout ("-") or to pre-created named pipes (FIFOs) instead of saving '
+    'them. Given twice, first mates go to the first target and second mates to the second one. '
+    'Runs are downloaded over HTTP one at a time, md5 is checked on the fly.',
+    cls=OrderableOption,
+    order=61,
+)
+@click.option(
+    '--interleave',
+    is_flag=True,
+    default=False,
+    help='With a single --stream-to target, decompress runs and interleave records of the mates.',
+    cls=OrderableOption,
+    order=62,
+)
+@click.option(
+    '--cache-dir',
+    'cache_directory',
+    default=None,
+    help='Download cache shared by working directories, e.g. of all projects on a node. Files are '
+    'found by their md5 and linked into the working directory instead of being downloaded again. '
+    'Overrides CacheDirectory in the ENA section of the config.',
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    cls=OrderableOption,
+    order=63,
+)
+@click.option(
+    '--cache-max-size',
+    default=None,
+    callback=validate_size,
+    help='Size of the download cache, e.g. 500G. The least recently used files are evicted beyond '
+    'it. Overrides CacheMaxSize in the ENA section of the config.',
+    cls=OrderableOption,
+    order=64,
+)
+@click.option(
+    '--max-reads',
+    default=None,
+    type=click.IntRange(min=1),
+    help='Download only this many reads from the start of every file (of every mate, keeping the '
+    'pairs in sync) over HTTP and save them as a new fastq.gz, e.g. for pilot analyses.',
+    cls=OrderableOption,
+    order=67,
+)
+@click.option(
+    '--max-bytes',
+    default=None,
+    callback=validate_size,
+    help='Like --max-reads, but stop the transfer of every file after this many bytes, e.g. '
+    '"100M". Second mates get as many reads as the first ones.',
+    cls=OrderableOption,
+    order=68,
+)
 @click.option(
     '--skip-download-metadata',
     default=False,
@@ -249,6 +557,43 @@ def cli() -> None:
     cls=OrderableOption,
     order=75,
 )
+@click.option(
+    '--min-length',
+    default=None,
+    type=click.IntRange(min=1),
+    help='Drop reads shorter than this (pairs of reads, if either mate is shorter) while they '
+    'are downloaded over HTTP.',
+    cls=OrderableOption,
+    order=76,
+)
+@click.option(
+    '--subsample',
+    'fraction',
+    default=None,
+    type=click.FloatRange(min=0, max=1, min_open=True),
+    help='Keep this fraction of the reads (pairs of reads), chosen at random while they are '
+    'downloaded over HTTP, e.g. 0.1.',
+    cls=OrderableOption,
+    order=77,
+)
+@click.option(
+    '--seed',
+    default=0,
+    show_default=True,
+    type=click.INT,
+    help='Seed of --subsample, the same seed keeps the same reads.',
+    cls=OrderableOption,
+    order=78,
+)
+@click.option(
+    '--strip-quality-headers',
+    is_flag=True,
+    default=False,
+    help='Remove read names from the "+" lines of the records while they are downloaded over '
+    'HTTP.',
+    cls=OrderableOption,
+    order=79,
+)
 @add_and_setup_logging
 @combine_accessions
 def ena(
@@ -256,30 +601,114 @@ def ena(
     metadata_file: str,
     config: FastQHeatConfigParser,
     transport: str,
-    accession: list[str],
+    max_bandwidth: tp.Optional[int],
+    bandwidth_control_file: tp.Optional[str],
+    aspera_batch_size: int,
+    aspera_sessions: int,
+    stream_to: tuple[str, ...],
+    interleave: bool,
+    cache_directory: tp.Optional[Path],
+    cache_max_size: tp.Optional[int],
+    max_reads: tp.Optional[int],
+    max_bytes: tp.Optional[int],
+    accession: 'AccessionSource',
     attempts: int,
     attempts_interval: int,
+    jobs: int,
+    scheduling_policy: str,
+    min_free_space: tp.Optional[int],
+    job_store: tp.Optional[Path],
+    node_id: tp.Optional[str],
+    output: tp.Optional[str],
+    shards: tp.Optional[int],
+    shard_reads: tp.Optional[int],
+    resume: bool,
+    on_locked: str,
     skip_download: bool,
     skip_check: bool,
     skip_download_metadata: bool,
+    min_length: tp.Optional[int],
+    fraction: tp.Optional[float],
+    seed: int,
+    strip_quality_headers: bool,
 ) -> None:
+    import asyncio
+
+    import fastqheat.backend.ena as ena_module
+    from fastqheat.backend.transforms import ReadTransforms
+    from fastqheat.exceptions import StreamError
+
+    if stream_to and jobs != 1:
+        raise click.UsageError('--stream-to cannot be used with --jobs')
+    if interleave and len(stream_to) != 1:
+        raise click.UsageError('--interleave requires a single --stream-to target')
+    transforms = ReadTransforms(min_length, fraction, seed, strip_quality_headers)
+    # files are derived from those in ENA on the fly
+    derived = max_reads is not None or max_bytes is not None or transforms.enabled
+    if derived and stream_to:
+        raise click.UsageError(
+            '--max-reads, --max-bytes and read transforms cannot be used with --stream-to'
+        )
+    shard_layout = make_shard_layout(shards, shard_reads)
+    if shard_layout is not None and stream_to:
+        raise click.UsageError('--shards and --shard-reads cannot be used with --stream-to')
+    # derived and sharded runs are rewritten on the fly
+    rewritten = derived or shard_layout is not None
+    cache_directory = cache_directory or config.ena_cache_directory
+    if cache_max_size is not None and cache_directory is None:
+        raise click.UsageError('--cache-max-size requires --cache-dir')
+
+    # accessions of the runs, studies are resolved through ENA only once
+    runs: tp.Optional[list[str]] = None
     if not skip_download:
-        if transport == 'binary':
+        aspera_available = True
+        # streamed and rewritten runs are downloaded over HTTP, Aspera is not needed
+        if transport == 'binary' and not stream_to and not rewritten:
             config.validate_ena_binary_config()
-        ena_module.download(
-            accessions=accession,
-            output_directory=working_dir,
-            transport=transport,
-            skip_check=skip_check,
-            binary_path=config.ena_binary_path,
-            attempts=attempts,
-            attempts_interval=attempts_interval,
-            aspera_ssh_path=config.ena_ssh_key_path,
-        )
+        elif transport == 'auto' and not stream_to and not rewritten:
+            try:
+                config.validate_ena_binary_config()
+            except click.BadParameter as err:
+                logger.warning("Aspera is not available, only FTP will be used: %s", err)
+                aspera_available = False
+        try:
+            runs = ena_module.download(
+                accessions=accession,
+                output_directory=working_dir,
+                transport=transport,
+                skip_check=skip_check,
+                binary_path=config.ena_binary_path,
+                attempts=attempts,
+                attempts_interval=attempts_interval,
+                aspera_ssh_path=config.ena_ssh_key_path,
+                max_bandwidth=max_bandwidth,
+                bandwidth_control_file=bandwidth_control_file,
+                aspera_batch_size=aspera_batch_size,
+                aspera_sessions=aspera_sessions,
+                aspera_available=aspera_available,
+                jobs=jobs,
+                scheduling_policy=scheduling_policy,
+                min_free_space=min_free_space,
+                job_store=make_job_store(job_store, node_id),
+                resume=resume,
+                wait_for_locked_runs=on_locked == 'wait',
+                stream_to=stream_to,
+                interleave=interleave,
+                sink=make_output_sink(output, working_dir),
+                sample=make_sample_limits(max_reads, max_bytes),
+                transforms=transforms,
+                shard_layout=shard_layout,
+                download_cache=make_download_cache(
+                    cache_directory, cache_max_size or config.ena_cache_max_size
+                ),
+            )
+        except StreamError as err:
+            raise click.ClickException(str(err))
     if skip_download and not skip_check:
+        runs = list(accession)
         ena_module.check(
             directory=working_dir,
-            accessions=accession,
+            accessions=runs,
             attempts=attempts,
             attempts_interval=attempts_interval,
         )
@@ -287,7 +716,7 @@ def ena(
         asyncio.run(
             ena_module.download_metadata(
                 directory=metadata_file,
-                accession=accession,
+                accession=runs if runs is not None else list(accession),
                 attempts=attempts,
                 attempts_interval=attempts_interval,
             )
@@ -301,27 +730,78 @@ def ena(
     default=get_cpu_cores_count,
     show_default=True,
     help='Sets the amount of cpu-threads used by fasterq-dump (binary that downloads files from'
-    ' NCBI) and pigz (binary that zips files)',
+    ' NCBI) and pigz (binary that zips files), shared by all jobs',
     type=click.IntRange(min=1),
     cls=OrderableOption,
     order=75,
 )
+@click.option(
+    '--prefetch',
+    is_flag=True,
+    default=False,
+    help='Fetch .sra files with prefetch into a cache in the working (or scratch) directory and '
+    'convert them with fasterq-dump while the next runs are fetched.',
+    cls=OrderableOption,
+    order=76,
+)
+@click.option(
+    '--scratch-dir',
+    'scratch_directory',
+    default=None,
+    help='Directory on a fast local disk (e.g. NVMe or tmpfs) for temporary files of fasterq-dump,'
+    ' uncompressed FASTQ files and checks. Only compressed files are moved to the working '
+    'directory. Overrides ScratchDirectory in the NCBI section of the config.',
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    cls=OrderableOption,
+    order=77,
+)
+@click.option(
+    '--compression',
+    default='gzip',
+    show_default=True,
+    help='Format of the compressed FASTQ files. "bgzf" is block gzip that can be read by any gzip '
+    'tool and accessed randomly, it comes with a block index (.gzi) and a read index (.fqi).',
+    type=click.Choice(['gzip', 'bgzf'], case_sensitive=False),
+    cls=OrderableOption,
+    order=78,
+)
 @add_and_setup_logging
 @combine_accessions
 def ncbi(
     working_dir: Path,
     config: FastQHeatConfigParser,
-    accession: list[str],
+    accession: 'AccessionSource',
     attempts: int,
     attempts_interval: int,
+    jobs: int,
+    scheduling_policy: str,
+    min_free_space: tp.Optional[int],
+    job_store: tp.Optional[Path],
+    node_id: tp.Optional[str],
+    output: tp.Optional[str],
+    shards: tp.Optional[int],
+    shard_reads: tp.Optional[int],
+    resume: bool,
+    on_locked: str,
     cpu_count: int,
+    prefetch: bool,
+    scratch_directory: tp.Optional[Path],
+    compression: str,
     skip_download: bool,
     skip_check: bool,
 ) -> None:
+    import fastqheat.backend.ncbi as ncbi_module
+
+    scratch_directory = scratch_directory or config.ncbi_scratch_directory
+    shard_layout = make_shard_layout(shards, shard_reads)
+    if shard_layout is not None and compression == 'bgzf':
+        raise click.UsageError('--shards and --shard-reads cannot be used with --compression=bgzf')
     if not skip_download or not skip_check:
         check_binary_available('pigz')
     if not skip_download:
         config.validate_ncbi_binary_config()
+        if prefetch:
+            check_binary_available('prefetch')
         ncbi_module.download(
             output_directory=working_dir,
             binary_path=config.ncbi_binary_path,
@@ -330,14 +810,26 @@ def ncbi(
             skip_check=skip_check,
             attempts_interval=attempts_interval,
             core_count=cpu_count,
+            jobs=jobs,
+            scheduling_policy=scheduling_policy,
+            min_free_space=min_free_space,
+            job_store=make_job_store(job_store, node_id),
+            resume=resume,
+            wait_for_locked_runs=on_locked == 'wait',
+            prefetch=prefetch,
+            scratch_directory=scratch_directory,
+            compression=compression,
+            sink=make_output_sink(output, working_dir),
+            shard_layout=shard_layout,
         )
     if skip_download and not skip_check:
         ncbi_module.check(
             directory=working_dir,
-            accessions=accession,
+            accessions=list(accession),
             attempts=attempts,
             attempts_interval=attempts_interval,
             core_count=cpu_count,
+            scratch_directory=scratch_directory,
         )
 
 
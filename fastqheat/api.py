@@ -0,0 +1,112 @@
+"""
+Python API of FastqHeat, for workflows that download runs without running the CLI.
+
+Usage example:
+
+import asyncio
+import fastqheat
+
+async def main():
+    async for result in fastqheat.fetch(["SRP163674"], backend="ena", working_dir="/data"):
+        if result.success:
+            start_alignment([file.path for file in result.files])
+        else:
+            print(result.accession, "failed:", result.error)
+
+asyncio.run(main())
+"""
+
+import asyncio
+import logging
+import typing as tp
+from pathlib import Path
+
+from fastqheat import typing_helpers as th
+from fastqheat.backend.accessions import AccessionSource
+from fastqheat.backend.ena.download import ENADownloadClient
+from fastqheat.backend.ena.transport import TransportType
+from fastqheat.backend.ncbi.download import NCBIDownloadClient
+from fastqheat.backend.results import FileResult, RunResult
+from fastqheat.config import config
+from fastqheat.utility import get_cpu_cores_count
+
+logger = logging.getLogger("fastqheat.api")
+
+__all__ = ["FileResult", "RunResult", "fetch"]
+
+BACKENDS = ("ena", "ncbi")
+
+
+async def fetch(
+    accessions: tp.Union[str, tp.Iterable[str]],
+    *,
+    working_dir: th.PathType,
+    backend: str = "ena",
+    attempts: int = config.DEFAULT_MAX_ATTEMPTS,
+    attempts_interval: int = 0,
+    skip_check: bool = False,
+    **options: tp.Any,
+) -> tp.AsyncIterator[RunResult]:
+    """
+    Download runs and yield the result of every run as soon as it is known.
+
+    `accessions` are run (SRR) or study (SRP) accessions, studies are resolved into their runs
+    while the first runs are downloaded. ValueError is raised for anything else. `options` are
+    passed to the download client of the backend (ENADownloadClient or NCBIDownloadClient), e.g.
+    `jobs`, `resume` or `transport`. ENA runs are downloaded over HTTP unless another `transport`
+    is given.
+
+    Runs are downloaded in a background thread. It keeps running until all runs are done, even
+    if the iteration is stopped early.
+    """
+    if isinstance(accessions, str):
+        accessions = [accessions]
+    source = AccessionSource(terms=accessions)
+    source.validate()
+
+    client = _make_client(
+        backend, Path(working_dir), attempts, attempts_interval, skip_check, options
+    )
+
+    loop = asyncio.get_running_loop()
+    results: asyncio.Queue[RunResult] = asyncio.Queue()
+
+    def report(result: RunResult) -> None:
+        # called from download threads
+        loop.call_soon_threadsafe(results.put_nowait, result)
+
+    client.on_result = report
+    download = loop.run_in_executor(None, client.download_accession_list, source)
+
+    while not download.done():
+        next_result = asyncio.ensure_future(results.get())
+        waited: set[asyncio.Future] = {next_result, download}
+        await asyncio.wait(waited, return_when=asyncio.FIRST_COMPLETED)
+        if next_result.done():
+            yield next_result.result()
+        else:
+            next_result.cancel()
+
+    # results reported right before the download has finished
+    while not results.empty():
+        yield results.get_nowait()
+    # errors that have stopped the download
+    download.result()
+
+
+def _make_client(
+    backend: str,
+    working_dir: Path,
+    attempts: int,
+    attempts_interval: int,
+    skip_check: bool,
+    options: dict[str, tp.Any],
+) -> tp.Union[ENADownloadClient, NCBIDownloadClient]:
+    if backend == "ena":
+        options.setdefault("transport", TransportType.ftp)
+        options.setdefault("aspera_ssh_path", "")
+        return ENADownloadClient(working_dir, attempts, attempts_interval, skip_check, **options)
+    if backend == "ncbi":
+        options.setdefault("core_count", get_cpu_cores_count())
+        return NCBIDownloadClient(working_dir, attempts, attempts_interval, skip_check, **options)
+    raise ValueError(f"Unknown backend: {backend!r}, expected one of {', '.join(BACKENDS)}")
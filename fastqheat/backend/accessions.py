@@ -0,0 +1,72 @@
+import logging
+import re
+import typing as tp
+
+from fastqheat import typing_helpers as th
+from fastqheat.backend.ena.ena_api_client import ENAClient
+from fastqheat.exceptions import ENAClientError
+
+logger = logging.getLogger("fastqheat.backend.accessions")
+
+SRR_PATTERN = re.compile(r'^(SRR|ERR|DRR)\d+$')
+SRP_PATTERN = re.compile(r'^(((SR|ER|DR)[PAXS])|(SAM(N|EA|D))|PRJ(NA|EB|DB)|(GS[EM]))\d+$')
+
+
+class AccessionSource:
+    """
+    Lazy, re-iterable stream of run accessions.
+
+    Terms are run accessions or studies (projects, samples, ...) given directly or in files with
+    one term per line. Files are read line by line and studies are resolved into runs via the ENA
+    API only when the stream is iterated, so the first runs are available right away and the
+    terms are never kept in memory all at once. Every iteration reads and resolves the terms
+    again.
+
+    Usage example:
+
+    source = AccessionSource(terms=['SRP163674'], files=['accessions.txt'])
+    source.validate()
+    for run_accession in source:
+        ...
+    """
+
+    def __init__(self, terms: tp.Iterable[str] = (), files: tp.Iterable[th.PathType] = ()):
+        self._terms = list(terms)
+        self._files = list(files)
+
+    def __add__(self, other: 'AccessionSource') -> 'AccessionSource':
+        return AccessionSource(self._terms + other._terms, self._files + other._files)
+
+    def __iter__(self) -> tp.Iterator[str]:
+        ena_client = ENAClient()
+        for term in self.terms():
+            if SRR_PATTERN.search(term):
+                yield term
+            elif SRP_PATTERN.search(term):
+                try:
+                    yield from ena_client.get_srr_ids_from_srp(term)
+                except ENAClientError:
+                    # The error is logged by ENAClient, skip the term and proceed with the next one
+                    continue
+            else:
+                raise ValueError(f"Unknown accession pattern: {term}")
+
+    def __bool__(self) -> bool:
+        return bool(self._terms or self._files)
+
+    def terms(self) -> tp.Iterator[str]:
+        """Terms as they are given, without empty lines."""
+        for term in self._terms:
+            if term:
+                yield term
+        for path in self._files:
+            with open(path) as file:
+                for line in file:
+                    if term := line.strip():
+                        yield term
+
+    def validate(self) -> None:
+        """Check patterns of all terms without resolving them."""
+        for term in self.terms():
+            if not SRR_PATTERN.search(term) and not SRP_PATTERN.search(term):
+                raise ValueError(f"Unknown accession pattern: {term}")
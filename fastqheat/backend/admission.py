@@ -0,0 +1,111 @@
+import contextlib
+import logging
+import shutil
+import threading
+import typing as tp
+from pathlib import Path
+
+from fastqheat.backend.scheduler import WorkItem
+from fastqheat.config import config
+from fastqheat.exceptions import InsufficientDiskSpaceError
+from fastqheat.utility import format_size
+
+logger = logging.getLogger("fastqheat.backend.admission")
+
+
+class DiskSpaceAdmission:
+    """
+    Reserves disk space for runs before they are downloaded.
+
+    The space a run needs is estimated as its `fastq_bytes` times `multiplier`, which accounts
+    for intermediate files (e.g. uncompressed fasterq-dump output and its temporary files).
+    A run is started only if the free space of the file system, minus space reserved by runs
+    that are in progress, stays above `min_free_space` after reserving space for it. Otherwise
+    the worker waits until other runs release their reservations or the free space grows.
+
+    A run that does not fit even when nothing else is in progress fails straight away instead of
+    filling the disk up and failing halfway through.
+
+    Reservations are conservative: files of a run in progress take free space and are still
+    counted as reserved until the run is done.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        min_free_space: int,
+        multiplier: float = 1.0,
+        poll_interval: float = config.DISK_SPACE_POLL_INTERVAL,
+    ):
+        self.directory = Path(directory)
+        self.min_free_space = min_free_space
+        self.multiplier = multiplier
+        self.poll_interval = poll_interval
+
+        self._condition = threading.Condition()
+        self._reserved = 0
+        self._runs_in_progress = 0
+
+    def estimate(self, size: tp.Optional[int]) -> int:
+        """Bytes needed to process a run with FASTQ files of `size` bytes."""
+        return int((size or 0) * self.multiplier)
+
+    def preflight(self, items: tp.Iterable[WorkItem]) -> None:
+        """Warn in advance if all runs are not going to fit."""
+        items = list(items)
+        needed = sum(self.estimate(item.size) for item in items)
+        unknown = sum(item.size is None for item in items)
+        available = self._get_free_space() - self.min_free_space
+
+        logger.info(
+            "Runs need about %s of disk space, %s is available in %s",
+            format_size(needed),
+            format_size(max(available, 0)),
+            self.directory,
+        )
+        if unknown:
+            logger.warning("Sizes of %d runs are unknown, space is not reserved for them", unknown)
+        if needed > available:
+            logger.warning(
+                "Not enough disk space to keep all runs. Runs are going to wait for free space "
+                "and fail if there is not enough of it even for a single run."
+            )
+
+    @contextlib.contextmanager
+    def reserve(self, item: WorkItem) -> tp.Iterator[None]:
+        """Wait until there is enough space for the run and keep it reserved for the context."""
+        needed = self.estimate(item.size)
+
+        with self._condition:
+            while True:
+                available = self._get_free_space() - self._reserved - self.min_free_space
+                if needed <= available:
+                    break
+                if not self._runs_in_progress:
+                    raise InsufficientDiskSpaceError(
+                        f"{item.accession} needs {format_size(needed)}, but only "
+                        f"{format_size(max(available, 0))} is available in {self.directory} "
+                        f"(keeping {format_size(self.min_free_space)} free)"
+                    )
+                logger.info(
+                    "Not enough disk space for %s (needs %s, %s available). Waiting...",
+                    item.accession,
+                    format_size(needed),
+                    format_size(max(available, 0)),
+                )
+                # wakes up when another run is done, or re-checks the file system periodically
+                self._condition.wait(self.poll_interval)
+
+            self._reserved += needed
+            self._runs_in_progress += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._reserved -= needed
+                self._runs_in_progress -= 1
+                self._condition.notify_all()
+
+    def _get_free_space(self) -> int:
+        return shutil.disk_usage(self.directory).free
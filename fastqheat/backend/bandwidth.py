@@ -0,0 +1,221 @@
+import contextlib
+import logging
+import re
+import threading
+import time
+import typing as tp
+from pathlib import Path
+
+from fastqheat import typing_helpers as th
+from fastqheat.config import config
+
+logger = logging.getLogger("fastqheat.backend.bandwidth")
+
+BANDWIDTH_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)\s*$', re.IGNORECASE)
+UNLIMITED_VALUES = ('', 'unlimited')
+MULTIPLIERS = {'': 1, 'k': 10**3, 'm': 10**6, 'g': 10**9}
+
+
+def parse_bandwidth(value: str) -> tp.Optional[int]:
+    """
+    Parse a bandwidth value into bits per second.
+
+    The format is the same as the one `ascp -l` uses: a number with an optional (decimal)
+    k/m/g suffix, e.g. "500k", "300m", "1.5g". Empty string, "unlimited" and zero with any suffix
+    ("0", "0m", "0.0") mean no limit, in which case None is returned.
+    """
+    if value.strip().lower() in UNLIMITED_VALUES:
+        return None
+
+    match = BANDWIDTH_PATTERN.match(value)
+    if not match:
+        raise ValueError(f"Invalid bandwidth value: {value!r}. Expected something like '300m'")
+
+    number, suffix = match.groups()
+    # a limit of zero would stall the transfers
+    return int(float(number) * MULTIPLIERS[suffix.lower()]) or None
+
+
+def format_aspera_rate(bits_per_second: int) -> str:
+    """Format a rate for the `ascp -l` option."""
+    return f"{max(bits_per_second // 1000, 1)}k"
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, tokens are bytes.
+
+    consume() never refuses a request: if there are not enough tokens, the bucket goes into debt
+    and the caller sleeps until the debt is paid off at the current rate. This keeps the average
+    rate of all consumers at `rate` while allowing chunks bigger than the bucket capacity.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: tp.Optional[float] = None,
+        clock: tp.Callable[[], float] = time.monotonic,
+        sleep: tp.Callable[[float], None] = time.sleep,
+    ):
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._rate = float(rate)
+        self._capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self._capacity
+        self._last_refill = self._clock()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            self._refill()
+            self._rate = float(rate)
+            self._capacity = float(rate)
+            self._tokens = min(self._tokens, self._capacity)
+
+    def consume(self, amount: int) -> None:
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            delay = -self._tokens / self._rate if self._tokens < 0 else 0.0
+
+        if delay > 0:
+            self._sleep(delay)
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+
+class BandwidthBudget:
+    """
+    One bandwidth budget shared by all transfers of a FastqHeat process.
+
+    Every transfer is registered as a session. An Aspera session gets a fixed share of the budget,
+    `max_bandwidth / max_sessions`, that is passed to `ascp -l` when it starts, so that the
+    sessions never exceed the budget together whatever their number. In-process HTTP(S)/FTP
+    streams share a token bucket whose rate is the rest of the budget. ascp cannot change its
+    rate afterwards: a new budget applies to Aspera sessions started after the change only,
+    running ones keep their rate (and HTTP streams get what they leave).
+
+    The budget can be changed at runtime by writing a new value (e.g. "100m", or "unlimited") into
+    the control file. The file is re-read when it is modified, at most once per
+    `config.BANDWIDTH_CONTROL_FILE_POLL_INTERVAL` seconds. If the file exists, its value takes
+    precedence over the one given on the command line.
+
+    Without any limit HTTP streams are not throttled and Aspera uses
+    `config.DEFAULT_ASPERA_RATE`.
+    """
+
+    HTTP = "http"
+    ASPERA = "aspera"
+
+    def __init__(
+        self,
+        max_bandwidth: tp.Optional[int] = None,
+        control_file: tp.Optional[th.PathType] = None,
+        max_sessions: int = 1,
+    ):
+        self._lock = threading.Lock()
+        self._max_bandwidth = max_bandwidth
+        # transfers that may run at the same time, e.g. the number of jobs
+        self.max_sessions = max(max_sessions, 1)
+        self._control_file = Path(control_file) if control_file else None
+        self._control_file_mtime: tp.Optional[float] = None
+        self._last_poll = 0.0
+        self._sessions: dict[str, int] = {self.HTTP: 0, self.ASPERA: 0}
+        # bits per second that running Aspera sessions have been started with
+        self._aspera_bandwidth = 0
+        self._http_bucket: tp.Optional[TokenBucket] = None
+
+        self._poll_control_file(force=True)
+
+    @property
+    def max_bandwidth(self) -> tp.Optional[int]:
+        """Current budget in bits per second, None means unlimited."""
+        return self._max_bandwidth
+
+    @contextlib.contextmanager
+    def session(self, kind: str) -> tp.Iterator[str]:
+        """
+        Register a transfer for the duration of the context.
+
+        Yields the rate to be passed to `ascp -l` (meaningful for Aspera sessions only).
+        """
+        self._poll_control_file()
+        with self._lock:
+            aspera_rate = self._aspera_rate()
+            bandwidth = (parse_bandwidth(aspera_rate) or 0) if kind == self.ASPERA else 0
+            self._sessions[kind] += 1
+            self._aspera_bandwidth += bandwidth
+            self._rebalance()
+        try:
+            yield aspera_rate
+        finally:
+            with self._lock:
+                self._sessions[kind] -= 1
+                self._aspera_bandwidth -= bandwidth
+                self._rebalance()
+
+    def throttle(self, nbytes: int) -> None:
+        """Account `nbytes` received by an HTTP stream, blocking if the budget is exceeded."""
+        self._poll_control_file()
+        bucket = self._http_bucket
+        if bucket is not None:
+            bucket.consume(nbytes)
+
+    def set_max_bandwidth(self, max_bandwidth: tp.Optional[int]) -> None:
+        with self._lock:
+            if max_bandwidth != self._max_bandwidth:
+                logger.info(
+                    "Bandwidth budget changed to %s",
+                    f"{max_bandwidth} bit/s" if max_bandwidth else "unlimited",
+                )
+            self._max_bandwidth = max_bandwidth
+            self._rebalance()
+
+    def _aspera_rate(self) -> str:
+        if self._max_bandwidth is None:
+            return config.DEFAULT_ASPERA_RATE
+        return format_aspera_rate(self._max_bandwidth // self.max_sessions)
+
+    def _rebalance(self) -> None:
+        """Recalculate the HTTP share of the budget. Must be called with the lock held."""
+        if self._max_bandwidth is None:
+            self._http_bucket = None
+            return
+
+        # bits -> bytes; HTTP streams get what running Aspera sessions leave
+        http_rate = max((self._max_bandwidth - self._aspera_bandwidth) // 8, 1)
+
+        if self._http_bucket is None:
+            self._http_bucket = TokenBucket(rate=http_rate)
+        else:
+            self._http_bucket.set_rate(http_rate)
+
+    def _poll_control_file(self, force: bool = False) -> None:
+        if self._control_file is None:
+            return
+
+        now = time.monotonic()
+        if not force and now - self._last_poll < config.BANDWIDTH_CONTROL_FILE_POLL_INTERVAL:
+            return
+        self._last_poll = now
+
+        try:
+            mtime = self._control_file.stat().st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self._control_file_mtime:
+            return
+        self._control_file_mtime = mtime
+
+        value = self._control_file.read_text()
+        try:
+            self.set_max_bandwidth(parse_bandwidth(value))
+        except ValueError as err:
+            logger.error("Ignoring bandwidth control file %s: %s", self._control_file, err)
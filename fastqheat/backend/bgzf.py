@@ -0,0 +1,137 @@
+import collections
+import concurrent.futures
+import logging
+import struct
+import typing as tp
+import zlib
+from pathlib import Path
+
+from fastqheat.config import config
+
+logger = logging.getLogger("fastqheat.backend.bgzf")
+
+# Uncompressed size of a block. Less than 64K, so that an incompressible block still fits in
+# the 64K limit on the size of a compressed block, same as in htslib.
+BLOCK_SIZE = 0xFF00
+MAX_COMPRESSED_BLOCK_SIZE = 0x10000
+
+# gzip member header with the BC extra field that holds the size of the compressed block
+_HEADER = struct.Struct('<4BI2BH2B2H')
+_FOOTER = struct.Struct('<2I')
+# an empty block, marks the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+BLOCK_INDEX_SUFFIX = '.gzi'
+READ_INDEX_SUFFIX = '.fqi'
+
+
+def compress_block(data: bytes, level: int = config.BGZF_COMPRESSION_LEVEL) -> bytes:
+    """Compress up to BLOCK_SIZE bytes into a BGZF block (a gzip member)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = _HEADER.size + len(deflated) + _FOOTER.size
+    if block_size > MAX_COMPRESSED_BLOCK_SIZE:
+        raise ValueError(f"Compressed block is too big: {block_size} bytes")
+    header = _HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, ord('B'), ord('C'), 2, block_size - 1)
+    return header + deflated + _FOOTER.pack(zlib.crc32(data), len(data))
+
+
+def virtual_offset(block_offset: int, offset_in_block: int) -> int:
+    """BGZF virtual offset: the offset of the block in the file and the offset in the block."""
+    return block_offset << 16 | offset_in_block
+
+
+class _ReadStarts:
+    """Finds uncompressed offsets of every `interval`-th read of a FASTQ file (4 lines a read)."""
+
+    def __init__(self, interval: int):
+        self.lines_between = 4 * interval
+        # newlines before the current chunk
+        self.lines = 0
+        # newlines before the next read to index
+        self.next_line = self.lines_between
+        self.offsets = [0]
+
+    def feed(self, chunk: bytes, chunk_offset: int) -> None:
+        total = self.lines + chunk.count(b'\n')
+        # newlines before `position`
+        seen, position = self.lines, 0
+        while total >= self.next_line:
+            for _ in range(self.next_line - seen):
+                position = chunk.index(b'\n', position) + 1
+            seen = self.next_line
+            self.offsets.append(chunk_offset + position)
+            self.next_line += self.lines_between
+        self.lines = total
+
+    def finish(self, size: int) -> list[int]:
+        # no read starts at the end of the file
+        return [offset for offset in self.offsets if offset < size]
+
+
+def compress_file(
+    source: Path,
+    target: Path,
+    threads: int = 1,
+    level: int = config.BGZF_COMPRESSION_LEVEL,
+    read_index_interval: int = config.BGZF_READ_INDEX_INTERVAL,
+) -> None:
+    """
+    Compress a FASTQ file into BGZF (block gzip, readable by any gzip tool) with indexes.
+
+    Blocks are compressed by `threads` threads, zlib releases the GIL while it works. Next to
+    the target two indexes are written:
+
+    - target.gzi: the block index in the format of `bgzip --index`, the number of entries and
+      then the compressed and the uncompressed offset of the start of every block but the first
+      one, all as little-endian uint64 (a file of a single block has no entries);
+    - target.fqi: a tab separated text file with the number of every `read_index_interval`-th
+      read (starting from 0) and the virtual offset of its first byte, suitable for
+      `bgzf_seek()` of htslib.
+    """
+    read_starts = _ReadStarts(read_index_interval)
+    # compressed offsets of the ends of the blocks
+    block_ends: list[int] = []
+    uncompressed_size = 0
+
+    with source.open('rb') as source_file, target.open('wb') as target_file:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="bgzf"
+        ) as executor:
+            # blocks are written in order, a few of them are compressed ahead
+            pending: tp.Deque[concurrent.futures.Future] = collections.deque()
+
+            def write_next() -> None:
+                block = pending.popleft().result()
+                target_file.write(block)
+                block_ends.append((block_ends[-1] if block_ends else 0) + len(block))
+
+            for chunk in iter(lambda: source_file.read(BLOCK_SIZE), b''):
+                read_starts.feed(chunk, uncompressed_size)
+                uncompressed_size += len(chunk)
+                pending.append(executor.submit(compress_block, chunk, level))
+                if len(pending) > 2 * threads:
+                    write_next()
+            while pending:
+                write_next()
+        target_file.write(EOF_BLOCK)
+
+    # the end of a block is the start of the next one, the first block starts at 0
+    block_index = [
+        (compressed, (number + 1) * BLOCK_SIZE) for number, compressed in enumerate(block_ends[:-1])
+    ]
+    with open(f'{target}{BLOCK_INDEX_SUFFIX}', 'wb') as block_index_file:
+        block_index_file.write(struct.pack('<Q', len(block_index)))
+        for offsets in block_index:
+            block_index_file.write(struct.pack('<2Q', *offsets))
+
+    with open(f'{target}{READ_INDEX_SUFFIX}', 'w') as index_file:
+        index_file.write("read\tvirtual_offset\n")
+        for number, offset in enumerate(read_starts.finish(uncompressed_size)):
+            block_number, offset_in_block = divmod(offset, BLOCK_SIZE)
+            block_offset = block_ends[block_number - 1] if block_number else 0
+            index_file.write(
+                f"{number * read_index_interval}\t{virtual_offset(block_offset, offset_in_block)}\n"
+            )
+
+    logger.debug("%s has been compressed into %d BGZF blocks", source, len(block_ends))
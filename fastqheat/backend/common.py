@@ -1,14 +1,81 @@
+import concurrent.futures
+import contextlib
+import functools
 import logging
 import subprocess
+import threading
+import time
+import typing as tp
 from abc import abstractmethod
 from pathlib import Path
 
-from fastqheat.backend.ena.ena_api_client import ENAClient
+import requests
+
+from fastqheat.backend.admission import DiskSpaceAdmission
 from fastqheat.backend.failed_output_writer import FailedAccessionWriter
-from fastqheat.exceptions import AccessionCheckerException, ENAClientError, ValidationError
+from fastqheat.backend.job_store import SQLiteJobStore
+from fastqheat.backend.locks import RunLocks
+from fastqheat.backend.results import FileResult, RunResult
+from fastqheat.backend.retry import RetryPolicy, classify_error
+from fastqheat.backend.scheduler import Scheduler, WorkItem, WorkQueue, get_scheduling_policy
+from fastqheat.backend.sinks import LocalSink, OutputSink
+from fastqheat.backend.state import StateStore
+from fastqheat.backend.verification import VerificationStage
+from fastqheat.config import config
+from fastqheat.exceptions import (
+    AccessionCheckerException,
+    ENAClientError,
+    InsufficientDiskSpaceError,
+    RunLockedError,
+    ValidationError,
+)
+from fastqheat.utility import prefetch
+
+if tp.TYPE_CHECKING:
+    from fastqheat.backend.ena.ena_api_client import ENAClient
 
 logger = logging.getLogger("fastqheat.backend.common")
 
+# Errors that fail the download of an accession, other errors are bugs
+DOWNLOAD_ERRORS = (
+    ENAClientError,
+    requests.RequestException,
+    subprocess.CalledProcessError,
+    ValidationError,
+    InsufficientDiskSpaceError,
+)
+
+
+def _make_ena_client(attempts: int, attempts_interval: int) -> 'ENAClient':
+    # imported here: the ena package imports this module, and the NCBI backend should not load
+    # the ENA one (with aiohttp) unless it needs ENA
+    from fastqheat.backend.ena.ena_api_client import ENAClient
+
+    return ENAClient(attempts=attempts, attempts_interval=attempts_interval)
+
+
+def get_run_size(ena_client: 'ENAClient', accession: str) -> tp.Optional[int]:
+    """Request `fastq_bytes` of the run from ENA, None if it is not available."""
+    try:
+        return sum(ena_client.get_fastq_bytes(accession))
+    except ENAClientError:
+        logger.warning("Cannot get size of %s from ENA", accession)
+        return None
+
+
+def get_run_sizes(
+    accessions: tp.Iterable[str], attempts: int, attempts_interval: int
+) -> dict[str, tp.Optional[int]]:
+    """Request `fastq_bytes` of the runs from ENA, a few requests at a time."""
+
+    ena_client = _make_ena_client(attempts, attempts_interval)
+    unique_accessions = list(dict.fromkeys(accessions))
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=config.RUN_SIZE_SIMULTANEOUS_CONNECTIONS_NUMBER
+    ) as executor:
+        sizes = executor.map(functools.partial(get_run_size, ena_client), unique_accessions)
+        return dict(zip(unique_accessions, sizes))
+
 
 class BaseAccessionChecker:
     def __init__(self, directory: Path, attempts: int, attempts_interval: int) -> None:
@@ -16,7 +83,7 @@ class BaseAccessionChecker:
         self.attempts = attempts
         self.attempts_interval = attempts_interval
         self.failed_accession_writer = FailedAccessionWriter(self.directory)
-        self.ena_client = ENAClient(attempts, attempts_interval)
+        self.ena_client = _make_ena_client(attempts, attempts_interval)
 
     def check_accessions(self, accessions: list[str]) -> int:
         num_accessions = len(accessions)
@@ -38,45 +105,428 @@ class BaseAccessionChecker:
 
 
 class BaseDownloadClient:
+    # Disk space needed by a run relative to its size in ENA, see DiskSpaceAdmission
+    disk_space_multiplier: float = 1.0
+
     def __init__(
-        self, output_directory: Path, attempts: int, attempts_interval: int, skip_check: bool
+        self,
+        output_directory: Path,
+        attempts: int,
+        attempts_interval: int,
+        skip_check: bool,
+        jobs: int = 1,
+        scheduling_policy: str = 'input',
+        min_free_space: tp.Optional[int] = None,
+        job_store: tp.Optional[SQLiteJobStore] = None,
+        resume: bool = False,
+        retry_policy: tp.Optional[RetryPolicy] = None,
+        sink: tp.Optional[OutputSink] = None,
+        wait_for_locked_runs: bool = True,
     ):
         self.output_directory = Path(output_directory)
         self.attempts = attempts
         self.attempts_interval = attempts_interval
         self.skip_check = skip_check
         self.failed_output_writer = FailedAccessionWriter(self.output_directory)
+        # how many accessions are downloaded simultaneously
+        self.jobs = jobs
+        self.scheduling_policy = get_scheduling_policy(scheduling_policy)
+        self.disk_space_admission = (
+            DiskSpaceAdmission(
+                self.output_directory, min_free_space, multiplier=self.disk_space_multiplier
+            )
+            if min_free_space is not None
+            else None
+        )
+        # shared queue of accessions when several processes work on the same accession list
+        self.job_store = job_store
+        self.state_store = StateStore(self.output_directory)
+        # other processes downloading into the same working directory do not take locked runs,
+        # runs locked by them are either waited for or left to them
+        self.run_locks = RunLocks(self.output_directory)
+        self.wait_for_locked_runs = wait_for_locked_runs
+        # runs completed by other processes since this time are not downloaded again
+        self._run_started = time.time()
+        # skip accessions completed by a previous run and continue the others where they stopped
+        self.resume = resume
+        # states left by the previous run, read before they are changed by this one
+        self._resumed_states: dict[str, str] = {}
+        self.retry_policy = retry_policy or RetryPolicy()
+        # where completed runs go, the working directory by default
+        self.sink = sink or LocalSink(self.output_directory)
+        # checks of downloaded files run there while the next files are downloaded
+        self.verification = VerificationStage()
+        self._result_lock = threading.Lock()
+        # called with the result of every run as soon as it is known, from download threads
+        self.on_result: tp.Optional[tp.Callable[[RunResult], None]] = None
+        # details of the runs for their results
+        self._started: dict[str, float] = {}
+        self._md5s: dict[str, dict[str, str]] = {}
+        self._read_counts: dict[str, int] = {}
 
-    def download_accession_list(self, accessions: list[str]) -> int:
-        """Iterate through accession lint and download them one by one."""
-        num_accessions = len(accessions)
-        logger.info("There are %d accessions to download", num_accessions)
-        successfully_downloaded = 0
+    @property
+    def completed_state(self) -> str:
+        """The last stage of an accession downloaded by this client."""
+        return StateStore.DOWNLOADED if self.skip_check else StateStore.VERIFIED
+
+    def download_accession_list(self, accessions: tp.Iterable[str]) -> int:
+        """
+        Download accessions, return the number of accessions downloaded successfully.
+
+        `accessions` may be a lazy stream (e.g. an AccessionSource): unless all accessions are
+        needed upfront to order them or to share them through a job store, downloads start as soon
+        as the first accessions arrive, while the rest of the stream is read in the background.
+        The accessions read from the stream are available as `accessions` afterwards, so it does
+        not need to be read (and its studies resolved) again.
+        """
+        self.accessions: list[str] = []
+        self._already_completed = 0
+        self._run_started = time.time()
+        accessions = self._count_accessions(accessions)
+        if self.resume:
+            self._resumed_states = self.state_store.states()
+            accessions = self._skip_completed(accessions)
+
+        with self.run_locks.heartbeat():
+            successfully_downloaded = self._download_accessions(accessions)
+
+        if self.resume:
+            logger.info(
+                "Resumed: %d accessions had already been completed", self._already_completed
+            )
+        logger.info(
+            "State of the accessions is kept in %s: %s",
+            self.state_store.path,
+            ", ".join(f"{count} {state}" for state, count in self.state_store.summary().items()),
+        )
+        return self._already_completed + successfully_downloaded
 
+    @property
+    def num_accessions(self) -> int:
+        return len(self.accessions)
+
+    def _count_accessions(self, accessions: tp.Iterable[str]) -> tp.Iterator[str]:
         for accession in accessions:
-            try:
-                self.download_one_accession(accession)
-                successfully_downloaded += 1
-            except ENAClientError:
-                logger.info(
-                    "Failed to download current run: %s. Number of attempts: %d",
-                    accession,
-                    self.attempts,
-                )
-            except (
-                subprocess.CalledProcessError,
-                ValidationError,
-            ) as err:
-                logger.info(
-                    "Failed to download current run: %s. Number of attempts: %d. Error details: %s",
-                    accession,
-                    self.attempts,
-                    str(err),
-                )
-                self.failed_output_writer.add_accession(accession)
+            self.accessions.append(accession)
+            yield accession
+
+    def _skip_completed(self, accessions: tp.Iterable[str]) -> tp.Iterator[str]:
+        for accession in accessions:
+            if StateStore.reached(self._resumed_state(accession), self.completed_state):
+                self._already_completed += 1
+                self._report_result(accession)
+            else:
+                yield accession
+
+    def _download_accessions(self, accessions: tp.Iterable[str]) -> int:
+        """
+        Download accessions in the order defined by the scheduling policy.
+
+        Up to `jobs` accessions are downloaded at the same time, each worker takes the next
+        accession from the work queue as soon as it is done with the previous one. The work queue
+        is either an in-memory scheduler, or a job store shared with other processes.
+        """
+        if self.job_store is None and not self.scheduling_policy.needs_sizes:
+            logger.info("Downloading accessions as they arrive")
+            return self._run_workers(self._make_streaming_work_queue(accessions))
 
+        accessions = list(accessions)
+        logger.info("There are %d accessions to download", len(accessions))
+        work_queue = self._make_work_queue(accessions)
+
+        if self.job_store is None:
+            return self._run_workers(work_queue)
+
+        with self.job_store.heartbeat():
+            successfully_downloaded = self._run_workers(work_queue)
+        logger.info(
+            "Job store %s: %s",
+            self.job_store.path,
+            ", ".join(f"{count} {state}" for state, count in self.job_store.summary().items()),
+        )
         return successfully_downloaded
 
+    def _make_streaming_work_queue(self, accessions: tp.Iterable[str]) -> WorkQueue:
+        """
+        Work queue fed by the accessions as they arrive.
+
+        Accessions are read (and their sizes requested, if needed) in a background thread, up to
+        ACCESSION_QUEUE_SIZE of them ahead of the workers.
+        """
+
+        def make_work_items() -> tp.Iterator[WorkItem]:
+            ena_client = _make_ena_client(self.attempts, self.attempts_interval)
+            for index, accession in enumerate(accessions):
+                size = None
+                if self.disk_space_admission is not None:
+                    size = get_run_size(ena_client, accession)
+                item = WorkItem(accession=accession, index=index, size=size)
+                self.state_store.resolve([item])
+                yield item
+
+        return Scheduler(
+            [],
+            self.scheduling_policy,
+            source=prefetch(make_work_items(), maxsize=config.ACCESSION_QUEUE_SIZE),
+        )
+
+    def _make_work_queue(self, accessions: list[str]) -> WorkQueue:
+        if self.job_store is not None:
+            # accessions added by other nodes already have their sizes in the store
+            accessions = self.job_store.missing(accessions)
+
+        sizes = None
+        if self.scheduling_policy.needs_sizes or self.disk_space_admission is not None:
+            sizes = get_run_sizes(accessions, self.attempts, self.attempts_interval)
+
+        scheduler = Scheduler.from_accessions(accessions, self.scheduling_policy, sizes)
+        self.state_store.resolve(scheduler.items)
+        if self.disk_space_admission is not None:
+            self.disk_space_admission.preflight(scheduler.items)
+
+        if self.job_store is None:
+            return scheduler
+
+        added = self.job_store.add(scheduler.items, self.scheduling_policy)
+        logger.info("%d accessions have been added to the job store %s", added, self.job_store.path)
+        return self.job_store
+
+    def _run_workers(self, work_queue: WorkQueue) -> int:
+        self._successfully_downloaded = 0
+
+        if self.jobs == 1:
+            self._download_scheduled(work_queue)
+            return self._successfully_downloaded
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.jobs, thread_name_prefix="download"
+        ) as executor:
+            workers = [
+                executor.submit(self._download_scheduled, work_queue) for _ in range(self.jobs)
+            ]
+            for worker in workers:
+                worker.result()
+        return self._successfully_downloaded
+
+    def _download_scheduled(self, work_queue: WorkQueue) -> None:
+        """
+        Download accessions from the work queue until there are none left.
+
+        Accessions may be verified in the verification stage after the worker has moved on to
+        the next accession, their outcome is handled when the verification is done. Before
+        leaving, the worker waits for the verification of its accessions, which may put them
+        back into the work queue.
+        """
+        # done when the outcome of an accession in the verification stage has been handled
+        finished: list[concurrent.futures.Future] = []
+
+        while True:
+            while (item := work_queue.next()) is not None:
+                result = self._download_item(item)
+                if not isinstance(result, concurrent.futures.Future):
+                    self._finish_item(work_queue, item, result)
+                    continue
+
+                finished.append(concurrent.futures.Future())
+                result.add_done_callback(
+                    functools.partial(self._finish_verified_item, work_queue, item, finished[-1])
+                )
+
+            if not finished:
+                return
+            concurrent.futures.wait(finished)
+            finished.clear()
+
+    def _finish_verified_item(
+        self,
+        work_queue: WorkQueue,
+        item: WorkItem,
+        finished: concurrent.futures.Future,
+        verification: concurrent.futures.Future,
+    ) -> None:
+        try:
+            error = verification.exception()
+            if error is not None and not isinstance(error, DOWNLOAD_ERRORS):
+                logger.error("Unexpected error when verifying %s", item.accession, exc_info=error)
+            self._finish_item(work_queue, item, tp.cast(tp.Optional[Exception], error))
+        finally:
+            finished.set_result(None)
+
+    def _finish_item(
+        self, work_queue: WorkQueue, item: WorkItem, error: tp.Optional[Exception]
+    ) -> None:
+        """
+        Report the outcome of an accession to the work queue.
+
+        Accessions that have failed with a transient error are deferred: they go back to the work
+        queue and are retried later, while the worker moves on to other accessions.
+        """
+        if isinstance(error, RunLockedError):
+            # the run is left to the process that holds its lock
+            logger.info("Skipping %s", str(error))
+            work_queue.done(item, success=True)
+            return
+
+        if error is None:
+            work_queue.done(item, success=True)
+            with self._result_lock:
+                self._successfully_downloaded += 1
+            self._report_result(item.accession)
+            return
+
+        kind = classify_error(error)
+        if self.retry_policy.should_defer(kind, item.retries):
+            delay = self.retry_policy.delay(item.retries)
+            logger.warning(
+                "Failed to download %s (%s error: %s). Retrying in %.0f seconds",
+                item.accession,
+                kind,
+                str(error),
+                delay,
+            )
+            self.state_store.record_error(item.accession, str(error))
+            item.retries += 1
+            work_queue.defer(item, delay)
+            return
+
+        self._report_failure(item.accession, error)
+        work_queue.done(item, success=False)
+        self._report_result(item.accession, error)
+
+    def _download_item(
+        self, item: WorkItem
+    ) -> tp.Union[None, Exception, concurrent.futures.Future]:
+        """
+        Download an accession.
+
+        Returns the error if it has failed, or the future of its verification if the accession
+        is still being verified.
+        """
+        self._started.setdefault(item.accession, time.monotonic())
+        try:
+            self.run_locks.acquire(item.accession, wait=self.wait_for_locked_runs)
+        except RunLockedError as err:
+            return err
+
+        # the lock and the disk space are held until the run has been verified, e.g. NCBI runs
+        # are checked, compressed and moved out of the scratch directory by the verification
+        reservation = contextlib.ExitStack()
+        verifying = False
+
+        def release(_: tp.Any = None) -> None:
+            reservation.close()
+            self.run_locks.release(item.accession)
+
+        try:
+            if self._completed_elsewhere(item.accession):
+                return None
+            reservation.enter_context(self._reserve_disk_space(item))
+            self.state_store.start(item.accession, self._resumed_state(item.accession))
+            result = self.download_one_accession(item.accession)
+            if isinstance(result, concurrent.futures.Future):
+                result.add_done_callback(release)
+                verifying = True
+            return result
+        except DOWNLOAD_ERRORS as err:
+            return err
+        finally:
+            if not verifying:
+                release()
+
+    def _completed_elsewhere(self, accession: str) -> bool:
+        """Whether another process has completed the run while this one was running."""
+        state = self.state_store.get(accession)
+        if state is None or state.updated < self._run_started:
+            return False
+        if not StateStore.reached(state.state, self.completed_state):
+            return False
+        logger.info("%s has just been completed by another download, reusing it", accession)
+        return True
+
+    def _reserve_disk_space(self, item: WorkItem) -> tp.ContextManager:
+        if self.disk_space_admission is None:
+            return contextlib.nullcontext()
+        return self.disk_space_admission.reserve(item)
+
+    def _resumed_state(self, accession: str) -> tp.Optional[str]:
+        """State of the accession left by a previous run, None unless resuming."""
+        return self._resumed_states.get(accession)
+
+    def _advance(self, accession: str, state: str) -> None:
+        """Record a completed stage together with the size of the accession directory."""
+        accession_directory = self.output_directory / accession
+        nbytes = sum(
+            path.stat().st_size for path in accession_directory.glob('*') if path.is_file()
+        )
+        self.state_store.advance(accession, state, nbytes)
+
+    def _store_run(self, accession: str) -> None:
+        """Hand files of a completed run in the working directory over to a remote sink."""
+        if self.sink.is_local:
+            return
+        accession_directory = self.output_directory / accession
+        for path in sorted(accession_directory.glob('*')):
+            if path.is_file():
+                relative_path = f'{accession}/{path.name}'
+                self.sink.store(path, relative_path)
+                logger.debug("%s has been stored in %s", path, self.sink.describe(relative_path))
+        with contextlib.suppress(OSError):
+            accession_directory.rmdir()
+
+    def _report_failure(self, accession: str, error: Exception) -> None:
+        if isinstance(error, ENAClientError):
+            logger.info(
+                "Failed to download current run: %s. Number of attempts: %d",
+                accession,
+                self.attempts,
+            )
+        else:
+            logger.info(
+                "Failed to download current run: %s. Number of attempts: %d. Error details: %s",
+                accession,
+                self.attempts,
+                str(error),
+            )
+            self.failed_output_writer.add_accession(accession)
+        self.state_store.fail(accession, str(error))
+
+    def _report_result(self, accession: str, error: tp.Optional[Exception] = None) -> None:
+        """Pass the result of the run to `on_result`."""
+        committed = self.sink.take_committed(accession)
+        if self.on_result is None:
+            return
+
+        files: list[FileResult] = []
+        if error is None and self.sink.is_local:
+            md5s = self._md5s.get(accession, {})
+            files = [
+                FileResult(path=path, size=path.stat().st_size, md5=md5s.get(path.name))
+                for path in sorted((self.output_directory / accession).glob('*.fastq.gz'))
+            ]
+        elif error is None:
+            # files of a remote sink are not on the local disk, they are described as written
+            files = [
+                FileResult(path=self.sink.describe(relative_path), size=size, md5=md5)
+                for relative_path, (size, md5) in sorted(committed.items())
+                if relative_path.endswith('.fastq.gz')
+            ]
+        started = self._started.get(accession)
+        self.on_result(
+            RunResult(
+                accession=accession,
+                success=error is None,
+                files=files,
+                read_count=self._read_counts.get(accession),
+                elapsed=time.monotonic() - started if started is not None else None,
+                error=str(error) if error is not None else None,
+            )
+        )
+
     @abstractmethod
-    def download_one_accession(self, accession: str) -> None:
-        pass
+    def download_one_accession(self, accession: str) -> tp.Optional[concurrent.futures.Future]:
+        """
+        Download an accession, raise one of DOWNLOAD_ERRORS if it has failed.
+
+        Checks of the downloaded files may be left to the verification stage, in which case the
+        future of the checks is returned.
+        """
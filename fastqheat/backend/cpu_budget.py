@@ -0,0 +1,53 @@
+import contextlib
+import logging
+import threading
+import typing as tp
+
+logger = logging.getLogger("fastqheat.backend.cpu_budget")
+
+
+class CpuBudget:
+    """
+    Splits a fixed number of CPU threads between external tools that run at the same time.
+
+    Every tool (fasterq-dump, pigz, ...) reserves threads for as long as it runs and releases them
+    when it exits, so the total number of threads never exceeds the budget. A tool asks for the
+    number of threads it can make good use of and gets fewer when the budget is mostly taken; it
+    only waits when no thread is free at all, so that a tool started late is not starved by ones
+    that keep starting.
+
+    Usage example:
+
+    budget = CpuBudget(64)
+    with budget.reserve(8) as threads:
+        subprocess.run(['pigz', '--processes', str(threads), path], check=True)
+    """
+
+    def __init__(self, total: int):
+        if total < 1:
+            raise ValueError(f"CPU budget must be positive, got {total}")
+        self.total = total
+        self._available = total
+        self._condition = threading.Condition()
+
+    @property
+    def available(self) -> int:
+        with self._condition:
+            return self._available
+
+    @contextlib.contextmanager
+    def reserve(self, wanted: int) -> tp.Iterator[int]:
+        """Reserve up to `wanted` threads, yields the number of reserved threads."""
+        wanted = max(1, min(wanted, self.total))
+        with self._condition:
+            self._condition.wait_for(lambda: self._available > 0)
+            granted = min(wanted, self._available)
+            self._available -= granted
+        if granted < wanted:
+            logger.debug("Reserved %d of %d wanted CPU threads", granted, wanted)
+        try:
+            yield granted
+        finally:
+            with self._condition:
+                self._available += granted
+                self._condition.notify_all()
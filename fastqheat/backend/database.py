@@ -0,0 +1,35 @@
+import contextlib
+import sqlite3
+import typing as tp
+
+from fastqheat import typing_helpers as th
+from fastqheat.config import config
+
+
+def connect(path: th.PathType) -> sqlite3.Connection:
+    """
+    Open an SQLite database in autocommit mode.
+
+    A new connection is opened for every operation: connections cannot be shared between threads,
+    and short-lived ones behave better on network file systems.
+    """
+    connection = sqlite3.connect(path, timeout=config.SQLITE_BUSY_TIMEOUT, isolation_level=None)
+    # WAL does not work on network file systems
+    connection.execute("PRAGMA journal_mode=DELETE")
+    return connection
+
+
+@contextlib.contextmanager
+def transaction(path: th.PathType) -> tp.Iterator[sqlite3.Connection]:
+    """Exclusive write transaction, concurrent writers (threads or processes) are serialized."""
+    connection = connect(path)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
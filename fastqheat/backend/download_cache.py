@@ -0,0 +1,244 @@
+import contextlib
+import dataclasses
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import typing as tp
+from pathlib import Path
+
+from fastqheat.backend import database
+from fastqheat.utility import format_size
+
+logger = logging.getLogger("fastqheat.backend.download_cache")
+
+# ioctl that makes a file share the blocks of another one (Linux, btrfs/XFS/...)
+FICLONE = 0x40049409
+
+
+@dataclasses.dataclass
+class CacheStats:
+    # files taken from the cache, and files that had to be downloaded
+    hits: int = 0
+    misses: int = 0
+    # bytes that have not been downloaded thanks to the cache
+    bytes_saved: int = 0
+
+    def describe(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {format_size(self.bytes_saved)} saved"
+
+
+class DownloadCache:
+    """
+    Content-addressed cache of verified files, shared by working directories, users and nodes.
+
+    Files are keyed by their md5 in ENA (`fastq_md5`) and kept as
+    <directory>/objects/<first 2 characters of md5>/<md5>, read-only. A cached file is put into
+    a working directory as a hard link, or as a reflink when hard links are not possible (e.g.
+    a file of another user with fs.protected_hardlinks), or as a symlink to the cache as the last
+    resort. Only files that have passed the md5 check are added. Since a file of the shared cache
+    may have been damaged after that, every process checks the md5 of a cached file again before
+    it uses it for the first time; a damaged file is removed from the cache and downloaded.
+
+    The index (size and last use of every file) and the statistics are kept in an SQLite
+    database in the cache directory. When the cache grows beyond `max_size`, the least recently
+    used files are evicted. Hard links and reflinks survive eviction, symlinks do not.
+
+    Errors of the cache (e.g. of a shared file system) are logged, the file is then downloaded.
+    """
+
+    INDEX_FILE_NAME = 'index.sqlite'
+
+    def __init__(self, directory: Path, max_size: tp.Optional[int] = None):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.objects_directory = self.directory / 'objects'
+        self.objects_directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.directory / self.INDEX_FILE_NAME
+        # statistics of this process, the index keeps the totals of all of them
+        self.stats = CacheStats()
+        self._stats_lock = threading.Lock()
+        # md5s of the cached files that have been checked by this process
+        self._verified: set[str] = set()
+        self._create_schema()
+
+    def materialize(self, md5: str, target: Path) -> bool:
+        """Put the cached file with this md5 at `target`, return False if it is not cached."""
+        source = self._object_path(md5)
+        try:
+            with contextlib.closing(database.connect(self.index_path)) as connection:
+                row = connection.execute("SELECT size FROM files WHERE md5 = ?", (md5,)).fetchone()
+            if row is None or source.stat().st_size != row[0]:
+                self._record(hit=False)
+                return False
+            if md5 not in self._verified:
+                if self._md5(source) != md5:
+                    logger.warning(
+                        "%s in the download cache is damaged, it is removed", target.name
+                    )
+                    self._discard(md5)
+                    self._record(hit=False)
+                    return False
+                self._verified.add(md5)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.unlink(missing_ok=True)
+            how = self._link(source, target)
+            with database.transaction(self.index_path) as connection:
+                connection.execute(
+                    "UPDATE files SET last_used = ?, hits = hits + 1 WHERE md5 = ?",
+                    (time.time(), md5),
+                )
+        except FileNotFoundError:
+            # evicted in the meantime
+            self._record(hit=False)
+            return False
+        except (OSError, sqlite3.Error) as err:
+            logger.warning("Cannot take %s from the download cache: %s", target.name, str(err))
+            self._record(hit=False)
+            return False
+
+        logger.debug("%s has been taken from the download cache (%s)", target.name, how)
+        self._record(hit=True, nbytes=row[0])
+        return True
+
+    def add(self, md5: str, path: Path) -> None:
+        """Add a verified file to the cache, then evict files beyond `max_size`."""
+        target = self._object_path(md5)
+        try:
+            if target.is_file():
+                with database.transaction(self.index_path) as connection:
+                    connection.execute(
+                        "UPDATE files SET last_used = ? WHERE md5 = ?", (time.time(), md5)
+                    )
+                return
+
+            target.parent.mkdir(exist_ok=True)
+            temp_path = target.with_name(f'.{md5}.{os.getpid()}.{threading.get_ident()}')
+            try:
+                os.link(path, temp_path)
+            except OSError:
+                self._copy(path, temp_path)
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, target)
+
+            with database.transaction(self.index_path) as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO files (md5, size, last_used) VALUES (?, ?, ?)",
+                    (md5, target.stat().st_size, time.time()),
+                )
+            self._verified.add(md5)
+            logger.debug("%s has been added to the download cache", path.name)
+            self._evict()
+        except (OSError, sqlite3.Error) as err:
+            logger.warning("Cannot add %s to the download cache: %s", path.name, str(err))
+
+    def total_stats(self) -> CacheStats:
+        """Statistics of all processes that have used the cache."""
+        with contextlib.closing(database.connect(self.index_path)) as connection:
+            values = dict(connection.execute("SELECT name, value FROM stats").fetchall())
+        return CacheStats(**values)
+
+    def size(self) -> int:
+        with contextlib.closing(database.connect(self.index_path)) as connection:
+            return connection.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+
+    def _evict(self) -> None:
+        if self.max_size is None:
+            return
+        evicted = []
+        with database.transaction(self.index_path) as connection:
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+            rows = connection.execute("SELECT md5, size FROM files ORDER BY last_used")
+            for md5, size in rows.fetchall():
+                if total <= self.max_size:
+                    break
+                connection.execute("DELETE FROM files WHERE md5 = ?", (md5,))
+                total -= size
+                evicted.append(md5)
+        for md5 in evicted:
+            self._object_path(md5).unlink(missing_ok=True)
+        if evicted:
+            logger.debug("%d files have been evicted from the download cache", len(evicted))
+
+    def _discard(self, md5: str) -> None:
+        with database.transaction(self.index_path) as connection:
+            connection.execute("DELETE FROM files WHERE md5 = ?", (md5,))
+        self._object_path(md5).unlink(missing_ok=True)
+
+    def _record(self, hit: bool, nbytes: int = 0) -> None:
+        with self._stats_lock:
+            if hit:
+                self.stats.hits += 1
+                self.stats.bytes_saved += nbytes
+            else:
+                self.stats.misses += 1
+        counters = {'hits': int(hit), 'misses': int(not hit), 'bytes_saved': nbytes}
+        with contextlib.suppress(sqlite3.Error), database.transaction(
+            self.index_path
+        ) as connection:
+            connection.executemany(
+                "UPDATE stats SET value = value + ? WHERE name = ?",
+                [(value, name) for name, value in counters.items()],
+            )
+
+    def _object_path(self, md5: str) -> Path:
+        return self.objects_directory / md5[:2] / md5
+
+    @staticmethod
+    def _md5(path: Path) -> str:
+        md5_hash = hashlib.md5()
+        with path.open('rb') as file:
+            for block in iter(lambda: file.read(md5_hash.block_size * 4_096), b''):
+                md5_hash.update(block)
+        return md5_hash.hexdigest()
+
+    @staticmethod
+    def _link(source: Path, target: Path) -> str:
+        """Link the cached file, return how it has been done."""
+        with contextlib.suppress(OSError):
+            os.link(source, target)
+            return "hard link"
+        with contextlib.suppress(OSError):
+            DownloadCache._reflink(source, target)
+            return "reflink"
+        target.unlink(missing_ok=True)
+        os.symlink(source.resolve(), target)
+        return "symlink"
+
+    @staticmethod
+    def _reflink(source: Path, target: Path) -> None:
+        with source.open('rb') as source_file, target.open('wb') as target_file:
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            except OSError:
+                target_file.close()
+                target.unlink()
+                raise
+
+    @staticmethod
+    def _copy(source: Path, target: Path) -> None:
+        try:
+            DownloadCache._reflink(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+    def _create_schema(self) -> None:
+        with database.transaction(self.index_path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "md5 TEXT PRIMARY KEY, "
+                "size INTEGER NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)",
+                [(field.name,) for field in dataclasses.fields(CacheStats)],
+            )
@@ -1,40 +1,83 @@
+import concurrent.futures
+import contextlib
+import dataclasses
+import hashlib
+import itertools
+import json
 import logging
+import os
 import subprocess
+import time
 import typing as tp
 from pathlib import Path
 
-import backoff
 import requests
 
 from fastqheat import typing_helpers as th
+from fastqheat.backend.bandwidth import BandwidthBudget
 from fastqheat.backend.common import BaseDownloadClient
+from fastqheat.backend.download_cache import DownloadCache
 from fastqheat.backend.ena.check import check_md5_checksum
 from fastqheat.backend.ena.ena_api_client import ENAClient
+from fastqheat.backend.ena.transport import TransportSelector, TransportType
+from fastqheat.backend.job_store import SQLiteJobStore
+from fastqheat.backend.retry import RetryPolicy, is_permanent_error, retry_on
+from fastqheat.backend.sampling import SampleLimits, fastq_head
+from fastqheat.backend.scheduler import WorkItem
+from fastqheat.backend.sharding import FastqWriter, ShardLayout, shard_index, shard_index_name
+from fastqheat.backend.sinks import OutputSink, SinkWriter
+from fastqheat.backend.state import StateStore
+from fastqheat.backend.streaming import StreamTargets, gunzip, interleave, paired_records
+from fastqheat.backend.transforms import ReadTransforms, RecordFilter
+from fastqheat.backend.verification import all_of
 from fastqheat.config import config
-from fastqheat.exceptions import ValidationError
-from fastqheat.utility import BaseEnum
+from fastqheat.exceptions import ENAClientError, RunLockedError, StreamError, ValidationError
 
 logger = logging.getLogger("fastqheat.ena.download")
 
 
-class TransportType(BaseEnum):
-    binary = "binary"
-    ftp = "ftp"
+@dataclasses.dataclass(frozen=True)
+class AsperaFile:
+    """A file to be transferred in an Aspera batch session."""
+
+    accession: str
+    # e.g. fasp.sra.ebi.ac.uk:/vol1/fastq/SRR796/006/SRR7969986/SRR7969986_1.fastq.gz
+    url: str
+    md5: tp.Optional[str] = None
+
+    @property
+    def host(self) -> str:
+        return self.url.split(':', 1)[0]
+
+    @property
+    def remote_path(self) -> str:
+        return self.url.split(':', 1)[1]
+
+    @property
+    def file_name(self) -> str:
+        return self.url.split('/')[-1]
 
 
 def download(
     *,
-    accessions: list[str],
+    accessions: tp.Iterable[str],
     output_directory: Path,
     binary_path: th.PathType = "",
     attempts: int,
     attempts_interval: int,
     skip_check: bool,
     **kwargs: tp.Any,
-) -> None:
-
+) -> list[str]:
+    """Download the runs, return their accessions as they have been read (studies resolved)."""
     aspera_ssh_path = kwargs.get("aspera_ssh_path", "")
     transport = kwargs.get("transport", TransportType.ftp)
+    bandwidth_budget = BandwidthBudget(
+        max_bandwidth=kwargs.get("max_bandwidth"),
+        control_file=kwargs.get("bandwidth_control_file"),
+        # Aspera batches are transferred in several sessions at a time
+        max_sessions=max(kwargs.get("jobs", 1), kwargs.get("aspera_sessions", 1)),
+    )
+    stream_targets = StreamTargets(kwargs["stream_to"]) if kwargs.get("stream_to") else None
 
     download_client = ENADownloadClient(
         output_directory,
@@ -44,10 +87,31 @@ def download(
         transport=transport,
         aspera_ssh_path=aspera_ssh_path,
         binary_path=binary_path,
+        bandwidth_budget=bandwidth_budget,
+        aspera_batch_size=kwargs.get("aspera_batch_size", 0),
+        aspera_sessions=kwargs.get("aspera_sessions", 1),
+        aspera_available=kwargs.get("aspera_available", True),
+        jobs=kwargs.get("jobs", 1),
+        scheduling_policy=kwargs.get("scheduling_policy", "input"),
+        min_free_space=kwargs.get("min_free_space"),
+        job_store=kwargs.get("job_store"),
+        resume=kwargs.get("resume", False),
+        wait_for_locked_runs=kwargs.get("wait_for_locked_runs", True),
+        stream_targets=stream_targets,
+        interleave=kwargs.get("interleave", False),
+        sink=kwargs.get("sink"),
+        download_cache=kwargs.get("download_cache"),
+        sample=kwargs.get("sample"),
+        transforms=kwargs.get("transforms"),
+        shard_layout=kwargs.get("shard_layout"),
     )
 
-    successfully_downloaded = download_client.download_accession_list(accessions)
-    num_accessions = len(accessions)
+    try:
+        successfully_downloaded = download_client.download_accession_list(accessions)
+    finally:
+        if stream_targets is not None:
+            stream_targets.close()
+    num_accessions = download_client.num_accessions
 
     if skip_check:
         logger.info(
@@ -59,9 +123,14 @@ def download(
             successfully_downloaded,
             num_accessions,
         )
+    if download_client.download_cache is not None:
+        logger.info("Download cache: %s.", download_client.download_cache.stats.describe())
+    return download_client.accessions
 
 
 class ENADownloadClient(BaseDownloadClient):
+    disk_space_multiplier = config.ENA_DISK_SPACE_MULTIPLIER
+
     def __init__(
         self,
         output_directory: Path,
@@ -71,40 +140,205 @@ class ENADownloadClient(BaseDownloadClient):
         transport: TransportType,
         aspera_ssh_path: th.PathType,
         binary_path: th.PathType = "",
+        bandwidth_budget: tp.Optional[BandwidthBudget] = None,
+        aspera_batch_size: int = 0,
+        aspera_sessions: int = 1,
+        aspera_available: bool = True,
+        jobs: int = 1,
+        scheduling_policy: str = 'input',
+        min_free_space: tp.Optional[int] = None,
+        job_store: tp.Optional[SQLiteJobStore] = None,
+        resume: bool = False,
+        retry_policy: tp.Optional[RetryPolicy] = None,
+        stream_targets: tp.Optional[StreamTargets] = None,
+        interleave: bool = False,
+        sink: tp.Optional[OutputSink] = None,
+        wait_for_locked_runs: bool = True,
+        download_cache: tp.Optional[DownloadCache] = None,
+        sample: tp.Optional[SampleLimits] = None,
+        transforms: tp.Optional[ReadTransforms] = None,
+        shard_layout: tp.Optional[ShardLayout] = None,
     ):
-        super().__init__(output_directory, attempts, attempts_interval, skip_check)
+        if stream_targets is not None:
+            if jobs != 1:
+                raise ValueError("Runs can only be streamed one at a time")
+            if interleave and len(stream_targets) != 1:
+                raise ValueError("Interleaved mates can only be streamed to a single target")
+            # a retried run would be streamed twice
+            retry_policy = retry_policy or RetryPolicy(deferred_retries=0)
+
+        super().__init__(
+            output_directory,
+            attempts,
+            attempts_interval,
+            skip_check,
+            jobs=jobs,
+            scheduling_policy=scheduling_policy,
+            min_free_space=min_free_space,
+            job_store=job_store,
+            resume=resume,
+            retry_policy=retry_policy,
+            sink=sink,
+            wait_for_locked_runs=wait_for_locked_runs,
+        )
 
         self.binary_path = binary_path
-        self.transport = transport
+        self.bandwidth_budget = bandwidth_budget or BandwidthBudget()
+        # 0 means one ascp process per file
+        self.aspera_batch_size = aspera_batch_size
+        self.aspera_sessions = aspera_sessions
+        self.transport = TransportType(transport)
         self.aspera_ssh_path = aspera_ssh_path or config.PATH_TO_ASPERA_KEY
         self.transport_flag = (
             {"aspera": True} if self.transport == TransportType.binary else {"ftp": True}
         )
+        # runs are streamed over HTTP to stdout or FIFOs instead of being saved
+        self.stream_targets = stream_targets
+        self.interleave = interleave
+        # files downloaded over HTTP and waiting for their check, their md5 has been computed
+        # while they were written
+        self._written: dict[Path, SinkWriter] = {}
+        # only the first reads of every file are downloaded, e.g. for pilot analyses, and/or
+        # reads are filtered on the way: files are derived from those in ENA over HTTP
+        self.sample = sample
+        self.transforms = transforms or ReadTransforms()
+        self.derived = sample is not None or self.transforms.enabled
+        # files are split into shards while they are downloaded over HTTP
+        self.shard_layout = shard_layout
+        # runs that are not saved as the files in ENA are
+        self.rewritten = self.derived or shard_layout is not None
+        if self.rewritten and stream_targets is not None:
+            raise ValueError("Sampled, transformed or sharded runs cannot be streamed")
+        # verified files shared by working directories, streamed and rewritten runs do not use it
+        self.download_cache = (
+            download_cache if stream_targets is None and not self.rewritten else None
+        )
+        # files taken from the cache, their md5 has been checked by the cache
+        self._cache_hits: set[Path] = set()
 
-        if transport == TransportType.binary:
-            self._download_function = backoff.on_exception(
-                backoff.constant,
-                subprocess.CalledProcessError,
-                jitter=None,  # The jitter is disabled in order to keep attempts interval fixed
-                max_tries=attempts,
-                interval=attempts_interval,
-            )(self._download_via_aspera)
+        self._download_functions: dict[TransportType, tp.Callable[..., int]] = {
+            TransportType.binary: retry_on(
+                subprocess.CalledProcessError, attempts, attempts_interval
+            )(self._download_via_aspera),
+            TransportType.ftp: retry_on(
+                requests.exceptions.RequestException, attempts, attempts_interval
+            )(self._download_file),
+        }
+        self._download_batch_function = retry_on(
+            subprocess.CalledProcessError, attempts, attempts_interval
+        )(self._download_batch_via_aspera)
 
+        if transport == TransportType.auto:
+            available = [TransportType.binary, TransportType.ftp]
+            if not aspera_available:
+                available.remove(TransportType.binary)
+            self.transport_selector = TransportSelector(available)
         else:
-            self._download_function = backoff.on_exception(
-                backoff.constant,
-                requests.exceptions.RequestException,
-                jitter=None,  # The jitter is disabled in order to keep attempts interval fixed
-                max_tries=attempts,
-                interval=attempts_interval,
-            )(self._download_file)
-
-    def download_one_accession(self, accession: str) -> None:
-        self._download_one_accession(
-            accession
-        ) if self.skip_check else self._download_and_check_one_accession(accession)
-
-    def _download_and_check_one_accession(self, accession: str) -> None:
+            self._download_function = self._download_functions[transport]
+
+    def _download_accessions(self, accessions: tp.Iterable[str]) -> int:
+        # with a job store accessions are claimed one by one, there are no batches to build
+        if (
+            self.transport == TransportType.binary
+            and self.aspera_batch_size
+            and self.job_store is None
+            and self.stream_targets is None
+            and not self.rewritten
+        ):
+            return self._download_accession_list_in_batches(list(accessions))
+        return super()._download_accessions(accessions)
+
+    def download_one_accession(self, accession: str) -> tp.Optional[concurrent.futures.Future]:
+        if self.stream_targets is not None:
+            self._stream_accession(accession, self.stream_targets)
+            return None
+        self._remove_stale_files(accession)
+        if self.rewritten:
+            self._rewrite_accession(accession)
+            return None
+
+        if self.transport == TransportType.auto:
+            return self._download_one_accession_with_auto_transport(accession)
+
+        if self.skip_check:
+            self._download_one_accession(accession)
+            return None
+        return self._download_and_check_one_accession(accession)
+
+    def _download_one_accession_with_auto_transport(
+        self, accession: str
+    ) -> tp.Optional[concurrent.futures.Future]:
+        """
+        Download files of the accession choosing the transport for every file.
+
+        If the chosen transport fails after all its attempts, the file is downloaded with the next
+        best transport, the accession fails only if none of them succeeded.
+        """
+        logger.debug("Preparing to download an accession: %s", accession)
+
+        aspera_urls, ftp_urls, md5s = ENAClient(
+            attempts=self.attempts, attempts_interval=self.attempts_interval
+        ).get_all_urls_and_md5s(accession)
+
+        accession_directory = Path(self.output_directory, accession)
+        accession_directory.mkdir(parents=True, exist_ok=True)
+        file_paths = [accession_directory / url.split('/')[-1] for url in ftp_urls]
+        self._md5s[accession] = {path.name: md5 for path, md5 in zip(file_paths, md5s)}
+
+        downloaded = StateStore.reached(self._resumed_state(accession), StateStore.DOWNLOADED)
+        checks = []
+        for aspera_url, ftp_url, md5, file_path in zip(aspera_urls, ftp_urls, md5s, file_paths):
+            if not downloaded and not self._from_cache(md5, file_path):
+                urls = {TransportType.binary: aspera_url, TransportType.ftp: ftp_url}
+                self._download_with_fallback(urls, file_path, None if self.skip_check else md5)
+            if not self.skip_check:
+                checks.append(self.verification.submit(self._check_file, accession, file_path, md5))
+        if not downloaded:
+            self._advance(accession, StateStore.DOWNLOADED)
+
+        if self.skip_check:
+            self._store_run(accession)
+            logger.info("Current Run: %s has been successfully downloaded", accession)
+            return None
+        return self._verify_accession(accession, checks)
+
+    def _download_with_fallback(
+        self, urls: dict[TransportType, str], file_path: Path, md5: tp.Optional[str] = None
+    ) -> TransportType:
+        """Download a file with the best transport, falling back to the others on errors."""
+        transport = self.transport_selector.choose()
+        candidates = [transport, *self.transport_selector.fallbacks(transport)]
+
+        for i, transport in enumerate(candidates):
+            start = time.monotonic()
+            try:
+                nbytes = self._download_functions[transport](
+                    url=urls[transport], file_path=file_path, md5=md5
+                )
+            except (subprocess.CalledProcessError, requests.exceptions.RequestException) as err:
+                self.transport_selector.record_failure(transport)
+                if i == len(candidates) - 1:
+                    raise
+                logger.warning(
+                    "Failed to download %s via %s, falling back to %s. Error details: %s",
+                    file_path.name,
+                    transport,
+                    candidates[i + 1],
+                    str(err),
+                )
+                continue
+
+            self.transport_selector.record_success(transport, nbytes, time.monotonic() - start)
+            return transport
+
+        raise RuntimeError("No transport is available")
+
+    def _download_and_check_one_accession(self, accession: str) -> concurrent.futures.Future:
+        """
+        Download files of the accession, checking every file while the next one is downloaded.
+
+        Returns the future of the checks, which may still be running.
+        """
         logger.debug("Preparing to download an accession: %s", accession)
 
         links, md5s = ENAClient(
@@ -113,17 +347,45 @@ class ENADownloadClient(BaseDownloadClient):
 
         accession_directory = Path(self.output_directory, accession)
         accession_directory.mkdir(parents=True, exist_ok=True)
+        file_paths = [accession_directory / url.split('/')[-1] for url in links]
+        self._md5s[accession] = {path.name: md5 for path, md5 in zip(file_paths, md5s)}
 
-        for url, md5 in zip(links, md5s):
-            srr = url.split('/')[-1]
-            file_path = accession_directory / srr
+        downloaded = StateStore.reached(self._resumed_state(accession), StateStore.DOWNLOADED)
+        checks = []
+        for url, md5, file_path in zip(links, md5s, file_paths):
+            if not downloaded and not self._from_cache(md5, file_path):
+                self._download_function(url=url, file_path=file_path, md5=md5)
+            checks.append(self.verification.submit(self._check_file, accession, file_path, md5))
+        if not downloaded:
+            self._advance(accession, StateStore.DOWNLOADED)
 
-            self._download_function(url=url, file_path=file_path)
+        return self._verify_accession(accession, checks)
 
-            if not check_md5_checksum(file_path, md5):
-                raise ValidationError("Downloaded run - %s - failed md5 check.", accession)
+    def _check_file(self, accession: str, file_path: Path, md5: str) -> None:
+        if file_path in self._cache_hits:
+            self._cache_hits.discard(file_path)
+            return
+        # files written to the sink are not read again
+        written = self._written.pop(file_path, None)
+        if written is not None:
+            valid = written.md5 == md5
+        else:
+            valid = check_md5_checksum(file_path, md5)
+        if not valid:
+            raise ValidationError("Downloaded run - %s - failed md5 check.", accession)
 
-        logger.info("Current run - %s - has been downloaded and checked successfully", accession)
+    def _verify_accession(
+        self, accession: str, checks: list[concurrent.futures.Future]
+    ) -> concurrent.futures.Future:
+        def on_success() -> None:
+            self._add_to_cache(accession)
+            self._store_run(accession)
+            self._advance(accession, StateStore.VERIFIED)
+            logger.info(
+                "Current run - %s - has been downloaded and checked successfully", accession
+            )
+
+        return all_of(checks, on_success)
 
     def _download_one_accession(self, accession: str) -> bool:
         logger.debug("Preparing to download an accession: %s", accession)
@@ -141,37 +403,632 @@ class ENADownloadClient(BaseDownloadClient):
             self._download_function(url=url, file_path=file_path)
             logger.info("Current Run: %s has been successfully downloaded", accession)
 
+        self._store_run(accession)
+        self._advance(accession, StateStore.DOWNLOADED)
         return True
 
-    def _download_via_aspera(self, url: str, file_path: th.PathType) -> None:
-        logger.debug(
-            "Calling aspera with parameters:\nbinary_path: %s\naspera_ssh_path: %s\nurl: %s",
-            self.binary_path or 'ascp',
-            self.aspera_ssh_path,
-            url,
-        )
-        subprocess.run(
-            [
+    def _download_via_aspera(
+        self, url: str, file_path: th.PathType, md5: tp.Optional[str] = None
+    ) -> int:
+        """Download the file with ascp, which writes it itself. Returns its size."""
+        # the file is checked afterwards, not the md5 of an earlier download over HTTP
+        self._written.pop(Path(file_path), None)
+        with self.bandwidth_budget.session(BandwidthBudget.ASPERA) as rate:
+            logger.debug(
+                "Calling aspera with parameters:\nbinary_path: %s\naspera_ssh_path: %s\nurl: %s"
+                "\nrate: %s",
                 self.binary_path or 'ascp',
-                '-QT',
-                '-l',
-                '300m',
-                '-P',
-                '33001',
-                '-i',
                 self.aspera_ssh_path,
-                f'era-fasp@{url}',
-                file_path,
-            ],
-            check=True,
+                url,
+                rate,
+            )
+            subprocess.run(
+                [
+                    self.binary_path or 'ascp',
+                    '-QT',
+                    '-l',
+                    rate,
+                    '-P',
+                    '33001',
+                    '-i',
+                    self.aspera_ssh_path,
+                    f'era-fasp@{url}',
+                    file_path,
+                ],
+                check=True,
+            )
+        return Path(file_path).stat().st_size
+
+    def _download_accession_list_in_batches(self, accessions: list[str]) -> int:
+        """
+        Download files of all accessions in a few Aspera sessions instead of one per file.
+
+        Files are transferred in batches of up to `aspera_batch_size` files, `aspera_sessions`
+        batches at a time, into a staging directory inside the output directory. Afterwards every
+        file is moved to the directory of its accession and checked. ascp is run with `-k 1`, so
+        a retried (or re-run) batch does not transfer complete files again.
+
+        Runs locked by other processes are not waited for, they are left to those processes.
+        """
+        unique_accessions = list(dict.fromkeys(accessions))
+        logger.info(
+            "There are %d accessions to download in batches of up to %d files",
+            len(unique_accessions),
+            self.aspera_batch_size,
+        )
+
+        self.state_store.resolve(
+            WorkItem(accession=accession, index=index)
+            for index, accession in enumerate(unique_accessions)
         )
 
-    def _download_file(self, url: str, file_path: th.PathType, chunk_size: int = 10**6) -> None:
+        locked = []
+        for accession in unique_accessions:
+            try:
+                self.run_locks.acquire(accession, wait=False)
+            except RunLockedError as err:
+                logger.info("Skipping %s", str(err))
+                continue
+            locked.append(accession)
+        try:
+            return self._download_locked_accessions_in_batches(accessions, locked)
+        finally:
+            for accession in locked:
+                self.run_locks.release(accession)
+
+    def _download_locked_accessions_in_batches(
+        self, accessions: list[str], unique_accessions: list[str]
+    ) -> int:
+        completed = {
+            accession for accession in unique_accessions if self._completed_elsewhere(accession)
+        }
+        unique_accessions = [
+            accession for accession in unique_accessions if accession not in completed
+        ]
+        for accession in unique_accessions:
+            self._started.setdefault(accession, time.monotonic())
+        files: list[AsperaFile] = []
+        # accessions downloaded by a previous run, their files only need to be checked
+        downloaded = set()
+        for accession in unique_accessions:
+            self.state_store.start(accession, self._resumed_state(accession))
+            self._remove_stale_files(accession)
+            try:
+                files += self._get_aspera_files(accession)
+            except ENAClientError as err:
+                logger.info(
+                    "Failed to download current run: %s. Number of attempts: %d",
+                    accession,
+                    self.attempts,
+                )
+                self.state_store.fail(accession, str(err))
+                self._report_result(accession, err)
+                continue
+            if StateStore.reached(self._resumed_state(accession), StateStore.DOWNLOADED):
+                downloaded.add(accession)
+
+        staging_directory = self.output_directory / config.ASPERA_STAGING_DIRECTORY
+        staging_directory.mkdir(exist_ok=True)
+
+        # url -> where the file has been put by a successful session
+        transferred: dict[str, Path] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.aspera_sessions) as executor:
+            futures = {}
+            files_to_transfer = [
+                file
+                for file in files
+                if file.accession not in downloaded
+                and not self._from_cache(
+                    file.md5, self.output_directory / file.accession / file.file_name
+                )
+            ]
+            for batch, directory in self._make_aspera_batches(files_to_transfer, staging_directory):
+                future = executor.submit(
+                    self._download_batch_function, batch=batch, directory=directory
+                )
+                futures[future] = (batch, directory)
+            for future in concurrent.futures.as_completed(futures):
+                batch, directory = futures[future]
+                try:
+                    future.result()
+                except subprocess.CalledProcessError as err:
+                    # Files of a failed session may be incomplete. They are left in the staging
+                    # directory for ascp to resume them on the next run.
+                    logger.info(
+                        "Aspera batch session for %s failed. Error details: %s", directory, str(err)
+                    )
+                    continue
+                transferred.update({file.url: directory / file.file_name for file in batch})
+
+        successful = set()
+        for accession in unique_accessions:
+            accession_files = [file for file in files if file.accession == accession]
+            if not accession_files:
+                continue
+            try:
+                self._finalize_batch_accession(accession, accession_files, transferred)
+                successful.add(accession)
+                self._report_result(accession)
+            except (FileNotFoundError, ValidationError) as err:
+                logger.info(
+                    "Failed to download current run: %s. Number of attempts: %d. "
+                    "Error details: %s",
+                    accession,
+                    self.attempts,
+                    str(err),
+                )
+                self.failed_output_writer.add_accession(accession)
+                self.state_store.fail(accession, str(err))
+                self._report_result(accession, err)
+
+        self._remove_staging_directory(staging_directory)
+        for accession in completed:
+            self._report_result(accession)
+        return sum(accession in successful | completed for accession in accessions)
+
+    def _get_aspera_files(self, accession: str) -> list[AsperaFile]:
+        ena_client = ENAClient(attempts=self.attempts, attempts_interval=self.attempts_interval)
+        if self.skip_check:
+            return [
+                AsperaFile(accession, url) for url in ena_client.get_urls(accession, aspera=True)
+            ]
+
+        urls, md5s = ena_client.get_urls_and_md5s(accession, aspera=True)
+        self._md5s[accession] = {url.split('/')[-1]: md5 for url, md5 in zip(urls, md5s)}
+        return [AsperaFile(accession, url, md5) for url, md5 in zip(urls, md5s)]
+
+    def _make_aspera_batches(
+        self, files: list[AsperaFile], staging_directory: Path
+    ) -> tp.Iterator[tuple[list[AsperaFile], Path]]:
+        """Split files into batches of one host each, every batch has its own directory."""
+        files_by_host: dict[str, list[AsperaFile]] = {}
+        for file in dict.fromkeys(files):  # the same run may be a part of several studies
+            files_by_host.setdefault(file.host, []).append(file)
+
+        batch_number = 0
+        for host_files in files_by_host.values():
+            for i in range(0, len(host_files), self.aspera_batch_size):
+                directory = staging_directory / f"batch_{batch_number}"
+                directory.mkdir(exist_ok=True)
+                batch_number += 1
+                yield host_files[i : i + self.aspera_batch_size], directory
+
+    def _download_batch_via_aspera(self, batch: list[AsperaFile], directory: Path) -> None:
+        file_list = directory / "file_list.txt"
+        file_list.write_text("".join(f"{file.remote_path}\n" for file in batch))
+
+        with self.bandwidth_budget.session(BandwidthBudget.ASPERA) as rate:
+            logger.debug(
+                "Calling aspera for a batch of %d files from %s to %s. Rate: %s",
+                len(batch),
+                batch[0].host,
+                directory,
+                rate,
+            )
+            subprocess.run(
+                [
+                    self.binary_path or 'ascp',
+                    '-QT',
+                    '-l',
+                    rate,
+                    '-P',
+                    '33001',
+                    '-k',
+                    '1',
+                    '-i',
+                    self.aspera_ssh_path,
+                    '--mode=recv',
+                    f'--host={batch[0].host}',
+                    '--user=era-fasp',
+                    f'--file-list={file_list}',
+                    directory,
+                ],
+                check=True,
+            )
+
+    def _finalize_batch_accession(
+        self, accession: str, files: list[AsperaFile], transferred: dict[str, Path]
+    ) -> None:
+        """Move files of an accession from the staging directory and check them."""
+        accession_directory = Path(self.output_directory, accession)
+        accession_directory.mkdir(parents=True, exist_ok=True)
+
+        for file in files:
+            file_path = accession_directory / file.file_name
+            staged_path = transferred.get(file.url)
+            if staged_path is not None and staged_path.is_file():
+                os.replace(staged_path, file_path)
+
+            if not file_path.is_file():
+                raise FileNotFoundError(f"{file.file_name} has not been downloaded")
+        self._advance(accession, StateStore.DOWNLOADED)
+
+        if self.skip_check:
+            self._store_run(accession)
+            logger.info("Current Run: %s has been successfully downloaded", accession)
+            return
+
+        for file in files:
+            file_path = accession_directory / file.file_name
+            if file_path in self._cache_hits:
+                self._cache_hits.discard(file_path)
+            elif file.md5 is not None and not check_md5_checksum(file_path, file.md5):
+                raise ValidationError(f"Downloaded run - {accession} - failed md5 check.")
+        self._add_to_cache(accession)
+        self._store_run(accession)
+        self._advance(accession, StateStore.VERIFIED)
+        logger.info("Current run - %s - has been downloaded and checked successfully", accession)
+
+    @staticmethod
+    def _remove_staging_directory(staging_directory: Path) -> None:
+        """Remove the staging directory unless there are partially transferred files left."""
+        for directory in staging_directory.glob("batch_*"):
+            for path in directory.glob("file_list.txt"):
+                path.unlink()
+            try:
+                directory.rmdir()
+            except OSError:
+                logger.debug("Keeping %s to resume transfers on the next run", directory)
+        try:
+            staging_directory.rmdir()
+        except OSError:
+            pass
+
+    def _download_file(
+        self, url: str, file_path: Path, md5: tp.Optional[str] = None, chunk_size: int = 10**6
+    ) -> int:
+        """
+        Download the file into the sink, e.g. to `file_path` or straight to S3. With its `md5`,
+        a corrupted file is checked before it is committed, so that it never appears in the sink.
+        Returns the size of the file.
+        """
+        # an earlier attempt (or transport) does not leave its md5 for the check of this one
+        self._written.pop(file_path, None)
+        relative_path = str(file_path.relative_to(self.output_directory))
         logger.debug(
-            "Downloading file via ftp with parameters. url: %s\nfile_path: %s", url, file_path
+            "Downloading file via ftp with parameters. url: %s\nfile_path: %s",
+            url,
+            self.sink.describe(relative_path),
         )
-        with requests.get(url, stream=True) as response:
+        with self.bandwidth_budget.session(BandwidthBudget.HTTP), requests.get(
+            url, stream=True
+        ) as response:
             response.raise_for_status()
-            with open(file_path, 'wb') as file:
+            with self.sink.open(relative_path, md5) as writer:
                 for chunk in response.iter_content(chunk_size):
-                    file.write(chunk)
+                    self.bandwidth_budget.throttle(len(chunk))
+                    writer.write(chunk)
+        if not self.skip_check:
+            self._written[file_path] = writer
+        return writer.size
+
+    def _from_cache(self, md5: tp.Optional[str], file_path: Path) -> bool:
+        """Take the file from the download cache instead of downloading it, if it is there."""
+        if self.download_cache is None or not md5:
+            return False
+        if not self.download_cache.materialize(md5, file_path):
+            return False
+        self._cache_hits.add(file_path)
+        logger.info("%s has been taken from the download cache", file_path.name)
+        return True
+
+    def _add_to_cache(self, accession: str) -> None:
+        """Add verified files of the run to the download cache, if they are on the local disk."""
+        if self.download_cache is None:
+            return
+        accession_directory = self.output_directory / accession
+        for name, md5 in self._md5s.get(accession, {}).items():
+            path = accession_directory / name
+            if path.is_file() and not path.is_symlink():
+                self.download_cache.add(md5, path)
+
+    def _resumed_state(self, accession: str) -> tp.Optional[str]:
+        state = super()._resumed_state(accession)
+        # derived files do not complete a run that is downloaded as it is now, neither do files
+        # split into other shards
+        if not self.derived and self._manifest_path(accession).exists():
+            return None
+        if self.sink.is_local and self._shard_layout_changed(accession):
+            return None
+        # a remote sink keeps only completed runs, the others are downloaded again
+        if not self.sink.is_local and not StateStore.reached(state, self.completed_state):
+            return None
+        return state
+
+    def _remove_stale_files(self, accession: str) -> None:
+        """
+        Remove files of the run left by an earlier download in another form, i.e. files derived
+        from those in ENA together with their manifest, or files split into other shards (or not
+        split) together with their index. The run is then downloaded from the start.
+        """
+        manifest_path = self._manifest_path(accession)
+        index_path = manifest_path.with_name(shard_index_name(accession))
+        derived = not self.derived and manifest_path.exists()
+        if not derived and not (self.sink.is_local and self._shard_layout_changed(accession)):
+            return
+        files = list(manifest_path.parent.glob('*.fastq.gz'))
+        if not files and not manifest_path.exists() and not index_path.exists():
+            return
+        logger.info("Removing files of %s left by an earlier download in another form", accession)
+        for path in [*files, manifest_path, index_path]:
+            path.unlink(missing_ok=True)
+        # the state left by the earlier download does not describe the files of the run anymore
+        self._resumed_states.pop(accession, None)
+
+    def _stream_accession(self, accession: str, stream_targets: StreamTargets) -> None:
+        """
+        Stream files of the run to the targets, checking their md5 on the fly.
+
+        A run that fails before anything has been written is reported as failed and the next runs
+        are streamed. If it fails in the middle, the readers have got a part of it, so the
+        targets are closed and StreamError is raised.
+        """
+        logger.debug("Preparing to stream an accession: %s", accession)
+        ena_client = ENAClient(attempts=self.attempts, attempts_interval=self.attempts_interval)
+        if self.skip_check:
+            urls = ena_client.get_urls(accession, ftp=True)
+            md5s: dict[str, tp.Optional[str]] = dict.fromkeys(urls)
+        else:
+            urls, expected = ena_client.get_urls_and_md5s(accession, ftp=True)
+            md5s = dict(zip(urls, expected))
+            self._md5s[accession] = {url.split('/')[-1]: md5 for url, md5 in zip(urls, expected)}
+        hashes = {url: hashlib.md5() for url in urls}
+
+        def read(urls: list[str]) -> tp.Iterator[bytes]:
+            for url in urls:
+                for chunk in self._stream_file(url):
+                    hashes[url].update(chunk)
+                    yield chunk
+
+        mates = [[url for url in urls if url.endswith(f'_{mate}.fastq.gz')] for mate in (1, 2)]
+        paired = all(mates)
+        if len(stream_targets) == 2 and not paired:
+            raise ValidationError(
+                f"{accession} is not paired, it cannot be streamed to two targets"
+            )
+        if paired and (len(stream_targets) == 2 or self.interleave):
+            unpaired = [url.split('/')[-1] for url in urls if url not in mates[0] + mates[1]]
+            if unpaired:
+                logger.warning("Unpaired reads of %s are not streamed: %s", accession, unpaired)
+            urls = mates[0] + mates[1]
+
+        written = [0] * len(stream_targets)
+
+        def write(index: int, chunks: tp.Iterable[bytes]) -> None:
+            for chunk in chunks:
+                stream_targets.write(index, chunk)
+                written[index] += len(chunk)
+
+        try:
+            if len(stream_targets) == 2:
+                self._stream_mates(accession, stream_targets, write, read(mates[0]), read(mates[1]))
+            elif self.interleave and paired:
+                write(0, interleave(gunzip(read(mates[0])), gunzip(read(mates[1]))))
+            elif self.interleave:
+                write(0, gunzip(read(urls)))
+            else:
+                write(0, read(urls))
+            stream_targets.flush()
+        except (requests.exceptions.RequestException, ValidationError) as err:
+            if not any(written):
+                raise
+            stream_targets.close()
+            raise StreamError(
+                f"Streaming of {accession} has failed after {sum(written)} bytes: {err}"
+            ) from err
+
+        self._advance(accession, StateStore.DOWNLOADED)
+        if self.skip_check:
+            logger.info("Current run - %s - has been streamed", accession)
+            return
+        failed = [url.split('/')[-1] for url in urls if hashes[url].hexdigest() != md5s.get(url)]
+        if failed:
+            raise ValidationError(f"Streamed run - {accession} - failed md5 check: {failed}")
+        self._advance(accession, StateStore.VERIFIED)
+        logger.info("Current run - %s - has been streamed and checked successfully", accession)
+
+    def _rewrite_accession(self, accession: str) -> None:
+        """
+        Download the reads of the run over HTTP, sample, transform and split them into shards on
+        the fly and save them re-compressed.
+
+        The transfer of a file stops as soon as it has got enough reads. Mates are read in
+        lockstep: the second mate gets as many reads as the first one, and a read is kept only
+        together with its mate, so the pairs stay in sync. ENA has no md5 of derived files, they
+        are checked to consist of complete FASTQ records instead, and are described in
+        <accession>.manifest.json next to them. Files that are only split into shards are read
+        whole, their md5 is checked on the fly. Shards are listed in <accession>.shards.json.
+        """
+        logger.debug("Preparing to download rewritten files of an accession: %s", accession)
+        ena_client = ENAClient(attempts=self.attempts, attempts_interval=self.attempts_interval)
+        verified = not self.derived and not self.skip_check
+        md5s: dict[str, str] = {}
+        if verified:
+            urls, expected = ena_client.get_urls_and_md5s(accession, ftp=True)
+            md5s = dict(zip(urls, expected))
+        else:
+            urls = ena_client.get_urls(accession, ftp=True)
+        mates = [[url for url in urls if url.endswith(f'_{mate}.fastq.gz')] for mate in (1, 2)]
+        groups = [[url] for url in urls]
+        if len(mates[0]) == len(mates[1]) == 1:
+            groups = [[url] for url in urls if url not in mates[0] + mates[1]]
+            groups.insert(0, mates[0] + mates[1])
+
+        sample = self.sample or SampleLimits()
+        files: dict[str, dict[str, tp.Any]] = {}
+        for group in groups:
+            files.update(self._rewrite_files(accession, group, sample, md5s))
+
+        if self.shard_layout is not None:
+            shards = {name: file.pop('shards') for name, file in files.items()}
+            with self.sink.open(f'{accession}/{shard_index_name(accession)}') as writer:
+                writer.write(shard_index(accession, self.shard_layout, shards))
+        if self.derived:
+            manifest = {
+                'accession': accession,
+                **sample.describe(),
+                'transforms': self.transforms.describe(),
+                # the files are not the ones in ENA, their md5 cannot be verified
+                'files': {name: {'derived': True, **file} for name, file in files.items()},
+            }
+            with self.sink.open(f'{accession}/{self._manifest_path(accession).name}') as writer:
+                writer.write(json.dumps(manifest, indent=2).encode())
+        self._advance(accession, StateStore.DOWNLOADED)
+        if verified:
+            self._advance(accession, StateStore.VERIFIED)
+        logger.info(
+            "Current run - %s - has been downloaded as %s files: %s",
+            accession,
+            "derived" if self.derived else "sharded",
+            ", ".join(f"{name} ({file['reads']} reads)" for name, file in files.items()),
+        )
+
+    def _rewrite_files(
+        self, accession: str, urls: list[str], limits: SampleLimits, md5s: dict[str, str]
+    ) -> dict[str, dict[str, tp.Any]]:
+        """
+        Save rewritten files of a single file or of two mates, return their manifest entries.
+        Files with an expected md5 in `md5s` are checked.
+        """
+        names = [url.split('/')[-1] for url in urls]
+        transferred = [0] * len(urls)
+        hashes = [hashlib.md5() for _ in urls]
+        # --max-bytes applies to the first file, the second mate is read as far as it goes
+        cut_off = limits.max_bytes is not None
+
+        def read(index: int) -> tp.Generator[bytes, None, None]:
+            # the transfer is closed as soon as the reads are complete
+            with contextlib.closing(self._stream_file(urls[index])) as chunks:
+                for chunk in chunks:
+                    transferred[index] += len(chunk)
+                    hashes[index].update(chunk)
+                    yield chunk
+                    if index == 0 and cut_off and transferred[0] >= tp.cast(int, limits.max_bytes):
+                        return
+
+        record_filter = RecordFilter(self.transforms, key=names[0])
+        threads = config.SHARD_COMPRESSION_THREADS
+        with contextlib.ExitStack() as stack:
+            chunks = [stack.enter_context(contextlib.closing(read(i))) for i in range(len(urls))]
+            # members of the files are compressed in parallel while the next reads arrive
+            executor = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(
+                    max_workers=threads, thread_name_prefix=f"compress-{accession}"
+                )
+            )
+            writers = [
+                stack.enter_context(
+                    FastqWriter(
+                        self.sink, f'{accession}/{name}', self.shard_layout, executor, 2 * threads
+                    )
+                )
+                for name in names
+            ]
+            records = [
+                fastq_head(
+                    gunzip(chunks[i], cut_off and i == 0), limits.max_reads, cut_off and i == 0
+                )
+                for i in range(len(urls))
+            ]
+            batches: tp.Iterable[tp.Sequence[list[bytes]]] = (
+                paired_records(records[0], records[1], until_first_ends=cut_off)
+                if len(urls) == 2
+                else ([data.split(b'\n')[:-1]] for data in records[0])
+            )
+            for batch in batches:
+                for writer, lines in zip(writers, record_filter(batch)):
+                    if lines:
+                        writer.write(lines)
+
+            # checked before the writers commit the files, corrupted ones are aborted
+            failed = [
+                name
+                for url, name, md5 in zip(urls, names, hashes)
+                if url in md5s and md5.hexdigest() != md5s[url]
+            ]
+            if failed:
+                raise ValidationError(f"Downloaded run - {accession} - failed md5 check: {failed}")
+
+        files = {}
+        for index, (name, writer) in enumerate(zip(names, writers)):
+            file: dict[str, tp.Any] = {
+                'reads': record_filter.records_out,
+                'source_reads': record_filter.records_in,
+                'transferred_bytes': transferred[index],
+            }
+            shards = writer.shards()
+            if self.shard_layout is None:
+                file.update(size=shards[0]['size'], md5=shards[0]['md5'])
+            else:
+                file['shards'] = shards
+            files[name] = file
+        return files
+
+    def _manifest_path(self, accession: str) -> Path:
+        return self.output_directory / accession / f'{accession}.manifest.json'
+
+    def _shard_layout_changed(self, accession: str) -> bool:
+        """Whether files of the run in the working directory are split in another way."""
+        index_path = self.output_directory / accession / shard_index_name(accession)
+        if not index_path.exists():
+            return self.shard_layout is not None
+        if self.shard_layout is None:
+            return True
+        return json.loads(index_path.read_text())['layout'] != self.shard_layout.describe()
+
+    @staticmethod
+    def _stream_mates(
+        accession: str,
+        stream_targets: StreamTargets,
+        write: tp.Callable[[int, tp.Iterable[bytes]], None],
+        *mates: tp.Iterable[bytes],
+    ) -> None:
+        """Write both mates at the same time, readers of the targets read them in lockstep."""
+
+        def write_mate(index: int) -> None:
+            try:
+                write(index, mates[index])
+            except BaseException:
+                # the reader gets the end of the stream and stops reading the other target too
+                stream_targets.close(index)
+                raise
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix=f"stream-{accession}"
+        ) as executor:
+            futures = [executor.submit(write_mate, index) for index in range(2)]
+            for future in futures:
+                future.result()
+
+    def _stream_file(self, url: str, chunk_size: int = 10**6) -> tp.Generator[bytes, None, None]:
+        """
+        Iterate over the contents of the file at `url`.
+
+        If the connection breaks, the download is resumed from where it has stopped with an HTTP
+        range request, up to `attempts` times, so the chunks are never repeated.
+        """
+        received = 0
+        for attempt in itertools.count(1):
+            headers = {'Range': f'bytes={received}-'} if received else {}
+            try:
+                with self.bandwidth_budget.session(BandwidthBudget.HTTP), requests.get(
+                    url, stream=True, headers=headers
+                ) as response:
+                    response.raise_for_status()
+                    if received and response.status_code != 206:
+                        raise ValidationError(f"{url} cannot be resumed from byte {received}")
+                    for chunk in response.iter_content(chunk_size):
+                        self.bandwidth_budget.throttle(len(chunk))
+                        received += len(chunk)
+                        yield chunk
+                return
+            except requests.exceptions.RequestException as err:
+                if attempt >= self.attempts or is_permanent_error(err):
+                    raise
+                logger.warning(
+                    "Connection to %s has broken after %d bytes, resuming. Error details: %s",
+                    url,
+                    received,
+                    str(err),
+                )
+                time.sleep(self.attempts_interval)
@@ -2,13 +2,13 @@ import logging
 import typing as tp
 
 import aiohttp
-import backoff
 import requests
 from requests import RequestException
 
 from fastqheat import typing_helpers as th
+from fastqheat.backend.retry import retry_on
 from fastqheat.config import config
-from fastqheat.exceptions import ENAClientError
+from fastqheat.exceptions import ENAClientError, ValidationError
 
 logger = logging.getLogger("fastqheat.ena.ena_api_client")
 
@@ -41,13 +41,9 @@ class ENAAsyncClient(BaseENAClient):
         self._all_ena_fields: list[str] = []
         self._session: tp.Optional[aiohttp.ClientSession] = session
 
-        self._get_json = backoff.on_exception(
-            backoff.constant,
-            exception=aiohttp.ClientResponseError,
-            jitter=None,  # The jitter is disabled in order to keep attempts interval fixed
-            max_tries=attempts,
-            interval=attempts_interval,
-        )(self._base_get_json)
+        self._get_json = retry_on(aiohttp.ClientResponseError, attempts, attempts_interval)(
+            self._base_get_json
+        )
 
     @property
     def session(self) -> aiohttp.ClientSession:
@@ -126,11 +122,11 @@ class ENAAsyncClient(BaseENAClient):
         except aiohttp.ClientResponseError as err:
             logger.exception(err)
             logger.error("%s. Accession: %s", error_message, term)
-            raise ENAClientError
+            raise ENAClientError(f"{error_message}. Accession: {term}") from err
 
         if not response_data:
             logger.error("ENA API returned no data for the accession: %s. Cannot proceed", term)
-            raise ENAClientError
+            raise ENAClientError(f"ENA API returned no data for the accession: {term}")
 
         return response_data
 
@@ -155,13 +151,9 @@ class ENAClient(BaseENAClient):
     ) -> None:
         super().__init__()
 
-        self._get_json = backoff.on_exception(
-            backoff.constant,
-            exception=RequestException,
-            jitter=None,  # The jitter is disabled in order to keep attempts interval fixed
-            max_tries=attempts,
-            interval=attempts_interval,
-        )(self._base_get_json)
+        self._get_json = retry_on(RequestException, attempts, attempts_interval)(
+            self._base_get_json
+        )
 
     def get_srr_ids_from_srp(self, term: str) -> list[str]:
         """Returns list of SRR(ERR) IDs based on the given SRP(ERP) ID."""
@@ -223,6 +215,47 @@ class ENAClient(BaseENAClient):
 
         return urls, md5s
 
+    def get_all_urls_and_md5s(self, term: str) -> tuple[list[str], list[str], list[str]]:
+        """
+        Returns links for both transports and hashes based on the given term
+
+        aspera_urls - list of IBM Aspera links to download given SRR IDs
+        ftp_urls - list of FTP links to the same files, in the same order
+        md5s - corresponding hashes to check downloaded files
+
+        Raises ValidationError if a field is empty or the fields list different numbers of files,
+        the files could not be matched with each other otherwise.
+        """
+        params = {
+            **self._query_params,
+            "fields": "fastq_aspera,fastq_ftp,fastq_md5",
+            "accession": term,
+        }
+        response_data = self._get_data(
+            term=term,
+            params=params,
+            error_message="An error occurred getting urls and md5s from ENA API",
+        )
+
+        fields = {
+            field: response_data[0][field].split(';')
+            for field in ('fastq_aspera', 'fastq_ftp', 'fastq_md5')
+        }
+        counts = {field: len(values) for field, values in fields.items() if all(values)}
+        if len(counts) != len(fields) or len(set(counts.values())) != 1:
+            raise ValidationError(
+                f"ENA lists different files of {term} for the transports: "
+                + ", ".join(f"{field}={response_data[0][field]!r}" for field in fields)
+            )
+
+        md5s = fields['fastq_md5']
+        aspera_urls = fields['fastq_aspera']
+        # FTP URLs from ENA do NOT currently include the scheme. Just prepend http://
+        # https://ena-docs.readthedocs.io/en/latest/retrieval/file-download.html
+        ftp_urls = [f"http://{uri}" for uri in fields['fastq_ftp']]
+
+        return aspera_urls, ftp_urls, md5s
+
     def get_urls(self, term: str, ftp: bool = False, aspera: bool = False) -> list[str]:
         """
         Returns links based on the given term
@@ -251,6 +284,18 @@ class ENAClient(BaseENAClient):
 
         return urls
 
+    def get_fastq_bytes(self, term: str) -> list[int]:
+        """Returns sizes of the FASTQ files of the given run in bytes."""
+
+        params = {**self._query_params, "fields": "fastq_bytes", "accession": term}
+        response_data = self._get_data(
+            term=term,
+            params=params,
+            error_message="An error occurred getting file sizes from ENA API",
+        )
+
+        return [int(size) for size in response_data[0]['fastq_bytes'].split(';') if size]
+
     def get_read_count(self, term: str) -> int:
         """Return total count of lines that should be in a file in order to check it is okay."""
 
@@ -265,17 +310,30 @@ class ENAClient(BaseENAClient):
 
         return total_spots
 
+    def get_read_and_base_count(self, term: str) -> tuple[int, tp.Optional[int]]:
+        """Return the number of spots of the run and the number of its bases, if known."""
+
+        params = {**self._query_params, "fields": "read_count,base_count", "accession": term}
+        response_data = self._get_data(
+            term=term,
+            params=params,
+            error_message="An error occurred getting read and base counts from ENA API",
+        )
+
+        base_count = response_data[0].get('base_count')
+        return int(response_data[0]['read_count']), int(base_count) if base_count else None
+
     def _get_data(self, term: str, params: dict[str, str], error_message: str) -> list[th.JsonDict]:
         try:
             response_data = self._get_json(params=params)
         except RequestException as err:
             logger.exception(err)
             logger.error("%s. Accession: %s", error_message, term)
-            raise ENAClientError
+            raise ENAClientError(f"{error_message}. Accession: {term}") from err
 
         if not response_data:
             logger.error("ENA API returned no data for the accession: %s. Cannot proceed", term)
-            raise ENAClientError
+            raise ENAClientError(f"ENA API returned no data for the accession: {term}")
 
         return response_data
 
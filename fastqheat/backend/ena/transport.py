@@ -0,0 +1,89 @@
+import logging
+import threading
+import typing as tp
+
+from fastqheat.config import config
+from fastqheat.utility import BaseEnum
+
+logger = logging.getLogger("fastqheat.ena.transport")
+
+
+class TransportType(BaseEnum):
+    binary = "binary"
+    ftp = "ftp"
+    auto = "auto"
+
+
+class TransportSelector:
+    """
+    Chooses a transport for every file based on the throughput measured so far.
+
+    Until every available transport has been measured, files are used as probes: each transport
+    that has no measurement yet downloads the next file. Afterwards the fastest transport is
+    chosen, and every `reprobe_interval`-th file is downloaded by the runner-up to keep its
+    measurement up to date, so the selector adapts when network conditions change.
+
+    Throughput is an exponentially weighted moving average of bytes per second. A transport that
+    failed to download a file gets a zero throughput, i.e. it is only used again when re-probed.
+    """
+
+    def __init__(
+        self,
+        transports: tp.Sequence[TransportType],
+        reprobe_interval: int = config.TRANSPORT_REPROBE_INTERVAL,
+        smoothing: float = config.TRANSPORT_THROUGHPUT_SMOOTHING,
+    ):
+        if not transports:
+            raise ValueError("At least one transport should be available")
+
+        self.transports = list(transports)
+        self.reprobe_interval = reprobe_interval
+        self.smoothing = smoothing
+
+        self._lock = threading.Lock()
+        self._throughput: dict[TransportType, float] = {}
+        self._files_chosen = 0
+
+    def choose(self) -> TransportType:
+        with self._lock:
+            self._files_chosen += 1
+
+            for transport in self.transports:
+                if transport not in self._throughput:
+                    logger.debug("Probing %s transport", transport)
+                    return transport
+
+            ranked = self._ranked()
+            if (
+                len(ranked) > 1
+                and self.reprobe_interval
+                and self._files_chosen % self.reprobe_interval == 0
+            ):
+                logger.debug("Re-probing %s transport", ranked[1])
+                return ranked[1]
+            return ranked[0]
+
+    def fallbacks(self, transport: TransportType) -> list[TransportType]:
+        """Return other transports to try if `transport` fails, the most promising first."""
+        with self._lock:
+            return [other for other in self._ranked() if other != transport]
+
+    def record_success(self, transport: TransportType, nbytes: int, seconds: float) -> None:
+        throughput = nbytes / max(seconds, 1e-6)
+        with self._lock:
+            previous = self._throughput.get(transport)
+            if previous:
+                throughput = self.smoothing * throughput + (1 - self.smoothing) * previous
+            self._throughput[transport] = throughput
+        logger.debug("%s transport throughput: %.0f bytes/s", transport, throughput)
+
+    def record_failure(self, transport: TransportType) -> None:
+        with self._lock:
+            self._throughput[transport] = 0.0
+        logger.debug("%s transport has failed", transport)
+
+    def _ranked(self) -> list[TransportType]:
+        """Transports sorted by throughput, unmeasured ones first. Requires the lock to be held."""
+        return sorted(
+            self.transports, key=lambda transport: -self._throughput.get(transport, float('inf'))
+        )
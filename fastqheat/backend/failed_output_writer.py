@@ -1,4 +1,5 @@
 import datetime as dt
+import threading
 from pathlib import Path
 
 
@@ -12,10 +13,13 @@ class FailedAccessionWriter:
         now = dt.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")  # e.g. '2022_07_28_17_58_17'
 
         self.path_to_file = self.path_to_dir / f"failed_list_{now}.txt"
+        # accessions may fail in several download threads at once
+        self._lock = threading.Lock()
 
     def add_accession(self, accession: str) -> None:
-        if not self.path_to_file.exists():
-            self.path_to_file.touch()
+        with self._lock:
+            if not self.path_to_file.exists():
+                self.path_to_file.touch()
 
-        with open(self.path_to_file, "a") as file:
-            file.write(f"{accession}\n")
+            with open(self.path_to_file, "a") as file:
+                file.write(f"{accession}\n")
@@ -0,0 +1,97 @@
+import collections
+import dataclasses
+import itertools
+import logging
+import typing as tp
+from pathlib import Path
+
+from fastqheat.config import config
+from fastqheat.exceptions import ValidationError
+
+logger = logging.getLogger("fastqheat.backend.fastq_scanner")
+
+
+@dataclasses.dataclass
+class FastqStats:
+    reads: int = 0
+    bases: int = 0
+    # number of reads of every length
+    lengths: tp.Counter[int] = dataclasses.field(default_factory=collections.Counter)
+
+    def describe(self) -> str:
+        if not self.reads:
+            return "no reads"
+        return (
+            f"{self.reads} reads, {self.bases} bases, "
+            f"lengths {min(self.lengths)}-{max(self.lengths)} (mean {self.bases / self.reads:.1f})"
+        )
+
+
+class FastqScanner:
+    """
+    Collects statistics of a FASTQ file and checks the structure of its records in one pass.
+
+    The file is read in big chunks and every chunk is handled with operations on whole lists of
+    lines (split, slicing, map over the C implementations of bytes methods), so no Python code
+    runs per line and the scan keeps up with the disk. A record is four lines: a header starting
+    with "@", the sequence, a separator starting with "+" and the qualities of the same length
+    as the sequence. Records cut short at the end of the file are reported as truncated.
+
+    Usage example:
+
+    stats = FastqScanner(path).scan()
+    """
+
+    def __init__(self, path: Path, chunk_size: int = config.FASTQ_SCAN_CHUNK_SIZE):
+        self.path = Path(path)
+        self.chunk_size = chunk_size
+        self.stats = FastqStats()
+
+    def scan(self) -> FastqStats:
+        # lines of the last record of a chunk that is not complete yet
+        rest = b''
+        with self.path.open('rb') as file:
+            for chunk in iter(lambda: file.read(self.chunk_size), b''):
+                lines = (rest + chunk).split(b'\n')
+                # the last line is unfinished, or empty when the chunk ends with a newline
+                complete = len(lines) - 1
+                records_end = complete - complete % 4
+                self._add_records(lines[:records_end])
+                rest = b'\n'.join(lines[records_end:])
+
+        if rest:
+            lines = rest.split(b'\n')
+            # the last record may lack the final newline
+            if len(lines) != 4:
+                raise ValidationError(
+                    f"{self.path.name}: record {self.stats.reads + 1} is truncated"
+                )
+            self._add_records(lines)
+        return self.stats
+
+    def _add_records(self, lines: list[bytes]) -> None:
+        headers, sequences, separators, qualities = (lines[i::4] for i in range(4))
+        lengths = list(map(len, sequences))
+        if not (
+            all(map(bytes.startswith, headers, itertools.repeat(b'@')))
+            and all(map(bytes.startswith, separators, itertools.repeat(b'+')))
+            and lengths == list(map(len, qualities))
+        ):
+            self._raise_malformed(lines)
+
+        self.stats.reads += len(lengths)
+        self.stats.bases += sum(lengths)
+        self.stats.lengths.update(lengths)
+
+    def _raise_malformed(self, lines: list[bytes]) -> None:
+        for number in range(len(lines) // 4):
+            header, sequence, separator, quality = lines[4 * number : 4 * number + 4]
+            if (
+                not header.startswith(b'@')
+                or not separator.startswith(b'+')
+                or len(sequence) != len(quality)
+            ):
+                raise ValidationError(
+                    f"{self.path.name}: record {self.stats.reads + number + 1} is malformed: "
+                    f"{header[:100]!r}"
+                )
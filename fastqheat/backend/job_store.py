@@ -0,0 +1,220 @@
+import contextlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import typing as tp
+from pathlib import Path
+
+from fastqheat import typing_helpers as th
+from fastqheat.backend import database
+from fastqheat.backend.scheduler import SchedulingPolicy, WorkItem, WorkQueue
+from fastqheat.config import config
+
+logger = logging.getLogger("fastqheat.backend.job_store")
+
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SQLiteJobStore(WorkQueue):
+    """
+    Queue of accessions shared by several FastqHeat processes, possibly on different hosts.
+
+    The queue is an SQLite database, usually on storage shared by all nodes. Every process adds
+    its accessions (accessions that are already in the store are left as they are, so all nodes
+    can be started with the same input) and then claims them one by one. A claim is a lease:
+    while a node works on an accession, a heartbeat thread keeps extending the lease of all its
+    claims. If the node dies, its leases expire and other nodes reclaim the accessions, so a node
+    keeps running until the accessions claimed by the others are done too.
+
+    Leases rely on wall clock time, clocks of the nodes should be reasonably synchronised
+    (much better than `lease_duration`).
+
+    Usage example:
+
+    job_store = SQLiteJobStore('/shared/study.sqlite')
+    job_store.add(items, policy)
+    with job_store.heartbeat():
+        while (item := job_store.next()) is not None:
+            success = process(item)
+            job_store.done(item, success)
+    """
+
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(
+        self,
+        path: th.PathType,
+        node_id: tp.Optional[str] = None,
+        lease_duration: float = config.JOB_LEASE_DURATION,
+        poll_interval: float = config.JOB_STORE_POLL_INTERVAL,
+    ):
+        self.path = Path(path)
+        self.node_id = node_id or default_node_id()
+        self.lease_duration = lease_duration
+        self.poll_interval = poll_interval
+        self._create_schema()
+
+    def add(self, items: tp.Iterable[WorkItem], policy: SchedulingPolicy) -> int:
+        """Add items that are not in the store yet, ordered by the policy. Returns their number."""
+        with database.transaction(self.path) as connection:
+            (last_position,) = connection.execute(
+                "SELECT COALESCE(MAX(position), -1) FROM jobs"
+            ).fetchone()
+            now = time.time()
+            cursor = connection.executemany(
+                "INSERT OR IGNORE INTO jobs (accession, position, size, state, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (item.accession, last_position + 1 + position, item.size, self.PENDING, now)
+                    for position, item in enumerate(sorted(items, key=policy.key))
+                ],
+            )
+            return cursor.rowcount
+
+    def missing(self, accessions: tp.Iterable[str]) -> list[str]:
+        """Return accessions that are not in the store."""
+        accessions = list(dict.fromkeys(accessions))
+        with contextlib.closing(database.connect(self.path)) as connection:
+            known = {
+                accession
+                for (accession,) in connection.execute("SELECT accession FROM jobs").fetchall()
+            }
+        return [accession for accession in accessions if accession not in known]
+
+    def next(self) -> tp.Optional[WorkItem]:
+        """
+        Claim the next pending accession, or an accession whose lease has expired.
+
+        Deferred accessions are claimed first once they are due. If only deferred accessions that
+        are not due yet, or accessions claimed by other nodes are left, waits for the first of
+        them to become due or for a lease to expire, checking every `poll_interval` whether the
+        other nodes are done. Returns None when there are no pending or claimed accessions left.
+        """
+        while True:
+            now = time.time()
+            with database.transaction(self.path) as connection:
+                row = connection.execute(
+                    "SELECT accession, position, size, state, owner, attempts FROM jobs "
+                    "WHERE (state = ? AND (retry_after IS NULL OR retry_after <= ?)) "
+                    "OR (state = ? AND lease_expires < ?) "
+                    "ORDER BY retry_after IS NULL, position LIMIT 1",
+                    (self.PENDING, now, self.CLAIMED, now),
+                ).fetchone()
+                if row is None:
+                    (retry_after,) = connection.execute(
+                        "SELECT MIN(retry_after) FROM jobs WHERE state = ?", (self.PENDING,)
+                    ).fetchone()
+                    # claims of other nodes are taken over if the nodes die
+                    (lease_expires,) = connection.execute(
+                        "SELECT MIN(lease_expires) FROM jobs WHERE state = ? AND owner != ?",
+                        (self.CLAIMED, self.node_id),
+                    ).fetchone()
+                else:
+                    accession, position, size, state, owner, attempts = row
+                    connection.execute(
+                        "UPDATE jobs SET state = ?, owner = ?, lease_expires = ?, "
+                        "attempts = attempts + 1, updated = ? WHERE accession = ?",
+                        (self.CLAIMED, self.node_id, now + self.lease_duration, now, accession),
+                    )
+
+            if row is not None:
+                break
+            wake_up = [moment for moment in (retry_after, lease_expires) if moment is not None]
+            if not wake_up:
+                return None
+            if lease_expires is not None:
+                wake_up.append(now + self.poll_interval)
+            time.sleep(max(min(wake_up) - now, 0))
+
+        if state == self.CLAIMED:
+            logger.warning("Reclaiming %s: the lease of %s has expired", accession, owner)
+        logger.debug("%s has been claimed by %s", accession, self.node_id)
+        return WorkItem(accession=accession, index=position, size=size, retries=attempts)
+
+    def done(self, item: WorkItem, success: bool = True) -> None:
+        with database.transaction(self.path) as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET state = ?, lease_expires = NULL, updated = ? "
+                "WHERE accession = ? AND owner = ?",
+                (self.DONE if success else self.FAILED, time.time(), item.accession, self.node_id),
+            )
+        self._check_owned(item, cursor.rowcount)
+
+    def defer(self, item: WorkItem, delay: float) -> None:
+        now = time.time()
+        with database.transaction(self.path) as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET state = ?, retry_after = ?, lease_expires = NULL, updated = ? "
+                "WHERE accession = ? AND owner = ?",
+                (self.PENDING, now + delay, now, item.accession, self.node_id),
+            )
+        self._check_owned(item, cursor.rowcount)
+
+    def renew_leases(self) -> None:
+        """Extend leases of all accessions claimed by this node."""
+        now = time.time()
+        with database.transaction(self.path) as connection:
+            connection.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE state = ? AND owner = ?",
+                (now + self.lease_duration, self.CLAIMED, self.node_id),
+            )
+
+    @contextlib.contextmanager
+    def heartbeat(self) -> tp.Iterator[None]:
+        """Keep renewing leases in a background thread for the duration of the context."""
+        stop = threading.Event()
+
+        def beat() -> None:
+            while not stop.wait(self.lease_duration / 3):
+                try:
+                    self.renew_leases()
+                except sqlite3.Error as err:
+                    logger.warning("Cannot renew leases in %s: %s", self.path, err)
+
+        thread = threading.Thread(target=beat, name="job-store-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def summary(self) -> dict[str, int]:
+        """Number of accessions in every state, across all nodes."""
+        with contextlib.closing(database.connect(self.path)) as connection:
+            rows = connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {self.PENDING: 0, self.CLAIMED: 0, self.DONE: 0, self.FAILED: 0, **dict(rows)}
+
+    def _check_owned(self, item: WorkItem, rowcount: int) -> None:
+        if not rowcount:
+            logger.warning(
+                "%s has been reclaimed by another node while %s was processing it",
+                item.accession,
+                self.node_id,
+            )
+
+    def _create_schema(self) -> None:
+        with database.transaction(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "accession TEXT PRIMARY KEY, "
+                "position INTEGER NOT NULL, "
+                "size INTEGER, "
+                "state TEXT NOT NULL, "
+                "owner TEXT, "
+                "lease_expires REAL, "
+                "retry_after REAL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "updated REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_state_position ON jobs (state, position)"
+            )
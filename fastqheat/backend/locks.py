@@ -0,0 +1,178 @@
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import typing as tp
+from pathlib import Path
+
+from fastqheat.config import config
+from fastqheat.exceptions import RunLockedError
+
+logger = logging.getLogger("fastqheat.backend.locks")
+
+
+class RunLocks:
+    """
+    Advisory locks on the runs of a working directory, so that processes sharing it do not
+    download the same run at the same time.
+
+    A lock is the file <working directory>/.fastqheat_locks/<accession>.lock, created exclusively
+    (which also works on NFS) with the host and pid of its owner. While the owner works on the run,
+    a heartbeat thread keeps touching the files of all its locks. A lock is stale if its owner is
+    a dead process on the same host, or if it has not been touched for `stale_timeout` seconds
+    (e.g. its host is down). Stale locks are broken by the next process that wants them.
+
+    Usage example:
+
+    run_locks = RunLocks(working_directory)
+    with run_locks.heartbeat():
+        run_locks.acquire(accession)
+        try:
+            download(accession)
+        finally:
+            run_locks.release(accession)
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        stale_timeout: float = config.RUN_LOCK_STALE_TIMEOUT,
+        poll_interval: float = config.RUN_LOCK_POLL_INTERVAL,
+    ):
+        self.directory = Path(directory) / config.RUN_LOCK_DIRECTORY
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.stale_timeout = stale_timeout
+        self.poll_interval = poll_interval
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        # accessions locked by this process, runs may be downloaded in several threads
+        self._held: set[str] = set()
+        self._held_lock = threading.Lock()
+
+    def path(self, accession: str) -> Path:
+        return self.directory / f'{accession}.lock'
+
+    def acquire(self, accession: str, wait: bool = True) -> None:
+        """Lock the run, waiting for its owner unless `wait` is False (RunLockedError then)."""
+        owner = self.try_acquire(accession)
+        if owner is None:
+            return
+        if not wait:
+            raise RunLockedError(f"{accession} is being downloaded by {owner}")
+
+        logger.info("%s is being downloaded by %s, waiting for it", accession, owner)
+        while self.try_acquire(accession) is not None:
+            time.sleep(self.poll_interval)
+
+    def try_acquire(self, accession: str) -> tp.Optional[str]:
+        """Lock the run if it is not locked, otherwise return the owner of the lock."""
+        path = self.path(accession)
+        while True:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                pass
+            else:
+                with os.fdopen(fd, 'w') as file:
+                    json.dump({'host': self.host, 'pid': self.pid, 'started': time.time()}, file)
+                with self._held_lock:
+                    self._held.add(accession)
+                return None
+
+            try:
+                stat = path.stat()
+                owner = self._read_owner(path)
+            except FileNotFoundError:
+                # released in the meantime
+                continue
+            if not self._is_stale(accession, owner, stat):
+                return f"{owner.get('host')}:{owner.get('pid')}"
+            self._break(path, owner, stat)
+
+    def release(self, accession: str) -> None:
+        with self._held_lock:
+            self._held.discard(accession)
+        path = self.path(accession)
+        with contextlib.suppress(FileNotFoundError):
+            owner = self._read_owner(path)
+            # the lock may have been broken as stale and taken by another process
+            if owner.get('host') == self.host and owner.get('pid') == self.pid:
+                path.unlink()
+
+    def touch(self) -> None:
+        """Show that the locks held by this process are still in use."""
+        with self._held_lock:
+            held = list(self._held)
+        for accession in held:
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(self.path(accession))
+
+    @contextlib.contextmanager
+    def heartbeat(self) -> tp.Iterator[None]:
+        """Keep touching the locks in a background thread for the duration of the context."""
+        stop = threading.Event()
+
+        def beat() -> None:
+            while not stop.wait(self.stale_timeout / 3):
+                try:
+                    self.touch()
+                except OSError as err:
+                    logger.warning("Cannot touch run locks in %s: %s", self.directory, err)
+
+        thread = threading.Thread(target=beat, name="run-lock-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _is_stale(self, accession: str, owner: dict[str, tp.Any], stat: os.stat_result) -> bool:
+        if time.time() - stat.st_mtime > self.stale_timeout:
+            return True
+        if owner.get('host') != self.host or not isinstance(owner.get('pid'), int):
+            # the process on another host cannot be checked, or the lock is being written
+            return False
+        if owner['pid'] == self.pid:
+            # left by a previous process with the same pid, unless another thread holds it
+            with self._held_lock:
+                return accession not in self._held
+        try:
+            os.kill(owner['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # a process of another user
+            pass
+        return False
+
+    def _break(self, path: Path, owner: dict[str, tp.Any], stat: os.stat_result) -> None:
+        stale_path = path.with_name(f'{path.name}.{self.pid}.{threading.get_ident()}.stale')
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return
+        if stale_path.stat().st_ino != stat.st_ino:
+            # another process has broken the lock and taken it in the meantime, give it back
+            with contextlib.suppress(FileExistsError):
+                os.link(stale_path, path)
+        else:
+            logger.warning(
+                "Breaking the stale lock of %s held by %s:%s",
+                path.stem,
+                owner.get('host'),
+                owner.get('pid'),
+            )
+        stale_path.unlink()
+
+    @staticmethod
+    def _read_owner(path: Path) -> dict[str, tp.Any]:
+        try:
+            owner = json.loads(path.read_text())
+        except ValueError:
+            # the owner has created the file and not written it yet
+            return {}
+        return owner if isinstance(owner, dict) else {}
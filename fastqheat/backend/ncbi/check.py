@@ -5,6 +5,7 @@ from pathlib import Path
 
 from fastqheat import typing_helpers as th
 from fastqheat.backend.common import BaseAccessionChecker
+from fastqheat.backend.fastq_scanner import FastqScanner, FastqStats
 from fastqheat.exceptions import AccessionCheckerException, ENAClientError, ValidationError
 
 logger = logging.getLogger("fastqheap.ncbi.check")
@@ -18,6 +19,7 @@ def check(
     attempts_interval: int,
     core_count: int,
     zipped: bool = True,
+    scratch_directory: tp.Optional[th.PathType] = None,
 ) -> None:
     """Check accessions in bulk."""
 
@@ -27,6 +29,7 @@ def check(
         attempts_interval=attempts_interval,
         core_count=core_count,
         zipped=zipped,
+        scratch_directory=Path(scratch_directory) if scratch_directory else None,
     )
 
     successfully_checked = access_checker.check_accessions(accessions)
@@ -35,72 +38,95 @@ def check(
 
 class AccessionChecker(BaseAccessionChecker):
     def __init__(
-        self, directory: Path, attempts: int, attempts_interval: int, core_count: int, zipped: bool
+        self,
+        directory: Path,
+        attempts: int,
+        attempts_interval: int,
+        core_count: int,
+        zipped: bool,
+        scratch_directory: tp.Optional[Path] = None,
     ) -> None:
         super().__init__(directory, attempts, attempts_interval)
         self.core_count = core_count
         self.zipped = zipped
+        # where zipped files are unzipped for the check, next to them by default
+        self.scratch_directory = scratch_directory
 
     def check_accession(self, accession: str) -> bool:
-        """Check loaded run by lines in file cnt"""
+        """Check loaded run, raises ValidationError if it is not valid"""
+        self.check_run(accession)
+        return True
+
+    def check_run(self, accession: str) -> int:
+        """
+        Check the structure of the loaded run and compare its spots and bases with ENA.
+
+        Returns the number of spots.
+
+        Paired mates (SRR..._1.fastq, SRR..._2.fastq) must have the same number of reads, a spot
+        is a read of every mate or an unpaired read (SRR....fastq).
+        """
         logger.debug("Checking accession %s", accession)
 
-        cnt_loaded = self._get_cnt_of_coding_loaded_lines(accession=accession)
+        stats = self._scan_files(accession=accession)
         try:
-            needed_lines_cnt = self.ena_client.get_read_count(accession)
+            read_count, base_count = self.ena_client.get_read_and_base_count(accession)
         except ENAClientError:
             logger.error("Cannot check %s because of the ENA API error", accession)
             raise AccessionCheckerException
 
-        if cnt_loaded != needed_lines_cnt:
+        spots = self._count_spots(accession, stats)
+        if spots != read_count:
+            raise ValidationError(
+                f"Loaded {spots} spots, but described {read_count} spots. "
+                f"File has been downloaded INCORRECTLY"
+            )
+
+        bases = sum(file_stats.bases for file_stats in stats.values())
+        if base_count is not None and bases != base_count:
             raise ValidationError(
-                f"Loaded {cnt_loaded} lines, but described {needed_lines_cnt} lines."
+                f"Loaded {bases} bases, but described {base_count} bases. "
                 f"File has been downloaded INCORRECTLY"
             )
 
         logger.info(
             'Current Run: %s with %d total spots has been successfully downloaded',
             accession,
-            needed_lines_cnt,
+            read_count,
         )
-        return True
+        return spots
 
     @staticmethod
-    def _count_lines(path: Path, chunk_size: int = 8 * 10**6) -> int:
-        # NOTE: actually counts newline characters, like wc -l would
-        count = 0
-        with path.open('rb') as file:
-            for chunk in iter(lambda: file.read(chunk_size), b''):
-                count += chunk.count(b'\n')
+    def _count_spots(accession: str, stats: dict[Path, FastqStats]) -> int:
+        unpaired = [file_stats for path, file_stats in stats.items() if path.stem == accession]
+        mates = {path: file_stats for path, file_stats in stats.items() if path.stem != accession}
 
-        return count
+        if len({file_stats.reads for file_stats in mates.values()}) > 1:
+            raise ValidationError(
+                f"Mates of {accession} have different numbers of reads: "
+                + ", ".join(
+                    f"{path.name}: {file_stats.reads}" for path, file_stats in mates.items()
+                )
+            )
 
-    def _get_cnt_of_coding_loaded_lines(
-        self,
-        accession: str,
-    ) -> int:
-        """Count lines in real loaded file(s) and return it."""
+        mate_reads = next(iter(mates.values())).reads if mates else 0
+        return mate_reads + sum(file_stats.reads for file_stats in unpaired)
+
+    def _scan_files(self, accession: str) -> dict[Path, FastqStats]:
+        """Scan loaded file(s) of the run."""
 
         with FileManager(
-            accession=accession, path=self.directory, core_count=self.core_count, zipped=self.zipped
+            accession=accession,
+            path=self.directory,
+            core_count=self.core_count,
+            zipped=self.zipped,
+            scratch_directory=self.scratch_directory,
         ) as fastq_files:
+            stats = {path: FastqScanner(path).scan() for path in sorted(fastq_files)}
 
-            if len(fastq_files) == 1:
-                logger.debug(
-                    'we loaded single-stranded read and have not to divide by 2 cnt of lines'
-                )
-                rate = 1
-            else:
-                rate = 2
-
-            total_lines = sum(map(self._count_lines, fastq_files))
-            logger.debug('All lines in all files of this run: %d', total_lines)
-
-        # 4 - fixed because of a fastq file content
-        cnt = (total_lines / rate) / 4
-        logger.debug('%d coding lines have been downloaded', cnt)
-
-        return int(cnt)
+        for path, file_stats in stats.items():
+            logger.debug('%s: %s', path.name, file_stats.describe())
+        return stats
 
 
 class FileManager:
@@ -127,13 +153,22 @@ class FileManager:
     core_count - how much cpu cores should pigz and unpigz use
     zipped - bool flag; basically says if we should expect the files in path to be zipped
     or unzipped
+    scratch_directory - where to unzip the files, next to them if not given
     """
 
-    def __init__(self, accession: str, path: Path, core_count: int, zipped: bool):
+    def __init__(
+        self,
+        accession: str,
+        path: Path,
+        core_count: int,
+        zipped: bool,
+        scratch_directory: tp.Optional[Path] = None,
+    ):
         self.accession = accession
         self.path = path
         self.core_count = core_count
         self.zipped = zipped
+        self.scratch_directory = scratch_directory
 
     def __enter__(self) -> list[Path]:
         if not self.path.match(self.accession):
@@ -147,7 +182,7 @@ class FileManager:
             raise FileNotFoundError(f"No files found for {self.accession}")
 
         self._unzip(file_paths=fastq_files_zipped)
-        fastq_files_unzipped = list(self.path.glob(f'{self.accession}*.fastq'))
+        fastq_files_unzipped = list(self.unzipped_directory.glob(f'{self.accession}*.fastq'))
 
         if not fastq_files_unzipped:
             raise FileNotFoundError(f"No files found for {self.accession}")
@@ -156,16 +191,35 @@ class FileManager:
 
     def __exit__(self, *args: tp.Any, **kwargs: tp.Any) -> None:
         if self.zipped:
-            fastq_files = list(self.path.glob(f'{self.accession}*.fastq'))
+            fastq_files = list(self.unzipped_directory.glob(f'{self.accession}*.fastq'))
             logger.debug('Removing unzipped temporary files...')
             for file in fastq_files:
                 file.unlink()
+            if self.scratch_directory is not None:
+                self.unzipped_directory.rmdir()
+
+    @property
+    def unzipped_directory(self) -> Path:
+        if self.scratch_directory is None:
+            return self.path
+        return self.scratch_directory / self.accession
 
     def _unzip(self, file_paths: list[Path]) -> None:
         """Unzip files."""
         if not file_paths:
             raise ValueError("No files have been given to unpigz")
         logger.debug("Unzipping %s...", "; ".join([str(file) for file in file_paths]))
-        subprocess.run(
-            ['unpigz', '--keep', '--processes', str(self.core_count), *file_paths], check=True
-        )
+        if self.scratch_directory is None:
+            subprocess.run(
+                ['unpigz', '--keep', '--processes', str(self.core_count), *file_paths], check=True
+            )
+            return
+
+        self.unzipped_directory.mkdir(parents=True, exist_ok=True)
+        for file_path in file_paths:
+            with open(self.unzipped_directory / file_path.stem, 'wb') as unzipped_file:
+                subprocess.run(
+                    ['unpigz', '--stdout', '--processes', str(self.core_count), file_path],
+                    stdout=unzipped_file,
+                    check=True,
+                )
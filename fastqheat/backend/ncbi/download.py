@@ -1,23 +1,39 @@
+import concurrent.futures
 import logging
+import shutil
 import subprocess
 import typing as tp
 from pathlib import Path
 
-import backoff
-
+from fastqheat.backend import bgzf
 from fastqheat.backend.common import BaseDownloadClient
+from fastqheat.backend.cpu_budget import CpuBudget
 from fastqheat.backend.failed_output_writer import FailedAccessionWriter
+from fastqheat.backend.job_store import SQLiteJobStore
 from fastqheat.backend.ncbi.check import AccessionChecker
+from fastqheat.backend.ncbi.prefetch import SraCache
+from fastqheat.backend.retry import RetryPolicy, retry_on
+from fastqheat.backend.sharding import ShardLayout, shard_fastq_file, shard_index, shard_index_name
+from fastqheat.backend.sinks import LocalSink, OutputSink
+from fastqheat.backend.state import StateStore
+from fastqheat.backend.verification import VerificationStage
 from fastqheat.config import config
-from fastqheat.exceptions import ValidationError
+from fastqheat.utility import BaseEnum, move_file
 
 logger = logging.getLogger("fastqheat.ncbi.download")
 
 
+class Compression(BaseEnum):
+    # a single gzip stream per file, made by pigz
+    gzip = "gzip"
+    # block gzip with indexes, see backend.bgzf
+    bgzf = "bgzf"
+
+
 def download(
     *,
     output_directory: Path,
-    accessions: list[str],
+    accessions: tp.Iterable[str],
     attempts: int = config.DEFAULT_MAX_ATTEMPTS,
     attempts_interval: int,
     core_count: int,
@@ -31,10 +47,21 @@ def download(
         attempts_interval,
         skip_check,
         core_count=core_count,  # todo: get default from config
+        jobs=kwargs.get("jobs", 1),
+        scheduling_policy=kwargs.get("scheduling_policy", "input"),
+        min_free_space=kwargs.get("min_free_space"),
+        job_store=kwargs.get("job_store"),
+        resume=kwargs.get("resume", False),
+        wait_for_locked_runs=kwargs.get("wait_for_locked_runs", True),
+        prefetch=kwargs.get("prefetch", False),
+        scratch_directory=kwargs.get("scratch_directory"),
+        compression=kwargs.get("compression", "gzip"),
+        sink=kwargs.get("sink"),
+        shard_layout=kwargs.get("shard_layout"),
     )
 
     successfully_downloaded = download_client.download_accession_list(accessions)
-    num_accessions = len(accessions)
+    num_accessions = download_client.num_accessions
 
     if skip_check:
         logger.info(
@@ -49,6 +76,8 @@ def download(
 
 
 class NCBIDownloadClient(BaseDownloadClient):
+    disk_space_multiplier = config.NCBI_DISK_SPACE_MULTIPLIER
+
     def __init__(
         self,
         output_directory: Path,
@@ -56,69 +85,245 @@ class NCBIDownloadClient(BaseDownloadClient):
         attempts_interval: int,
         skip_check: bool,
         core_count: int,
+        jobs: int = 1,
+        scheduling_policy: str = 'input',
+        min_free_space: tp.Optional[int] = None,
+        job_store: tp.Optional[SQLiteJobStore] = None,
+        resume: bool = False,
+        retry_policy: tp.Optional[RetryPolicy] = None,
+        prefetch: bool = False,
+        scratch_directory: tp.Optional[Path] = None,
+        compression: str = 'gzip',
+        sink: tp.Optional[OutputSink] = None,
+        wait_for_locked_runs: bool = True,
+        shard_layout: tp.Optional[ShardLayout] = None,
     ):
         self.output_directory = Path(output_directory)
         self.failed_output_writer = FailedAccessionWriter(self.output_directory)
         self.attempts = attempts
 
-        super().__init__(output_directory, attempts, attempts_interval, skip_check)
+        super().__init__(
+            output_directory,
+            attempts,
+            attempts_interval,
+            skip_check,
+            jobs=jobs,
+            scheduling_policy=scheduling_policy,
+            min_free_space=min_free_space,
+            job_store=job_store,
+            resume=resume,
+            retry_policy=retry_policy,
+            sink=sink,
+            wait_for_locked_runs=wait_for_locked_runs,
+        )
 
         self.core_count = core_count
-        self._download_function = backoff.on_exception(
-            backoff.constant,
-            subprocess.CalledProcessError,
-            jitter=None,  # The jitter is disabled in order to keep attempts interval fixed
-            max_tries=attempts,
-            interval=attempts_interval,
+        # fasterq-dump, pigz and checks of all runs processed at the same time share the CPUs
+        self.cpu_budget = CpuBudget(core_count)
+        # threads wanted by a single tool, so that every job gets its share of the budget
+        self.threads_per_job = max(1, core_count // jobs)
+        # runs of every job are checked and compressed while the job downloads the next run
+        self.verification = VerificationStage(workers=max(config.VERIFICATION_WORKERS, jobs))
+        self._download_function = retry_on(
+            subprocess.CalledProcessError, attempts, attempts_interval
         )(self._download_via_fastrq_dump)
+        # FASTQ files are converted, checked and compressed there, then moved to the output
+        # directory. A scratch directory on a fast local disk keeps this I/O off the output one.
+        self.scratch_directory = Path(scratch_directory) if scratch_directory else None
+        self.conversion_directory = self.scratch_directory or self.output_directory
+        self.conversion_directory.mkdir(parents=True, exist_ok=True)
+        # with prefetch, runs are fetched into the cache and converted while the next ones are
+        # fetched, otherwise fasterq-dump fetches and converts them in one step
+        self.sra_cache: tp.Optional[SraCache] = None
+        if prefetch:
+            self.sra_cache = SraCache(self.conversion_directory / config.SRA_CACHE_DIRECTORY_NAME)
+            self._prefetch_function = retry_on(
+                subprocess.CalledProcessError, attempts, attempts_interval
+            )(self.sra_cache.fetch)
+
+        self.compression = Compression(compression)
+        # FASTQ files are split into shards compressed in parallel instead of being compressed whole
+        self.shard_layout = shard_layout
+        if shard_layout is not None and self.compression == Compression.bgzf:
+            raise ValueError("Sharded runs are compressed with gzip")
 
         self.accession_checker = AccessionChecker(
-            directory=Path(output_directory),
+            directory=self.conversion_directory,
             attempts=attempts,
             attempts_interval=attempts_interval,
             core_count=core_count,
             zipped=False,
         )
 
-    def download_one_accession(self, accession: str) -> None:
+    @property
+    def completed_state(self) -> str:
+        return StateStore.COMPRESSED
+
+    def download_one_accession(self, accession: str) -> concurrent.futures.Future:
         """
         Download the run from NCBI's Sequence Read Archive (SRA)
         Uses fasterq_dump and check completeness of downloaded fastq file
+
+        The check and compression run in the verification stage, while the next run is
+        downloaded. Returns their future.
         """
 
         accession_directory = Path(self.output_directory, accession)
         accession_directory.mkdir(parents=True, exist_ok=True)
+        work_directory = Path(self.conversion_directory, accession)
+        work_directory.mkdir(parents=True, exist_ok=True)
 
-        logger.info('Trying to download %s file', accession)
+        resumed_state = self._resumed_state(accession)
+        if StateStore.reached(resumed_state, StateStore.DOWNLOADED) and not any(
+            work_directory.glob(f'{accession}*.fastq')
+        ):
+            # e.g. the scratch directory has been cleaned since the previous run
+            logger.warning("FASTQ files of %s are gone, downloading it again", accession)
+            resumed_state = None
+            self.state_store.advance(accession, StateStore.DOWNLOADING)
 
-        self._download_function(accession=accession, accession_directory=accession_directory)
+        if self.sra_cache is not None and not StateStore.reached(
+            resumed_state, StateStore.DOWNLOADED
+        ):
+            return self._prefetch_and_submit(
+                accession, work_directory, accession_directory, self.sra_cache
+            )
 
-        if self.skip_check:
-            self._zip(accession_directory, accession)
-            return
+        if not StateStore.reached(resumed_state, StateStore.DOWNLOADED):
+            logger.info('Trying to download %s file', accession)
+            self._download_function(accession=accession, accession_directory=work_directory)
+            self._advance(accession, StateStore.DOWNLOADED)
 
-        if not self.accession_checker.check_accession(accession=accession):
-            raise ValidationError("Downloaded run - %s - is not valid.", accession)
+        return self.verification.submit(
+            self._check_and_zip, accession, work_directory, accession_directory, resumed_state
+        )
 
-        self._zip(accession_directory, accession)
+    def _prefetch_and_submit(
+        self, accession: str, work_directory: Path, accession_directory: Path, sra_cache: SraCache
+    ) -> concurrent.futures.Future:
+        """Fetch the run into the cache, its conversion runs while the next run is fetched."""
+        sra_cache.reserve()
+        try:
+            sra_path = self._prefetch_function(accession)
+            return self.verification.submit(
+                self._convert_check_and_zip,
+                accession,
+                work_directory,
+                accession_directory,
+                sra_path,
+                sra_cache,
+            )
+        except BaseException:
+            sra_cache.evict(accession)
+            raise
+
+    def _convert_check_and_zip(
+        self,
+        accession: str,
+        work_directory: Path,
+        accession_directory: Path,
+        sra_path: Path,
+        sra_cache: SraCache,
+    ) -> None:
+        # a run that fails is evicted too, it is fetched again when the accession is retried
+        try:
+            self._download_function(
+                accession=accession, accession_directory=work_directory, source=sra_path
+            )
+            self._advance(accession, StateStore.DOWNLOADED)
+            self._check_and_zip(
+                accession, work_directory, accession_directory, StateStore.DOWNLOADED
+            )
+        finally:
+            sra_cache.evict(accession)
+
+    def _check_and_zip(
+        self,
+        accession: str,
+        work_directory: Path,
+        accession_directory: Path,
+        resumed_state: tp.Optional[str],
+    ) -> None:
+        if not self.skip_check and not StateStore.reached(resumed_state, StateStore.VERIFIED):
+            # lines are counted in this thread
+            with self.cpu_budget.reserve(1):
+                self._read_counts[accession] = self.accession_checker.check_run(accession)
+            self._advance(accession, StateStore.VERIFIED)
+
+        self._zip(work_directory, accession)
+        if work_directory != accession_directory:
+            self._move_to_output(accession, work_directory, accession_directory)
+        self._store_run(accession)
+        self._advance(accession, StateStore.COMPRESSED)
 
     def _zip(self, accession_directory: Path, accession: str) -> None:
         fastq_files = list(accession_directory.glob(f'{accession}*.fastq'))
-        logger.info("Compressing FASTQ files for %s in %s", accession, accession_directory)
-        subprocess.run(['pigz', '--processes', str(self.core_count), *fastq_files], check=True)
+        with self.cpu_budget.reserve(self.threads_per_job) as threads:
+            logger.info("Compressing FASTQ files for %s in %s", accession, accession_directory)
+            if self.shard_layout is not None:
+                self._shard(fastq_files, accession, accession_directory, self.shard_layout, threads)
+            elif self.compression == Compression.bgzf:
+                for path in fastq_files:
+                    bgzf.compress_file(path, path.with_name(f'{path.name}.gz'), threads=threads)
+                    path.unlink()
+            else:
+                subprocess.run(['pigz', '--processes', str(threads), *fastq_files], check=True)
         logger.info("FASTQ files for %s have been zipped", accession)
 
-    def _download_via_fastrq_dump(self, accession: str, accession_directory: Path) -> None:
-        logger.debug("Downloading accession %s using fasterq-dump...", accession)
-        subprocess.run(
-            [
-                'fasterq-dump',
-                accession,
-                '-O',
-                accession_directory,
-                '-p',
-                '--threads',
-                str(self.core_count),
-            ],
-            check=True,
-        )
+    @staticmethod
+    def _shard(
+        fastq_files: list[Path],
+        accession: str,
+        accession_directory: Path,
+        layout: ShardLayout,
+        threads: int,
+    ) -> None:
+        """Split FASTQ files into shards next to them and list the shards in the shard index."""
+        sink = LocalSink(accession_directory)
+        files = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix=f"compress-{accession}"
+        ) as executor:
+            for path in sorted(fastq_files):
+                name = f'{path.name}.gz'
+                files[name] = shard_fastq_file(path, sink, name, layout, executor, 2 * threads)
+                path.unlink()
+        index_path = accession_directory / shard_index_name(accession)
+        index_path.write_bytes(shard_index(accession, layout, files))
+
+    @staticmethod
+    def _move_to_output(accession: str, work_directory: Path, accession_directory: Path) -> None:
+        """Move compressed files from the scratch directory, then remove what is left there."""
+        # with their indexes, if any, and the index of their shards
+        for path in [
+            *work_directory.glob(f'{accession}*.fastq.gz*'),
+            *work_directory.glob(shard_index_name(accession)),
+        ]:
+            move_file(path, accession_directory / path.name)
+        shutil.rmtree(work_directory, ignore_errors=True)
+        logger.debug("FASTQ files for %s have been moved to %s", accession, accession_directory)
+
+    def _download_via_fastrq_dump(
+        self, accession: str, accession_directory: Path, source: tp.Optional[Path] = None
+    ) -> None:
+        """Fetch and convert the run, or only convert it from `source` fetched by prefetch."""
+        # temporary files are written to the current directory by default
+        temp_options = ['--temp', str(accession_directory)] if self.scratch_directory else []
+        wanted = min(self.threads_per_job, config.FASTERQ_DUMP_MAX_THREADS)
+        with self.cpu_budget.reserve(wanted) as threads:
+            logger.debug(
+                "Downloading accession %s using fasterq-dump with %d threads...", accession, threads
+            )
+            subprocess.run(
+                [
+                    'fasterq-dump',
+                    source if source is not None else accession,
+                    '-O',
+                    accession_directory,
+                    *temp_options,
+                    '-p',
+                    '--threads',
+                    str(threads),
+                ],
+                check=True,
+            )
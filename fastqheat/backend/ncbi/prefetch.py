@@ -0,0 +1,56 @@
+import logging
+import shutil
+import subprocess
+import threading
+from pathlib import Path
+
+from fastqheat.config import config
+
+logger = logging.getLogger("fastqheat.ncbi.prefetch")
+
+
+class SraCache:
+    """
+    Bounded local cache of .sra files fetched by `prefetch` ahead of their conversion.
+
+    A download worker reserves a place in the cache, fetches the .sra file of the run and hands it
+    over to the conversion (fasterq-dump on the local file), then fetches the next run while the
+    previous one is converted. The run is evicted once it has been converted and checked, which
+    frees its place. When conversions fall behind, the cache fills up and workers wait for places
+    instead of filling the disk with .sra files.
+
+    directory/
+    ├── SRR7882015
+    │   └── SRR7882015.sra
+    └── SRR7882016
+        └── SRR7882016.sra
+    """
+
+    def __init__(self, directory: Path, capacity: int = config.SRA_CACHE_RUNS):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._places = threading.BoundedSemaphore(capacity)
+
+    def reserve(self) -> None:
+        """Wait for a place in the cache, it is freed by evict()."""
+        self._places.acquire()
+
+    def fetch(self, accession: str) -> Path:
+        """Fetch the .sra file of the run (files left by an interrupted run are reused)."""
+        logger.info("Prefetching %s into %s", accession, self.directory)
+        subprocess.run(
+            ['prefetch', accession, '--output-directory', self.directory, '--max-size', 'u'],
+            check=True,
+        )
+        return self.path(accession)
+
+    def path(self, accession: str) -> Path:
+        """Path of the fetched run, as accepted by fasterq-dump."""
+        run_directory = self.directory / accession
+        # newer versions of prefetch may fetch .sralite files instead of .sra
+        return next(run_directory.glob(f'{accession}.sra*'), run_directory)
+
+    def evict(self, accession: str) -> None:
+        shutil.rmtree(self.directory / accession, ignore_errors=True)
+        self._places.release()
+        logger.debug("%s has been evicted from the .sra cache", accession)
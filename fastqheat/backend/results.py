@@ -0,0 +1,33 @@
+import dataclasses
+import typing as tp
+from pathlib import Path
+
+
+@dataclasses.dataclass(frozen=True)
+class FileResult:
+    # path in the working directory, or URL of the object in a remote sink, e.g. s3://bucket/key
+    path: tp.Union[Path, str]
+    # bytes
+    size: int
+    # md5 of the file, None if it is not known (NCBI runs, or the check was skipped)
+    md5: tp.Optional[str] = None
+
+
+@dataclasses.dataclass(frozen=True)
+class RunResult:
+    """Outcome of a run, reported as soon as the run is completed or has failed for good."""
+
+    accession: str
+    success: bool
+    # compressed FASTQ files of the run, empty if it has failed
+    files: list[FileResult] = dataclasses.field(default_factory=list)
+    # number of spots counted by the check, None unless it has been counted (NCBI runs)
+    read_count: tp.Optional[int] = None
+    # seconds from the first start of the run until it was completed, retries included. None if
+    # the run has been completed by a previous run of FastqHeat (see `resume`).
+    elapsed: tp.Optional[float] = None
+    error: tp.Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return sum(file.size for file in self.files)
@@ -0,0 +1,116 @@
+import logging
+import random
+import subprocess
+import typing as tp
+
+import aiohttp
+import backoff
+import requests
+
+from fastqheat.config import config
+from fastqheat.exceptions import ENAClientError, ValidationError
+from fastqheat.utility import BaseEnum
+
+logger = logging.getLogger("fastqheat.backend.retry")
+
+_CallableT = tp.TypeVar('_CallableT', bound=tp.Callable[..., tp.Any])
+
+
+class ErrorKind(BaseEnum):
+    # connection errors, timeouts, failed transfers of external tools
+    transient = "transient"
+    # HTTP 429 and 5xx, the server is overloaded or has an incident
+    throttled = "throttled"
+    # the downloaded data does not match its checksum or the expected contents
+    checksum = "checksum"
+    # errors that are not going to go away on their own, e.g. HTTP 404 or a missing run
+    permanent = "permanent"
+
+
+def classify_error(error: BaseException) -> ErrorKind:
+    """Decide whether an error is worth retrying."""
+    if isinstance(error, ENAClientError):
+        # ENA client errors wrap the HTTP error, no cause means the run has not been found
+        if error.__cause__ is None:
+            return ErrorKind.permanent
+        error = error.__cause__
+
+    if isinstance(error, ValidationError):
+        return ErrorKind.checksum
+
+    status = None
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+    elif isinstance(error, aiohttp.ClientResponseError):
+        status = error.status
+    if status is not None:
+        if status == 429 or status >= 500:
+            return ErrorKind.throttled
+        return ErrorKind.permanent
+
+    if isinstance(
+        error,
+        (
+            requests.RequestException,
+            aiohttp.ClientError,
+            subprocess.CalledProcessError,
+            ConnectionError,
+            TimeoutError,
+        ),
+    ):
+        return ErrorKind.transient
+    return ErrorKind.permanent
+
+
+def is_permanent_error(error: BaseException) -> bool:
+    return classify_error(error) == ErrorKind.permanent
+
+
+def retry_on(
+    exception: tp.Union[tp.Type[Exception], tuple[tp.Type[Exception], ...]],
+    attempts: int,
+    attempts_interval: float,
+) -> tp.Callable[[_CallableT], _CallableT]:
+    """
+    Retry a function that raises `exception` up to `attempts` times.
+
+    Waits grow exponentially from `attempts_interval` with full jitter, so that workers that
+    failed at the same time do not retry at the same time. Permanent errors are not retried.
+    """
+    return backoff.on_exception(
+        backoff.expo,
+        exception,
+        max_tries=attempts,
+        factor=attempts_interval,
+        max_value=config.RETRY_MAX_INTERVAL,
+        jitter=backoff.full_jitter,
+        giveup=is_permanent_error,
+    )
+
+
+class RetryPolicy:
+    """
+    Decides which failed accessions are deferred and retried later, and when.
+
+    Deferred accessions go back to the work queue and are retried after an exponentially
+    growing delay with jitter, other accessions are downloaded in the meantime.
+    """
+
+    def __init__(
+        self,
+        deferred_retries: int = config.DEFERRED_RETRIES,
+        interval: float = config.DEFERRED_RETRY_INTERVAL,
+        max_interval: float = config.RETRY_MAX_INTERVAL,
+    ):
+        self.deferred_retries = deferred_retries
+        self.interval = interval
+        self.max_interval = max_interval
+
+    def should_defer(self, kind: ErrorKind, retries: int) -> bool:
+        """Whether an accession that failed `retries` times already is going to be retried."""
+        return kind != ErrorKind.permanent and retries < self.deferred_retries
+
+    def delay(self, retries: int) -> float:
+        """Seconds to wait before the next retry, half of the delay is random."""
+        delay = min(self.interval * 2**retries, self.max_interval)
+        return delay / 2 + random.uniform(0, delay / 2)
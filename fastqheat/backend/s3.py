@@ -0,0 +1,179 @@
+import base64
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import typing as tp
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+import requests
+
+from fastqheat.backend.retry import retry_on
+from fastqheat.config import config
+
+logger = logging.getLogger("fastqheat.backend.s3")
+
+# payload hashes are not computed, parts are protected by Content-MD5 instead
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+
+def parse_s3_url(url: str) -> tuple[str, str]:
+    """Split s3://bucket/prefix into the bucket and the key prefix (without slashes around)."""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme != 's3' or not parsed.netloc:
+        raise ValueError(f"Invalid S3 URL: {url!r}. Expected something like 's3://bucket/prefix'")
+    return parsed.netloc, parsed.path.strip('/')
+
+
+class S3Client:
+    """
+    Minimal client of the S3 API: single and multipart uploads, signed with AWS Signature V4.
+
+    Objects are addressed path-style (endpoint/bucket/key), which works with AWS and with
+    S3-compatible storage such as MinIO or Ceph. Settings default to the usual environment
+    variables: AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_SESSION_TOKEN, AWS_REGION (or
+    AWS_DEFAULT_REGION) and AWS_ENDPOINT_URL.
+    """
+
+    def __init__(
+        self,
+        endpoint_url: tp.Optional[str] = None,
+        region: tp.Optional[str] = None,
+        access_key: tp.Optional[str] = None,
+        secret_key: tp.Optional[str] = None,
+        session_token: tp.Optional[str] = None,
+        attempts: int = config.DEFAULT_MAX_ATTEMPTS,
+        attempts_interval: float = 0,
+    ):
+        self.region = (
+            region or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+        ) or 'us-east-1'
+        self.endpoint_url = (
+            endpoint_url
+            or os.environ.get('AWS_ENDPOINT_URL')
+            or f'https://s3.{self.region}.amazonaws.com'
+        ).rstrip('/')
+        self.access_key = access_key or os.environ.get('AWS_ACCESS_KEY_ID', '')
+        self.secret_key = secret_key or os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+        self.session_token = session_token or os.environ.get('AWS_SESSION_TOKEN')
+        if not self.access_key or not self.secret_key:
+            raise ValueError("S3 credentials are not set, see AWS_ACCESS_KEY_ID")
+        self._session = requests.Session()
+        self._request = retry_on(requests.RequestException, attempts, attempts_interval)(self._send)
+
+    def put_object(self, bucket: str, key: str, data: bytes) -> None:
+        self._request('PUT', bucket, key, data=data)
+
+    def create_multipart_upload(self, bucket: str, key: str) -> str:
+        """Start a multipart upload, return its id."""
+        response = self._request('POST', bucket, key, params={'uploads': ''})
+        return self._find(response, 'UploadId')
+
+    def upload_part(
+        self, bucket: str, key: str, upload_id: str, part_number: int, data: bytes
+    ) -> str:
+        """Upload a part (numbered from 1), return its ETag."""
+        response = self._request(
+            'PUT',
+            bucket,
+            key,
+            params={'partNumber': str(part_number), 'uploadId': upload_id},
+            data=data,
+        )
+        return response.headers['ETag']
+
+    def complete_multipart_upload(
+        self, bucket: str, key: str, upload_id: str, etags: list[str]
+    ) -> None:
+        parts = "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+            for number, etag in enumerate(etags, start=1)
+        )
+        body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode()
+        response = self._request('POST', bucket, key, params={'uploadId': upload_id}, data=body)
+        # S3 may report an error after it has started to answer with 200
+        if ElementTree.fromstring(response.content).tag.endswith('Error'):
+            raise requests.HTTPError(f"Upload of {key} has failed: {response.text}")
+
+    def abort_multipart_upload(self, bucket: str, key: str, upload_id: str) -> None:
+        self._request('DELETE', bucket, key, params={'uploadId': upload_id})
+
+    def _send(
+        self,
+        method: str,
+        bucket: str,
+        key: str,
+        params: tp.Optional[dict[str, str]] = None,
+        data: bytes = b'',
+    ) -> requests.Response:
+        path = '/' + urllib.parse.quote(f'{bucket}/{key}', safe='/-_.~')
+        query = '&'.join(
+            f"{urllib.parse.quote(name, safe='-_.~')}={urllib.parse.quote(value, safe='-_.~')}"
+            for name, value in sorted((params or {}).items())
+        )
+        headers = self._sign(
+            method,
+            path,
+            query,
+            {'content-md5': base64.b64encode(hashlib.md5(data).digest()).decode()},
+        )
+
+        url = f'{self.endpoint_url}{path}' + (f'?{query}' if query else '')
+        response = self._session.request(method, url, data=data, headers=headers)
+        response.raise_for_status()
+        return response
+
+    def _sign(self, method: str, path: str, query: str, headers: dict[str, str]) -> dict[str, str]:
+        """`headers` (lowercase) with the headers of AWS Signature V4 of the request added."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        scope = f"{now:%Y%m%d}/{self.region}/s3/aws4_request"
+
+        signed = {
+            'host': urllib.parse.urlparse(self.endpoint_url).netloc,
+            'x-amz-content-sha256': UNSIGNED_PAYLOAD,
+            'x-amz-date': amz_date,
+            **headers,
+        }
+        if self.session_token:
+            signed['x-amz-security-token'] = self.session_token
+        signed_names = ';'.join(sorted(signed))
+        canonical_request = '\n'.join(
+            [
+                method,
+                path,
+                query,
+                ''.join(f'{name}:{signed[name].strip()}\n' for name in sorted(signed)),
+                signed_names,
+                UNSIGNED_PAYLOAD,
+            ]
+        )
+        string_to_sign = '\n'.join(
+            [
+                'AWS4-HMAC-SHA256',
+                amz_date,
+                scope,
+                hashlib.sha256(canonical_request.encode()).hexdigest(),
+            ]
+        )
+
+        key = f'AWS4{self.secret_key}'.encode()
+        for part in scope.split('/'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+        result = {name: value for name, value in signed.items() if name != 'host'}
+        result['Authorization'] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed_names}, Signature={signature}"
+        )
+        return result
+
+    @staticmethod
+    def _find(response: requests.Response, tag: str) -> str:
+        for element in ElementTree.fromstring(response.content).iter():
+            if element.tag.split('}')[-1] == tag and element.text:
+                return element.text
+        raise requests.HTTPError(f"{tag} not found in the response: {response.text}")
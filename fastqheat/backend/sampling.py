@@ -0,0 +1,70 @@
+import dataclasses
+import typing as tp
+import zlib
+
+from fastqheat.config import config
+from fastqheat.exceptions import ValidationError
+
+
+@dataclasses.dataclass(frozen=True)
+class SampleLimits:
+    """How much of every file of a run to download: the first `max_reads` reads, at most."""
+
+    max_reads: tp.Optional[int] = None
+    # compressed bytes transferred, the reads that have arrived complete are kept
+    max_bytes: tp.Optional[int] = None
+
+    def describe(self) -> dict[str, tp.Optional[int]]:
+        return dataclasses.asdict(self)
+
+
+def fastq_head(
+    chunks: tp.Iterable[bytes], max_records: tp.Optional[int] = None, cut_off: bool = False
+) -> tp.Iterator[bytes]:
+    """
+    Complete FASTQ records of a decompressed stream, up to `max_records` of them.
+
+    Every chunk yielded consists of whole records. The stream is not read further once there are
+    enough records. If it has been `cut_off` on purpose, its unfinished last record is dropped,
+    otherwise it is an error.
+    """
+    records = 0
+    # lines of the unfinished record read so far, the last one may be unfinished too
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        complete = (len(lines) - 1) // 4
+        if max_records is not None:
+            complete = min(complete, max_records - records)
+        if complete:
+            _check_records(lines, complete)
+            records += complete
+            yield b'\n'.join(lines[: 4 * complete]) + b'\n'
+        if max_records is not None and records >= max_records:
+            return
+        rest = b'\n'.join(lines[4 * complete :])
+
+    lines = rest.split(b'\n')
+    # the last record may lack the final newline, then its quality line is as long as the sequence
+    if len(lines) == 4 and len(lines[3]) == len(lines[1]) and not cut_off:
+        _check_records(lines, 1)
+        yield rest + b'\n'
+    elif rest and not cut_off:
+        raise ValidationError("FASTQ stream ends with a truncated record")
+
+
+def _check_records(lines: list[bytes], records: int) -> None:
+    headers = lines[0 : 4 * records : 4]
+    separators = lines[2 : 4 * records : 4]
+    if not all(header.startswith(b'@') for header in headers) or not all(
+        separator.startswith(b'+') for separator in separators
+    ):
+        raise ValidationError("The stream is not in FASTQ format")
+
+
+def gzip_member(data: bytes) -> bytes:
+    """Compress data into a single gzip member, members of a file can be compressed in parallel."""
+    compressor = zlib.compressobj(
+        config.SAMPLE_COMPRESSION_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16
+    )
+    return compressor.compress(data) + compressor.flush()
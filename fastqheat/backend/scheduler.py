@@ -0,0 +1,206 @@
+import dataclasses
+import heapq
+import logging
+import threading
+import time
+import typing as tp
+from abc import abstractmethod
+
+logger = logging.getLogger("fastqheat.backend.scheduler")
+
+
+@dataclasses.dataclass
+class WorkItem:
+    """An accession to be processed by a worker."""
+
+    accession: str
+    # position of the accession in the input
+    index: int
+    # total size of the FASTQ files of the run in bytes, None if unknown
+    size: tp.Optional[int] = None
+    # how many times the item has been deferred after a failure
+    retries: int = 0
+
+
+class SchedulingPolicy:
+    """
+    Defines the order in which accessions are processed.
+
+    Items with the smallest key are processed first. Policies that need run sizes set
+    `needs_sizes`, so that sizes are requested from ENA only when they are used.
+    """
+
+    needs_sizes: bool = False
+
+    def key(self, item: WorkItem) -> tp.Any:
+        return item.index
+
+
+class InputOrderPolicy(SchedulingPolicy):
+    """Process accessions in the order they were given."""
+
+
+class LargestFirstPolicy(SchedulingPolicy):
+    """
+    Process the largest runs first.
+
+    Together with workers that take the next item as soon as they are free this is the
+    "longest processing time first" heuristic: big runs are spread across workers at the start
+    and small ones fill the gaps at the end, so that no single big run is left as a long tail
+    after everything else has finished. Runs of unknown size go last.
+    """
+
+    needs_sizes = True
+
+    def key(self, item: WorkItem) -> tp.Any:
+        return (item.size is None, -(item.size or 0), item.index)
+
+
+class SmallestFirstPolicy(SchedulingPolicy):
+    """Process the smallest runs first, e.g. to get as many complete runs as early as possible."""
+
+    needs_sizes = True
+
+    def key(self, item: WorkItem) -> tp.Any:
+        return (item.size is None, item.size or 0, item.index)
+
+
+SCHEDULING_POLICIES: dict[str, tp.Type[SchedulingPolicy]] = {
+    'input': InputOrderPolicy,
+    'largest-first': LargestFirstPolicy,
+    'smallest-first': SmallestFirstPolicy,
+}
+
+
+def register_scheduling_policy(name: str, policy: tp.Type[SchedulingPolicy]) -> None:
+    """Make a custom policy available by name."""
+    SCHEDULING_POLICIES[name] = policy
+
+
+def get_scheduling_policy(name: str) -> SchedulingPolicy:
+    try:
+        return SCHEDULING_POLICIES[name]()
+    except KeyError:
+        raise ValueError(f"Unknown scheduling policy: {name}")
+
+
+class WorkQueue:
+    """
+    Source of work for download workers.
+
+    Workers call next() when they are free and get the next item, or None when there is no work
+    left, and report the outcome of every item they got with done(), or put it back with defer()
+    to be retried later.
+    """
+
+    @abstractmethod
+    def next(self) -> tp.Optional[WorkItem]:
+        pass
+
+    @abstractmethod
+    def done(self, item: WorkItem, success: bool = True) -> None:
+        pass
+
+    @abstractmethod
+    def defer(self, item: WorkItem, delay: float) -> None:
+        """Put the item back to be returned by next() again in `delay` seconds."""
+
+
+class Scheduler(WorkQueue):
+    """
+    Thread-safe in-memory queue of accessions ordered by a scheduling policy.
+
+    Items can also come from `source`, an iterator that is consumed only when all other items
+    have been scheduled, so that downloads start before the source has been read to the end.
+    Items from the source are scheduled in the order they come.
+
+    Deferred items are returned as soon as their delay has passed, before the other items.
+    While the delay of every deferred item is still running and there are no other items,
+    next() waits for the first one.
+
+    Bytes in flight are tracked to be reported in the logs.
+    """
+
+    def __init__(
+        self,
+        items: tp.Iterable[WorkItem],
+        policy: SchedulingPolicy,
+        clock: tp.Callable[[], float] = time.monotonic,
+        source: tp.Optional[tp.Iterator[WorkItem]] = None,
+    ):
+        self.policy = policy
+        self._clock = clock
+        self._source = source
+        self._condition = threading.Condition()
+        self._heap = [(policy.key(item), item.index, item) for item in items]
+        heapq.heapify(self._heap)
+        # (time when the item is due, index, item)
+        self._deferred: list[tuple[float, int, WorkItem]] = []
+        self._bytes_in_flight = 0
+
+    @classmethod
+    def from_accessions(
+        cls,
+        accessions: list[str],
+        policy: SchedulingPolicy,
+        sizes: tp.Optional[dict[str, tp.Optional[int]]] = None,
+    ) -> 'Scheduler':
+        sizes = sizes or {}
+        items = [
+            WorkItem(accession=accession, index=index, size=sizes.get(accession))
+            for index, accession in enumerate(accessions)
+        ]
+        return cls(items, policy)
+
+    def __len__(self) -> int:
+        return len(self._heap) + len(self._deferred)
+
+    @property
+    def items(self) -> list[WorkItem]:
+        """Items that have not been scheduled yet."""
+        with self._condition:
+            return [item for _, _, item in self._heap]
+
+    def next(self) -> tp.Optional[WorkItem]:
+        with self._condition:
+            while True:
+                now = self._clock()
+                if self._deferred and self._deferred[0][0] <= now:
+                    _, _, item = heapq.heappop(self._deferred)
+                    break
+                if self._heap:
+                    _, _, item = heapq.heappop(self._heap)
+                    break
+                if self._source is not None:
+                    # other workers wait while the next item is being read, there is nothing else
+                    # for them to do anyway
+                    source_item = next(self._source, None)
+                    if source_item is not None:
+                        item = source_item
+                        break
+                    self._source = None
+                if not self._deferred:
+                    return None
+                # woken up early if another item is deferred
+                self._condition.wait(self._deferred[0][0] - now)
+
+            self._bytes_in_flight += item.size or 0
+            bytes_in_flight = self._bytes_in_flight
+
+        logger.debug(
+            "Scheduling %s (%s bytes). Bytes in flight: %d",
+            item.accession,
+            item.size if item.size is not None else "unknown",
+            bytes_in_flight,
+        )
+        return item
+
+    def done(self, item: WorkItem, success: bool = True) -> None:
+        with self._condition:
+            self._bytes_in_flight -= item.size or 0
+
+    def defer(self, item: WorkItem, delay: float) -> None:
+        with self._condition:
+            self._bytes_in_flight -= item.size or 0
+            heapq.heappush(self._deferred, (self._clock() + delay, item.index, item))
+            self._condition.notify_all()
@@ -0,0 +1,218 @@
+import collections
+import concurrent.futures
+import dataclasses
+import functools
+import json
+import typing as tp
+from pathlib import Path
+
+from fastqheat.backend.sampling import fastq_head, gzip_member
+from fastqheat.backend.sinks import OutputSink, SinkFile, SinkWriter
+from fastqheat.config import config
+
+
+@dataclasses.dataclass(frozen=True)
+class ShardLayout:
+    """
+    How every file of a run is split into shards: into `shards` shards, or into shards of
+    `reads_per_shard` reads.
+
+    Reads go to the shards by their number only, so the shards of two mates with the same number
+    hold the same pairs. With a number of shards, consecutive blocks of SHARD_BLOCK_READS reads go
+    to the shards in turn, since the number of reads is not known before the run is read.
+    """
+
+    shards: tp.Optional[int] = None
+    reads_per_shard: tp.Optional[int] = None
+
+    def __post_init__(self) -> None:
+        if (self.shards is None) == (self.reads_per_shard is None):
+            raise ValueError("Either the number of shards or the reads per shard must be set")
+
+    @property
+    def block_reads(self) -> int:
+        """How many consecutive reads go to the same shard."""
+        return self.reads_per_shard or config.SHARD_BLOCK_READS
+
+    def shard_of(self, read: int) -> int:
+        block = read // self.block_reads
+        return block if self.shards is None else block % self.shards
+
+    def describe(self) -> dict[str, tp.Optional[int]]:
+        return {**dataclasses.asdict(self), 'block_reads': self.block_reads}
+
+
+def shard_path(path: str, shard: int) -> str:
+    """Path of a shard of the file: SRR1_1.fastq.gz -> SRR1_1.shard0000.fastq.gz"""
+    stem = path[: -len('.fastq.gz')] if path.endswith('.fastq.gz') else path
+    return f'{stem}.shard{shard:04d}.fastq.gz'
+
+
+def shard_index_name(accession: str) -> str:
+    return f'{accession}.shards.json'
+
+
+def shard_index(
+    accession: str, layout: ShardLayout, files: dict[str, list[dict[str, tp.Any]]]
+) -> bytes:
+    """Contents of the index of a sharded run: the shards every file has been split into."""
+    index = {'accession': accession, 'layout': layout.describe(), 'files': files}
+    return json.dumps(index, indent=2).encode()
+
+
+class FastqWriter:
+    """
+    Writes FASTQ records into a gzip file of a sink, or into its shards.
+
+    Records are collected into gzip members of about SHARD_MEMBER_SIZE uncompressed bytes, which
+    are compressed by the executor while the next records arrive. A file is a series of such
+    members, written in order. At most `in_flight` members are being compressed at a time, so
+    the memory used stays bounded. Shards of a number of reads are completed one after another,
+    only the shard being written is kept open.
+    """
+
+    def __init__(
+        self,
+        sink: OutputSink,
+        relative_path: str,
+        layout: tp.Optional[ShardLayout],
+        executor: concurrent.futures.Executor,
+        in_flight: int,
+    ):
+        self.sink = sink
+        self.relative_path = relative_path
+        self.layout = layout
+        self._executor = executor
+        self._in_flight = in_flight
+        # files of the shards that have not been completed yet, and their writers
+        self._files: dict[int, SinkFile] = {}
+        self._writers: dict[int, SinkWriter] = {}
+        # size and md5 of the completed shards
+        self._completed: dict[int, tuple[int, str]] = {}
+        # records of every shard waiting to be compressed, and their size
+        self._buffers: collections.defaultdict[int, list[bytes]] = collections.defaultdict(list)
+        self._buffered: collections.Counter[int] = collections.Counter()
+        self._pending: collections.deque[tuple[int, concurrent.futures.Future]] = (
+            collections.deque()
+        )
+        self.reads: collections.Counter[int] = collections.Counter()
+        self.records = 0
+
+    def __enter__(self) -> 'FastqWriter':
+        # every shard exists even if the run has fewer reads, a single file does too
+        shards = self.layout.shards if self.layout is not None and self.layout.shards else 1
+        for shard in range(shards):
+            self._writer(shard)
+        return self
+
+    def __exit__(self, exc_type: tp.Any, exc_value: tp.Any, traceback: tp.Any) -> None:
+        if exc_type is not None:
+            self._abort(exc_type, exc_value, traceback)
+            return
+        try:
+            for shard in list(self._buffers):
+                self._submit(shard)
+            self._drain(0)
+            for shard in list(self._files):
+                self._complete(shard)
+        except BaseException as err:
+            self._abort(type(err), err, err.__traceback__)
+            raise
+
+    def write(self, lines: list[bytes]) -> None:
+        """Write lines of complete records."""
+        records = len(lines) // 4
+        start = 0
+        while start < records:
+            if self.layout is None:
+                shard, taken = 0, records - start
+            else:
+                shard = self.layout.shard_of(self.records)
+                block_reads = self.layout.block_reads
+                taken = min(records - start, block_reads - self.records % block_reads)
+                if self.layout.shards is None and self.records % block_reads == 0 and shard:
+                    # the previous shard is complete
+                    self._submit(shard - 1)
+                    self._drain(0)
+                    self._complete(shard - 1)
+            data = b'\n'.join(lines[4 * start : 4 * (start + taken)]) + b'\n'
+            self._buffers[shard].append(data)
+            self._buffered[shard] += len(data)
+            self.reads[shard] += taken
+            self.records += taken
+            start += taken
+            if self._buffered[shard] >= config.SHARD_MEMBER_SIZE:
+                self._submit(shard)
+
+    def shards(self) -> list[dict[str, tp.Any]]:
+        """Index entries of the shards, once they have been written."""
+        return [
+            {
+                'shard': shard,
+                'file': self._path(shard).split('/')[-1],
+                'reads': self.reads[shard],
+                'size': size,
+                'md5': md5,
+            }
+            for shard, (size, md5) in sorted(self._completed.items())
+        ]
+
+    def _submit(self, shard: int) -> None:
+        if shard not in self._buffers:
+            return
+        data = b''.join(self._buffers.pop(shard))
+        del self._buffered[shard]
+        self._writer(shard)
+        self._pending.append((shard, self._executor.submit(gzip_member, data)))
+        self._drain(self._in_flight)
+
+    def _drain(self, in_flight: int) -> None:
+        while len(self._pending) > in_flight:
+            shard, future = self._pending.popleft()
+            self._writers[shard].write(future.result())
+
+    def _writer(self, shard: int) -> SinkWriter:
+        if shard in self._completed:
+            raise ValueError(f"Shard {shard} of {self.relative_path} has been completed")
+        if shard not in self._writers:
+            self._files[shard] = self.sink.open(self._path(shard))
+            self._writers[shard] = self._files[shard].__enter__()
+        return self._writers[shard]
+
+    def _complete(self, shard: int) -> None:
+        """Commit a shard, all its members have been written."""
+        writer = self._writers.pop(shard)
+        if not writer.size:
+            # an empty file is still a valid gzip file
+            writer.write(gzip_member(b''))
+        self._files.pop(shard).__exit__(None, None, None)
+        self._completed[shard] = (writer.size, writer.md5)
+
+    def _abort(self, exc_type: tp.Any, exc_value: tp.Any, traceback: tp.Any) -> None:
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        for shard in list(self._files):
+            del self._writers[shard]
+            self._files.pop(shard).__exit__(exc_type, exc_value, traceback)
+
+    def _path(self, shard: int) -> str:
+        return self.relative_path if self.layout is None else shard_path(self.relative_path, shard)
+
+
+def shard_fastq_file(
+    path: Path,
+    sink: OutputSink,
+    relative_path: str,
+    layout: ShardLayout,
+    executor: concurrent.futures.Executor,
+    in_flight: int,
+) -> list[dict[str, tp.Any]]:
+    """Split an uncompressed FASTQ file into compressed shards, return their index entries."""
+    with open(path, 'rb') as file, FastqWriter(
+        sink, relative_path, layout, executor, in_flight
+    ) as writer:
+        chunks = iter(functools.partial(file.read, config.FASTQ_SCAN_CHUNK_SIZE), b'')
+        for data in fastq_head(chunks):
+            writer.write(data.split(b'\n')[:-1])
+    return writer.shards()
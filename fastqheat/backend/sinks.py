@@ -0,0 +1,284 @@
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import threading
+import typing as tp
+from abc import abstractmethod
+from pathlib import Path
+
+from fastqheat.backend.s3 import S3Client, parse_s3_url
+from fastqheat.config import config
+from fastqheat.exceptions import ValidationError
+
+logger = logging.getLogger("fastqheat.backend.sinks")
+
+
+class SinkWriter:
+    """A file being written to a sink. md5 and size of the written data are known afterwards."""
+
+    def __init__(self) -> None:
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+    def write(self, data: bytes) -> None:
+        self._md5.update(data)
+        self.size += len(data)
+        self._write(data)
+
+    @abstractmethod
+    def _write(self, data: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def commit(self) -> None:
+        """All data has been written, make the file available."""
+
+    @abstractmethod
+    def abort(self) -> None:
+        """Writing has failed, drop what has been written."""
+
+
+class OutputSink:
+    """
+    Destination of downloaded runs.
+
+    Files are addressed by paths relative to the destination, "<accession>/<file name>". They are
+    either written to the sink as they are downloaded (`open`), or handed over to it once they
+    are complete on the local disk (`store`), e.g. after external tools have made them.
+
+    A file written to the sink appears under its path only when it is committed: a file whose
+    writing has failed, or whose md5 differs from the expected one, is aborted and leaves
+    nothing behind, neither a partial local file nor an object in S3. Size and md5 of committed
+    files are kept until they are taken by `take_committed`, e.g. for the result of the run.
+    """
+
+    # whether files are kept in the working directory, i.e. runs can be checked and resumed there
+    is_local: bool = True
+
+    def __init__(self) -> None:
+        # accession -> path of a committed file -> its size and md5
+        self._committed: dict[str, dict[str, tuple[int, str]]] = {}
+        self._committed_lock = threading.Lock()
+
+    def open(self, relative_path: str, md5: tp.Optional[str] = None) -> 'SinkFile':
+        """Open a file for writing, with the `md5` it is checked against before it is committed."""
+        return SinkFile(self._make_writer(relative_path), relative_path, md5, sink=self)
+
+    def take_committed(self, accession: str) -> dict[str, tuple[int, str]]:
+        """Size and md5 of the files of the accession committed since the last call, by path."""
+        with self._committed_lock:
+            return self._committed.pop(accession, {})
+
+    def _record_commit(self, relative_path: str, writer: SinkWriter) -> None:
+        accession = relative_path.split('/')[0]
+        with self._committed_lock:
+            self._committed.setdefault(accession, {})[relative_path] = (writer.size, writer.md5)
+
+    @abstractmethod
+    def _make_writer(self, relative_path: str) -> SinkWriter:
+        pass
+
+    @abstractmethod
+    def store(self, path: Path, relative_path: str) -> None:
+        """Hand a complete local file over to the sink."""
+
+    def describe(self, relative_path: str) -> str:
+        return relative_path
+
+
+class SinkFile:
+    """
+    Context manager that commits the writer on success and aborts it on errors. With the expected
+    `md5`, a file with another md5 is aborted too and ValidationError is raised.
+    """
+
+    def __init__(
+        self,
+        writer: SinkWriter,
+        relative_path: str,
+        md5: tp.Optional[str] = None,
+        sink: tp.Optional[OutputSink] = None,
+    ):
+        self.writer = writer
+        self.relative_path = relative_path
+        self.md5 = md5
+        self.sink = sink
+
+    def __enter__(self) -> SinkWriter:
+        return self.writer
+
+    def __exit__(self, exc_type: tp.Any, exc_value: tp.Any, traceback: tp.Any) -> None:
+        if exc_type is not None:
+            self.writer.abort()
+            return
+        if self.md5 is not None and self.writer.md5 != self.md5:
+            self.writer.abort()
+            raise ValidationError(f"{self.relative_path} failed md5 check")
+        self.writer.commit()
+        if self.sink is not None:
+            self.sink._record_commit(self.relative_path, self.writer)
+
+
+class _LocalWriter(SinkWriter):
+    def __init__(self, path: Path):
+        super().__init__()
+        self.path = path
+        self._file = open(path, 'wb')
+
+    def _write(self, data: bytes) -> None:
+        self._file.write(data)
+
+    def commit(self) -> None:
+        self._file.close()
+
+    def abort(self) -> None:
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
+
+class LocalSink(OutputSink):
+    """Files in the working directory, the default."""
+
+    def __init__(self, directory: Path):
+        super().__init__()
+        self.directory = Path(directory)
+
+    def _make_writer(self, relative_path: str) -> SinkWriter:
+        path = self.directory / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # an old file may be a read-only hard link to the download cache, it is not written through
+        path.unlink(missing_ok=True)
+        return _LocalWriter(path)
+
+    def store(self, path: Path, relative_path: str) -> None:
+        target = self.directory / relative_path
+        if path.resolve() != target.resolve():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            path.replace(target)
+
+
+class _S3Writer(SinkWriter):
+    """
+    Uploads a file in parts while it is written, a few parts at a time.
+
+    Files smaller than a part are uploaded with a single request when they are committed.
+    """
+
+    def __init__(self, sink: 'S3Sink', key: str):
+        super().__init__()
+        self.sink = sink
+        self.key = key
+        self.part_size = sink.part_size
+        self._buffer = bytearray()
+        self._upload_id: tp.Optional[str] = None
+        self._parts: tp.Deque[concurrent.futures.Future] = collections.deque()
+        self._etags: list[str] = []
+
+    def _write(self, data: bytes) -> None:
+        self._buffer += data
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+
+    def commit(self) -> None:
+        client, bucket = self.sink.client, self.sink.bucket
+        if self._upload_id is None:
+            client.put_object(bucket, self.key, bytes(self._buffer))
+            logger.debug("s3://%s/%s has been uploaded", bucket, self.key)
+            return
+        try:
+            if self._buffer:
+                self._upload_part()
+            self._wait_for_parts(0)
+            client.complete_multipart_upload(bucket, self.key, self._upload_id, self._etags)
+        except BaseException:
+            self.abort()
+            raise
+        logger.debug("s3://%s/%s has been uploaded in %d parts", bucket, self.key, len(self._etags))
+
+    def abort(self) -> None:
+        if self._upload_id is None:
+            return
+        for part in self._parts:
+            part.cancel()
+        concurrent.futures.wait(self._parts)
+        try:
+            self.sink.client.abort_multipart_upload(self.sink.bucket, self.key, self._upload_id)
+        except Exception as err:
+            # S3 removes parts of abandoned uploads by a lifecycle rule, if there is one
+            logger.warning("Cannot abort the upload of %s: %s", self.key, str(err))
+        self._upload_id = None
+
+    def _upload_part(self) -> None:
+        if self._upload_id is None:
+            self._upload_id = self.sink.client.create_multipart_upload(self.sink.bucket, self.key)
+        # the next parts are downloaded while this one is uploaded
+        self._wait_for_parts(config.S3_PARTS_IN_FLIGHT - 1)
+        part_number = len(self._etags) + len(self._parts) + 1
+        self._parts.append(
+            self.sink.executor.submit(
+                self.sink.client.upload_part,
+                self.sink.bucket,
+                self.key,
+                self._upload_id,
+                part_number,
+                bytes(self._buffer),
+            )
+        )
+        self._buffer = bytearray()
+        if part_number % config.S3_PART_SIZE_DOUBLING == 0:
+            self.part_size *= 2
+
+    def _wait_for_parts(self, in_flight: int) -> None:
+        while len(self._parts) > in_flight:
+            self._etags.append(self._parts.popleft().result())
+
+
+class S3Sink(OutputSink):
+    """
+    Objects in S3-compatible storage, under "s3://bucket/prefix/<accession>/<file name>".
+
+    Files downloaded over HTTP are uploaded while they are downloaded, without touching the local
+    disk. Other files are uploaded when they are complete, and removed from the local disk.
+    """
+
+    is_local = False
+
+    def __init__(
+        self,
+        url: str,
+        client: tp.Optional[S3Client] = None,
+        part_size: int = config.S3_PART_SIZE,
+    ):
+        super().__init__()
+        self.bucket, self.prefix = parse_s3_url(url)
+        self.client = client or S3Client()
+        self.part_size = part_size
+        # uploads parts of all files written at the same time
+        self.executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="s3-upload")
+
+    def key(self, relative_path: str) -> str:
+        return f'{self.prefix}/{relative_path}' if self.prefix else relative_path
+
+    def _make_writer(self, relative_path: str) -> SinkWriter:
+        return _S3Writer(self, self.key(relative_path))
+
+    def store(self, path: Path, relative_path: str) -> None:
+        with self.open(relative_path) as writer, path.open('rb') as file:
+            for chunk in iter(lambda: file.read(self.part_size), b''):
+                writer.write(chunk)
+        path.unlink()
+
+    def describe(self, relative_path: str) -> str:
+        return f's3://{self.bucket}/{self.key(relative_path)}'
+
+
+def make_sink(output: tp.Optional[str], working_directory: Path) -> OutputSink:
+    """Sink for the --output option: an S3 URL, or the working directory if it is not set."""
+    if output is None:
+        return LocalSink(working_directory)
+    return S3Sink(output)
@@ -0,0 +1,146 @@
+import contextlib
+import dataclasses
+import logging
+import time
+import typing as tp
+from pathlib import Path
+
+from fastqheat.backend import database
+from fastqheat.backend.scheduler import WorkItem
+from fastqheat.config import config
+
+logger = logging.getLogger("fastqheat.backend.state")
+
+
+@dataclasses.dataclass
+class AccessionState:
+    accession: str
+    state: str
+    # number of times the accession has been started
+    attempts: int
+    # total size of the FASTQ files of the run in ENA, None if unknown
+    size: tp.Optional[int]
+    # bytes in the accession directory after the last completed stage
+    bytes: tp.Optional[int]
+    last_error: tp.Optional[str]
+    # UNIX time of the last change
+    updated: float
+
+
+class StateStore:
+    """
+    Durable record of the lifecycle of every accession downloaded into a working directory.
+
+    An accession is resolved when it is queued for download, goes through downloading and
+    downloaded, then verified and/or compressed depending on the backend and its options, or ends
+    up failed. Every start increments the number of attempts, failures keep the error message.
+    The record is an SQLite database in the working directory, so it survives crashes and can
+    be inspected with the sqlite3 shell. It is used to resume an interrupted run: accessions that
+    have completed all stages are skipped, the others continue from the last completed stage.
+    """
+
+    RESOLVED = 'resolved'
+    DOWNLOADING = 'downloading'
+    DOWNLOADED = 'downloaded'
+    VERIFIED = 'verified'
+    COMPRESSED = 'compressed'
+    FAILED = 'failed'
+
+    # Stages in the order they are completed. Not every backend goes through all of them.
+    LIFECYCLE = (RESOLVED, DOWNLOADING, DOWNLOADED, VERIFIED, COMPRESSED)
+
+    def __init__(self, directory: Path):
+        self.path = Path(directory) / config.STATE_FILE_NAME
+        self._create_schema()
+
+    @classmethod
+    def reached(cls, state: tp.Optional[str], stage: str) -> bool:
+        """Whether an accession in `state` has completed `stage`."""
+        if state is None or state == cls.FAILED:
+            return False
+        return cls.LIFECYCLE.index(state) >= cls.LIFECYCLE.index(stage)
+
+    def resolve(self, items: tp.Iterable[WorkItem]) -> None:
+        """Record accessions queued for download, the state of known accessions is kept."""
+        now = time.time()
+        with database.transaction(self.path) as connection:
+            connection.executemany(
+                "INSERT INTO accessions (accession, state, size, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (accession) DO UPDATE SET size = COALESCE(excluded.size, size)",
+                [(item.accession, self.RESOLVED, item.size, now) for item in items],
+            )
+
+    def start(self, accession: str, resumed: tp.Optional[str] = None) -> None:
+        """
+        Record a start of the accession. An accession resumed from a stage completed by a previous
+        run (`resumed`) stays at it, so it is resumed from there again if it is interrupted again.
+        """
+        state = resumed if self.reached(resumed, self.DOWNLOADED) else self.DOWNLOADING
+        with database.transaction(self.path) as connection:
+            connection.execute(
+                "INSERT INTO accessions (accession, state, attempts, updated) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT (accession) DO UPDATE SET "
+                "state = excluded.state, attempts = attempts + 1, updated = excluded.updated",
+                (accession, state, time.time()),
+            )
+
+    def advance(self, accession: str, state: str, nbytes: tp.Optional[int] = None) -> None:
+        """Record that the accession has completed a stage."""
+        with database.transaction(self.path) as connection:
+            connection.execute(
+                "UPDATE accessions SET state = ?, bytes = COALESCE(?, bytes), updated = ? "
+                "WHERE accession = ?",
+                (state, nbytes, time.time(), accession),
+            )
+        logger.debug("%s is %s", accession, state)
+
+    def fail(self, accession: str, error: str) -> None:
+        with database.transaction(self.path) as connection:
+            connection.execute(
+                "UPDATE accessions SET state = ?, last_error = ?, updated = ? WHERE accession = ?",
+                (self.FAILED, error, time.time(), accession),
+            )
+
+    def record_error(self, accession: str, error: str) -> None:
+        """Keep the error of an accession that is going to be retried."""
+        with database.transaction(self.path) as connection:
+            connection.execute(
+                "UPDATE accessions SET last_error = ?, updated = ? WHERE accession = ?",
+                (error, time.time(), accession),
+            )
+
+    def get(self, accession: str) -> tp.Optional[AccessionState]:
+        with contextlib.closing(database.connect(self.path)) as connection:
+            row = connection.execute(
+                "SELECT accession, state, attempts, size, bytes, last_error, updated "
+                "FROM accessions WHERE accession = ?",
+                (accession,),
+            ).fetchone()
+        return AccessionState(*row) if row is not None else None
+
+    def states(self) -> dict[str, str]:
+        """States of all known accessions."""
+        with contextlib.closing(database.connect(self.path)) as connection:
+            return dict(connection.execute("SELECT accession, state FROM accessions").fetchall())
+
+    def summary(self) -> dict[str, int]:
+        """Number of accessions in every state."""
+        with contextlib.closing(database.connect(self.path)) as connection:
+            return dict(
+                connection.execute(
+                    "SELECT state, COUNT(*) FROM accessions GROUP BY state ORDER BY state"
+                ).fetchall()
+            )
+
+    def _create_schema(self) -> None:
+        with database.transaction(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS accessions ("
+                "accession TEXT PRIMARY KEY, "
+                "state TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "size INTEGER, "
+                "bytes INTEGER, "
+                "last_error TEXT, "
+                "updated REAL NOT NULL)"
+            )
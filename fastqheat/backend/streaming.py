@@ -0,0 +1,175 @@
+import logging
+import sys
+import threading
+import typing as tp
+import zlib
+
+from fastqheat.exceptions import StreamError, ValidationError
+
+logger = logging.getLogger("fastqheat.backend.streaming")
+
+STDOUT = '-'
+
+
+class StreamTargets:
+    """
+    Stdout or pre-created named pipes (FIFOs) that runs are streamed to instead of files.
+
+    With a single target everything goes there, with two targets the first mates go to the first
+    one and the second mates to the second one, e.g. for `bwa mem ref.fa r1.fifo r2.fifo`.
+    A FIFO is opened when the first data is written to it, which blocks until the reader has
+    opened it too. All runs are written one after another, targets are closed at the very end.
+    """
+
+    def __init__(self, targets: tp.Sequence[str]):
+        if not 1 <= len(targets) <= 2:
+            raise ValueError("Runs can be streamed to one or two targets")
+        self.targets = list(targets)
+        self._files: dict[int, tp.BinaryIO] = {}
+        self._closed: set[int] = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def write(self, index: int, data: bytes) -> None:
+        try:
+            self._open(index).write(data)
+        except BrokenPipeError as exc:
+            raise StreamError(f"{self._name(index)} has been closed by its reader") from exc
+
+    def flush(self) -> None:
+        for index, file in list(self._files.items()):
+            try:
+                file.flush()
+            except BrokenPipeError as exc:
+                raise StreamError(f"{self._name(index)} has been closed by its reader") from exc
+
+    def close(self, index: tp.Optional[int] = None) -> None:
+        """Close a target (all of them by default), its reader gets the end of the stream."""
+        indexes = range(len(self.targets)) if index is None else [index]
+        for index in indexes:
+            with self._lock:
+                self._closed.add(index)
+                file = self._files.pop(index, None)
+            if file is None:
+                continue
+            try:
+                if file is sys.stdout.buffer:
+                    file.flush()
+                else:
+                    file.close()
+            except BrokenPipeError:
+                logger.debug("%s has already been closed by its reader", self._name(index))
+
+    def _open(self, index: int) -> tp.BinaryIO:
+        with self._lock:
+            if index in self._closed:
+                raise StreamError(f"{self._name(index)} has been closed")
+            if index not in self._files:
+                target = self.targets[index]
+                logger.debug("Opening %s", self._name(index))
+                self._files[index] = sys.stdout.buffer if target == STDOUT else open(target, 'wb')
+            return self._files[index]
+
+    def _name(self, index: int) -> str:
+        return "stdout" if self.targets[index] == STDOUT else self.targets[index]
+
+
+def gunzip(chunks: tp.Iterable[bytes], cut_off: bool = False) -> tp.Iterator[bytes]:
+    """
+    Decompress a gzip stream of one or more members, e.g. of several concatenated files.
+
+    A stream that ends in the middle of a member is an error, unless it has been `cut_off` on
+    purpose: then the data decompressed so far is all there is.
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    # whether the current member has got any input
+    started = False
+    for chunk in chunks:
+        while chunk:
+            started = True
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            started = False
+    if started and not cut_off:
+        raise ValidationError("gzip stream is truncated")
+
+
+class _FastqLines:
+    """Lines of complete FASTQ records read from a stream of decompressed chunks."""
+
+    def __init__(self, chunks: tp.Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._lines: list[bytes] = []
+        # the unfinished last line of the chunks read so far
+        self._rest = b''
+        self.finished = False
+
+    @property
+    def records(self) -> int:
+        return len(self._lines) // 4
+
+    def read(self) -> None:
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self.finished = True
+            # the last record may lack the final newline
+            if self._rest:
+                self._lines.append(self._rest)
+                self._rest = b''
+            if len(self._lines) % 4:
+                raise ValidationError("FASTQ stream ends with a truncated record")
+            return
+        lines = (self._rest + chunk).split(b'\n')
+        self._rest = lines.pop()
+        self._lines += lines
+
+    def take(self, records: int) -> list[bytes]:
+        taken = self._lines[: 4 * records]
+        del self._lines[: 4 * records]
+        return taken
+
+
+def paired_records(
+    first: tp.Iterable[bytes], second: tp.Iterable[bytes], until_first_ends: bool = False
+) -> tp.Iterator[tuple[list[bytes], list[bytes]]]:
+    """
+    Read two decompressed FASTQ streams of mates in lockstep.
+
+    Yields lines of the same number of records of both mates. Both streams must have the same
+    number of records, unless `until_first_ends`: then the second one is read only as far as the
+    first one goes, e.g. when the first one has been cut off.
+    """
+    mates = (_FastqLines(first), _FastqLines(second))
+    while True:
+        for mate in mates:
+            while not mate.records and not mate.finished:
+                mate.read()
+        records = min(mate.records for mate in mates)
+        if not records:
+            if until_first_ends and mates[0].finished and not mates[0].records:
+                return
+            if any(mate.records for mate in mates):
+                raise ValidationError("Mates have different numbers of reads")
+            return
+        yield mates[0].take(records), mates[1].take(records)
+
+
+def interleave(first: tp.Iterable[bytes], second: tp.Iterable[bytes]) -> tp.Iterator[bytes]:
+    """
+    Interleave records of two decompressed FASTQ streams of mates: 1st of the first, 1st of the
+    second, 2nd of the first and so on. Both streams must have the same number of records.
+    """
+    for first_lines, second_lines in paired_records(first, second):
+        # every group of 8 lines is a record of the first mate and a record of the second one
+        lines: list[bytes] = [b''] * (2 * len(first_lines))
+        for offset, taken in enumerate((first_lines, second_lines)):
+            for line in range(4):
+                lines[4 * offset + line :: 8] = taken[line::4]
+        yield b'\n'.join(lines) + b'\n'
@@ -0,0 +1,70 @@
+import dataclasses
+import random
+import typing as tp
+
+
+@dataclasses.dataclass(frozen=True)
+class ReadTransforms:
+    """Transforms applied to the reads of ENA runs while they are downloaded."""
+
+    # reads shorter than this are dropped, with their mates
+    min_length: tp.Optional[int] = None
+    # fraction of the reads (pairs of reads) kept, chosen at random
+    fraction: tp.Optional[float] = None
+    # the same seed keeps the same reads of a run
+    seed: int = 0
+    # the read name is removed from the "+" line of every record
+    strip_quality_headers: bool = False
+
+    @property
+    def enabled(self) -> bool:
+        return (
+            self.min_length is not None or self.fraction is not None or self.strip_quality_headers
+        )
+
+    def describe(self) -> dict[str, tp.Any]:
+        return dataclasses.asdict(self)
+
+
+class RecordFilter:
+    """
+    Applies the transforms to the records of a file, or of two mates in lockstep.
+
+    A record is kept only together with its mate, so the mates stay in sync. Subsampling is
+    deterministic: the random choice depends on the seed, the run and the number of the record.
+    """
+
+    def __init__(self, transforms: ReadTransforms, key: str):
+        self.transforms = transforms
+        self._random = random.Random(f'{transforms.seed}:{key}')
+        # records (pairs of records) read and kept
+        self.records_in = 0
+        self.records_out = 0
+
+    def __call__(self, mates: tp.Sequence[list[bytes]]) -> list[list[bytes]]:
+        """Transform lines of the same number of records of every mate."""
+        transforms = self.transforms
+        records = len(mates[0]) // 4
+        keep = [True] * records
+        if transforms.min_length is not None:
+            for lines in mates:
+                for i, sequence in enumerate(lines[1::4]):
+                    if len(sequence) < transforms.min_length:
+                        keep[i] = False
+        if transforms.fraction is not None:
+            # drawn for every record, so that the choice does not depend on the length filter
+            for i in range(records):
+                if self._random.random() >= transforms.fraction:
+                    keep[i] = False
+        self.records_in += records
+        self.records_out += sum(keep)
+        if all(keep) and not transforms.strip_quality_headers:
+            return list(mates)
+
+        result = []
+        for lines in mates:
+            kept = [line for i, line in enumerate(lines) if keep[i // 4]]
+            if transforms.strip_quality_headers:
+                kept[2::4] = [b'+'] * (len(kept) // 4)
+            result.append(kept)
+        return result
@@ -0,0 +1,90 @@
+import concurrent.futures
+import logging
+import threading
+import typing as tp
+
+from fastqheat.config import config
+
+logger = logging.getLogger("fastqheat.backend.verification")
+
+
+class VerificationStage:
+    """
+    Runs checks of downloaded files (hashing, line counting) in background threads.
+
+    Download workers submit a check as soon as a file is downloaded and move on to the next
+    transfer, so the network and the disk are busy at the same time. The queue of checks is
+    bounded: when the checks fall behind, submit() blocks and downloads wait for them instead of
+    filling the disk with unchecked files.
+
+    Usage example:
+
+    verification = VerificationStage()
+    checks = [verification.submit(check_md5, path, md5) for path, md5 in downloaded_files]
+    accession_check = all_of(checks, on_success=lambda: logger.info("Verified"))
+    """
+
+    def __init__(
+        self,
+        workers: int = config.VERIFICATION_WORKERS,
+        queue_size: int = config.VERIFICATION_QUEUE_SIZE,
+    ):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="verification"
+        )
+        # checks that are running or waiting in the queue
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, fn: tp.Callable[..., tp.Any], *args: tp.Any) -> concurrent.futures.Future:
+        """Schedule a check, waiting while the queue is full."""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+def all_of(
+    futures: tp.Sequence[concurrent.futures.Future],
+    on_success: tp.Optional[tp.Callable[[], None]] = None,
+) -> concurrent.futures.Future:
+    """
+    Return a future that is done when all `futures` are done.
+
+    It fails with the exception of the first failed future in `futures` order, so that errors
+    are reported the same way as if the checks had run one by one. Otherwise `on_success` is
+    called and its exception, if any, fails the future.
+    """
+    result: concurrent.futures.Future = concurrent.futures.Future()
+    remaining = len(futures)
+    lock = threading.Lock()
+
+    def finish() -> None:
+        for future in futures:
+            if (error := future.exception()) is not None:
+                result.set_exception(error)
+                return
+        try:
+            if on_success is not None:
+                on_success()
+        except BaseException as err:
+            result.set_exception(err)
+        else:
+            result.set_result(None)
+
+    def on_done(_: concurrent.futures.Future) -> None:
+        nonlocal remaining
+        with lock:
+            remaining -= 1
+            if remaining:
+                return
+        finish()
+
+    if not futures:
+        finish()
+    for future in futures:
+        future.add_done_callback(on_done)
+    return result
@@ -1,6 +1,10 @@
+import json
 import logging
+import os
+import shutil
 import subprocess
 import typing as tp
+from pathlib import Path
 
 import click
 
@@ -18,15 +22,96 @@ class OrderedOptsCommand(click.Command):
         return sorted(params, key=lambda x: getattr(x, 'order', 10000))
 
 
+# entries for other PATHs (e.g. other conda environments) are dropped beyond this number
+BINARY_CACHE_MAX_ENTRIES = 64
+
+
+class BinaryCache:
+    """
+    Results of successful binary checks, kept between invocations of FastqHeat.
+
+    An entry is keyed by the program and PATH, and is valid while the binary found on PATH is
+    the same file with the same size and modification time. The cache is a JSON file in the
+    user cache directory, a missing or corrupt file is treated as empty.
+    """
+
+    def __init__(self, path: tp.Optional[Path] = None):
+        self.path = path or self.default_path()
+
+    @staticmethod
+    def default_path() -> Path:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+        return Path(cache_home, 'fastqheat', 'binaries.json')
+
+    @staticmethod
+    def signature(program_name: str) -> tp.Optional[list]:
+        """Resolved path, size and mtime of the binary found on PATH, None if there is none."""
+        found = shutil.which(program_name)
+        if found is None:
+            return None
+        path = os.path.realpath(found)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return [path, stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def key(program_name: str) -> str:
+        return f"{program_name}:{os.environ.get('PATH', '')}"
+
+    def get(self, program_name: str, signature: list) -> tp.Optional[str]:
+        entry = self._load().get(self.key(program_name))
+        if not isinstance(entry, dict) or entry.get('signature') != signature:
+            return None
+        return entry.get('version')
+
+    def put(self, program_name: str, signature: list, version: str) -> None:
+        entries = self._load()
+        entries.pop(self.key(program_name), None)
+        entries[self.key(program_name)] = {'signature': signature, 'version': version}
+        while len(entries) > BINARY_CACHE_MAX_ENTRIES:
+            del entries[next(iter(entries))]
+        # written atomically, FastqHeat may be started many times at once
+        temp_path = self.path.with_name(f'.{self.path.name}.{os.getpid()}')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path.write_text(json.dumps(entries))
+            os.replace(temp_path, self.path)
+        except OSError as exc:
+            logging.debug("Cannot write the binary cache %s: %s", self.path, exc)
+
+    def _load(self) -> dict:
+        try:
+            entries = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+
 def check_binary_available(
     program_name: str,
     exception_cls: tp.Type[Exception] = click.UsageError,
     exception_kwargs: tp.Optional[dict] = None,
-) -> None:
+) -> str:
+    """
+    Check that the program can be run, return the first line of its `--version` output.
+
+    Successful checks are cached in BinaryCache, so the program is started again only when it
+    has changed or PATH is different.
+    """
     if exception_kwargs is None:
         exception_kwargs = dict()
+    cache = BinaryCache()
+    signature = cache.signature(program_name)
+    if signature is not None:
+        version = cache.get(program_name, signature)
+        if version is not None:
+            return version
     try:
-        subprocess.run([program_name, '--version'], text=True, capture_output=True, check=True)
+        result = subprocess.run(
+            [program_name, '--version'], text=True, capture_output=True, check=True
+        )
     except FileNotFoundError as exc:
         raise exception_cls(
             f"""Unable to run "{program_name}": File not found.""",
@@ -38,3 +123,9 @@ def check_binary_available(
         raise exception_cls(
             f"""Unable to run "{program_name}": {message}""", **exception_kwargs  # noqa
         ) from exc
+
+    # some programs print their version to stderr
+    version = (result.stdout.strip() or result.stderr.strip()).partition('\n')[0]
+    if signature is not None:
+        cache.put(program_name, signature, version)
+    return version
@@ -1,3 +1,4 @@
+import typing as tp
 from configparser import ConfigParser
 from importlib.resources import files
 from pathlib import Path
@@ -5,6 +6,7 @@ from pathlib import Path
 import click
 
 from fastqheat.click_utils import check_binary_available
+from fastqheat.utility import parse_size
 
 
 class FastQHeatConfigParser(ConfigParser):
@@ -76,6 +78,21 @@ class FastQHeatConfigParser(ConfigParser):
     def ncbi_binary_path(self) -> str:
         return self['NCBI']['FasterQDump']
 
+    @property
+    def ncbi_scratch_directory(self) -> tp.Optional[Path]:
+        path = self['NCBI'].get('ScratchDirectory')
+        return Path(path) if path else None
+
+    @property
+    def ena_cache_directory(self) -> tp.Optional[Path]:
+        path = self['ENA'].get('CacheDirectory')
+        return Path(path) if path else None
+
+    @property
+    def ena_cache_max_size(self) -> tp.Optional[int]:
+        size = self['ENA'].get('CacheMaxSize')
+        return parse_size(size) if size else None
+
 
 class _Config:
     DEFAULT_MAX_ATTEMPTS: int = 2
@@ -85,5 +102,97 @@ class _Config:
     # What is the limit or sweet spot - we have not tested yet
     METADATA_DOWNLOAD_SIMULTANEOUS_CONNECTIONS_NUMBER: int = 5
 
+    # How many requests we make simultaneously to ENA API when getting sizes of runs for scheduling
+    RUN_SIZE_SIMULTANEOUS_CONNECTIONS_NUMBER: int = 5
+
+    # Rate passed to `ascp -l` when no bandwidth budget is set
+    DEFAULT_ASPERA_RATE: str = '300m'
+    # How often (in seconds) at most the bandwidth control file is checked for changes
+    BANDWIDTH_CONTROL_FILE_POLL_INTERVAL: float = 1.0
+
+    # With the auto transport every n-th file is downloaded by the slower transport
+    # to keep its throughput estimate up to date
+    TRANSPORT_REPROBE_INTERVAL: int = 20
+    # Weight of the latest measurement in the moving average of a transport throughput
+    TRANSPORT_THROUGHPUT_SMOOTHING: float = 0.3
+
+    # Disk space needed to process a run relative to the size of its FASTQ files in ENA.
+    # NCBI runs need space for fasterq-dump temporary files, uncompressed FASTQ files
+    # and compressed ones at the same time.
+    ENA_DISK_SPACE_MULTIPLIER: float = 1.05
+    NCBI_DISK_SPACE_MULTIPLIER: float = 10.0
+    # How often (in seconds) a run waiting for disk space re-checks the free space
+    DISK_SPACE_POLL_INTERVAL: float = 30.0
+
+    # Threads checking downloaded files while the next files are downloaded, and how many
+    # downloaded files may wait for them
+    VERIFICATION_WORKERS: int = 2
+    VERIFICATION_QUEUE_SIZE: int = 4
+
+    # fasterq-dump does not get faster beyond a few threads, the rest of the CPU budget goes to
+    # other runs downloaded at the same time and to pigz
+    FASTERQ_DUMP_MAX_THREADS: int = 8
+    # How many .sra files fetched by prefetch may wait for fasterq-dump, and the directory (in the
+    # working directory) where they are kept
+    SRA_CACHE_RUNS: int = 4
+    SRA_CACHE_DIRECTORY_NAME: str = '.sra_cache'
+
+    # Compression level of BGZF output, and how many reads apart the entries of its read index are
+    BGZF_COMPRESSION_LEVEL: int = 6
+    BGZF_READ_INDEX_INTERVAL: int = 10000
+
+    # ENA files sampled (--max-reads, --max-bytes) or filtered while they are downloaded, and
+    # sharded files, are re-compressed with this gzip compression level
+    SAMPLE_COMPRESSION_LEVEL: int = 6
+
+    # Runs split into a number of shards (--shards) go to them in blocks of this many reads.
+    # Written files are gzip members of about SHARD_MEMBER_SIZE uncompressed bytes each, compressed
+    # by SHARD_COMPRESSION_THREADS threads per ENA run (NCBI runs use their share of the CPUs).
+    SHARD_BLOCK_READS: int = 10000
+    SHARD_MEMBER_SIZE: int = 4 * 1024 * 1024
+    SHARD_COMPRESSION_THREADS: int = 4
+
+    # FASTQ files are checked in chunks of this many bytes
+    FASTQ_SCAN_CHUNK_SIZE: int = 8 * 1024 * 1024
+
+    # How many accessions are read from the input ahead of the downloads
+    ACCESSION_QUEUE_SIZE: int = 1000
+
+    # Longest wait (in seconds) between retries, both of a single request and of an accession
+    RETRY_MAX_INTERVAL: float = 600.0
+    # How many times an accession that has failed with a transient error is put back into the
+    # queue to be retried later, and the initial delay (in seconds) before the first such retry
+    DEFERRED_RETRIES: int = 2
+    DEFERRED_RETRY_INTERVAL: float = 30.0
+
+    # How long (in seconds) an accession claimed from a shared job store stays claimed without
+    # a heartbeat from its node. Heartbeats are sent every third of this time.
+    JOB_LEASE_DURATION: float = 300.0
+    # How often (in seconds) a node that has nothing left to claim checks whether the accessions
+    # claimed by other nodes are done or their leases have expired
+    JOB_STORE_POLL_INTERVAL: float = 30.0
+    # How long (in seconds) to wait for a lock on an SQLite database (job store, accession state)
+    SQLITE_BUSY_TIMEOUT: float = 60.0
+
+    # File in the working directory where the state of every accession is kept
+    STATE_FILE_NAME: str = '.fastqheat_state.sqlite'
+
+    # Directory in the working directory with the locks of the runs being downloaded. A lock that
+    # has not been touched for RUN_LOCK_STALE_TIMEOUT seconds is stale (its owner touches it every
+    # third of this time). Processes waiting for a lock check it every RUN_LOCK_POLL_INTERVAL.
+    RUN_LOCK_DIRECTORY: str = '.fastqheat_locks'
+    RUN_LOCK_STALE_TIMEOUT: float = 300.0
+    RUN_LOCK_POLL_INTERVAL: float = 5.0
+
+    # Files are uploaded to S3 in parts of this many bytes, the part size doubles every
+    # S3_PART_SIZE_DOUBLING parts to stay within the limit of 10000 parts. Up to
+    # S3_PARTS_IN_FLIGHT parts of a file are uploaded while the next part is downloaded.
+    S3_PART_SIZE: int = 16 * 1024 * 1024
+    S3_PART_SIZE_DOUBLING: int = 1000
+    S3_PARTS_IN_FLIGHT: int = 2
+
+    # Directory inside the working directory where Aspera batch sessions put files
+    ASPERA_STAGING_DIRECTORY: str = '.aspera_staging'
+
 
 config = _Config()
@@ -8,3 +8,15 @@ class ENAClientError(Exception):
 
 class AccessionCheckerException(Exception):
     pass
+
+
+class InsufficientDiskSpaceError(Exception):
+    pass
+
+
+class StreamError(Exception):
+    pass
+
+
+class RunLockedError(Exception):
+    pass
@@ -0,0 +1,146 @@
+import cProfile
+import io
+import logging
+import pstats
+import resource
+import subprocess
+import threading
+import time
+import typing as tp
+from collections import defaultdict
+from pathlib import Path
+
+import click
+
+from fastqheat import typing_helpers as th
+
+logger = logging.getLogger("fastqheat.profiling")
+
+
+def _program_name(args: tp.Sequence[tp.Any], kwargs: dict[str, tp.Any]) -> str:
+    """Return the name of the program `subprocess.run` was asked to launch."""
+    command = args[0] if args else kwargs.get('args')
+    if isinstance(command, (str, bytes)):
+        command = str(command).split()
+    if not command:
+        return '<unknown>'
+    return Path(str(command[0])).name
+
+
+class Profiler:
+    """
+    Deterministic profiler for a whole CLI invocation.
+
+    Usage example:
+
+    with Profiler('fastqheat.prof', top=25):
+        run_the_command()
+
+    cProfile runs in the main thread and in every thread started while the profiler is active.
+    On exit raw stats of all threads are merged and dumped to `output_path` (it can be inspected
+    with `python -m pstats` or snakeviz), and a human-readable summary is printed to stderr and
+    saved next to it with a `.txt` suffix.
+
+    Besides the usual per-function table, the summary reports the time spent waiting for external
+    tools started via `subprocess.run` (ascp, fasterq-dump, pigz, ...) grouped by program name,
+    separately from the CPU time used by the Python process itself.
+    """
+
+    def __init__(self, output_path: th.PathType, top: int = 25):
+        self.output_path = Path(output_path)
+        self.top = top
+
+        self._profiles: list[cProfile.Profile] = []
+        self._profiles_lock = threading.Lock()
+        self._subprocess_wall: dict[str, float] = defaultdict(float)
+        self._subprocess_calls: dict[str, int] = defaultdict(int)
+        self._original_run: tp.Callable = subprocess.run
+
+        self._wall_start = 0.0
+        self._cpu_start = 0.0
+        self._children_cpu_start = 0.0
+
+    def __enter__(self) -> 'Profiler':
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._children_cpu_start = self._get_children_cpu_time()
+
+        self._original_run = subprocess.run
+        subprocess.run = self._timed_run
+        threading.setprofile(self._start_thread_profile)
+
+        self._start_profile()
+        logger.debug("Profiling enabled. Stats will be written to %s", self.output_path)
+        return self
+
+    def __exit__(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        main_profile = self._profiles[0]
+        main_profile.disable()
+        threading.setprofile(None)
+        subprocess.run = self._original_run
+
+        wall_time = time.perf_counter() - self._wall_start
+        cpu_time = time.process_time() - self._cpu_start
+        children_cpu_time = self._get_children_cpu_time() - self._children_cpu_start
+
+        stats_stream = io.StringIO()
+        with self._profiles_lock:
+            stats = pstats.Stats(*self._profiles, stream=stats_stream)
+        stats.dump_stats(self.output_path)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+
+        summary = self._make_summary(wall_time, cpu_time, children_cpu_time)
+        summary_path = self.output_path.with_name(f"{self.output_path.name}.txt")
+        summary_path.write_text(f"{summary}\n\n{stats_stream.getvalue()}")
+
+        click.echo(summary, err=True)
+        click.echo(f"Profile stats: {self.output_path}\nFull summary: {summary_path}", err=True)
+
+    def _start_profile(self) -> None:
+        profile = cProfile.Profile()
+        with self._profiles_lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    @tp.no_type_check
+    def _start_thread_profile(self, frame, event, arg) -> None:
+        # Called by the interpreter as a profile function on the first event of every new thread.
+        # Enabling cProfile replaces this hook for the thread with the real profiler.
+        self._start_profile()
+
+    @tp.no_type_check
+    def _timed_run(self, *args, **kwargs) -> subprocess.CompletedProcess:
+        program = _program_name(args, kwargs)
+        start = time.perf_counter()
+        try:
+            return self._original_run(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._profiles_lock:
+                self._subprocess_wall[program] += elapsed
+                self._subprocess_calls[program] += 1
+
+    @staticmethod
+    def _get_children_cpu_time() -> float:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    def _make_summary(self, wall_time: float, cpu_time: float, children_cpu_time: float) -> str:
+        subprocess_wall = sum(self._subprocess_wall.values())
+        lines = [
+            "Profile summary",
+            f"  Wall time:                       {wall_time:10.2f}s",
+            f"  In-process CPU time:             {cpu_time:10.2f}s",
+            f"  Waiting for external tools:      {subprocess_wall:10.2f}s",
+        ]
+        for program, seconds in sorted(
+            self._subprocess_wall.items(), key=lambda item: item[1], reverse=True
+        ):
+            calls = self._subprocess_calls[program]
+            lines.append(f"    {program:<31}{seconds:10.2f}s ({calls} calls)")
+        lines.append(f"  CPU time of external tools:      {children_cpu_time:10.2f}s")
+        lines.append(
+            f"  Other (network, disk, idle):     "
+            f"{max(wall_time - cpu_time - subprocess_wall, 0.0):10.2f}s"
+        )
+        return "\n".join(lines)
@@ -1,5 +1,15 @@
+import errno
 import os
+import queue
+import re
+import shutil
+import threading
+import typing as tp
 from enum import Enum
+from pathlib import Path
+
+SIZE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', re.IGNORECASE)
+SIZE_UNITS = ['', 'K', 'M', 'G', 'T']
 
 
 class BaseEnum(str, Enum):
@@ -18,3 +28,92 @@ def get_cpu_cores_count() -> int:
             # For now we only use it to pass to fasterq-dump and to pigz external utilities.
             # pigz uses 8 threads by default. fasterq-dump uses 6, so 4 feels like a safe option
             return 4
+
+
+def parse_size(value: str) -> int:
+    """Parse a size like "500M" or "10G" (powers of 1024) into bytes."""
+    match = SIZE_PATTERN.match(value)
+    if not match:
+        raise ValueError(f"Invalid size: {value!r}. Expected something like '10G'")
+
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** SIZE_UNITS.index(unit.upper()))
+
+
+def format_size(size: float) -> str:
+    """Format a size in bytes for humans, e.g. 1536 -> '1.5K'."""
+    for unit in SIZE_UNITS[:-1]:
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}" if unit else f"{int(size)}"
+        size /= 1024
+    return f"{size:.1f}{SIZE_UNITS[-1]}"
+
+
+_T = tp.TypeVar('_T')
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def prefetch(iterable: tp.Iterable[_T], maxsize: int) -> tp.Iterator[_T]:
+    """
+    Iterate in a background thread, keeping up to `maxsize` items ready for the consumer.
+
+    Slow producers (e.g. ones that make network requests) run ahead of the consumer, while the
+    bounded queue keeps memory flat when the consumer is the slower one. Exceptions are re-raised
+    in the consumer.
+    """
+    items: queue.Queue = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item: tp.Any) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as err:
+            put(_Failure(err))
+            return
+        put(_DONE)
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while (item := items.get()) is not _DONE:
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        # the consumer may stop early, the producer should not wait for it forever
+        stop.set()
+
+
+def move_file(source: Path, target: Path) -> None:
+    """
+    Move a file, renaming it when both paths are on the same file system.
+
+    Otherwise the file is copied next to the target under a temporary name and renamed, so that
+    the target never holds a partially copied file.
+    """
+    try:
+        os.replace(source, target)
+        return
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+    partial = target.with_name(f'{target.name}.partial')
+    shutil.copyfile(source, partial)
+    os.replace(partial, target)
+    source.unlink()
@@ -0,0 +1,56 @@
+import gzip
+import importlib
+import subprocess
+from pathlib import Path
+
+import pytest
+
+import fastqheat
+from fastqheat.backend.ena.ena_api_client import ENAClient
+from fastqheat.backend.retry import RetryPolicy
+
+ncbi_download_module = importlib.import_module("fastqheat.backend.ncbi.download")
+
+FASTQ = "@read\nACGT\n+\nFFFF\n"
+
+
+def fake_run(command, check):
+    if command[0] == 'fasterq-dump':
+        if command[1] == 'SRR0000002':
+            raise subprocess.CalledProcessError(3, command)
+        Path(command[3], f'{command[1]}.fastq').write_text(FASTQ)
+    elif command[0] == 'pigz':
+        for path in command[3:]:
+            path.with_name(f'{path.name}.gz').write_bytes(gzip.compress(path.read_bytes()))
+            path.unlink()
+
+
+async def test_fetch(tmp_path, mocker):
+    mocker.patch.object(ncbi_download_module.subprocess, "run", side_effect=fake_run)
+    mocker.patch.object(ENAClient, "get_read_and_base_count", return_value=(1, 4))
+
+    results = [
+        result
+        async for result in fastqheat.fetch(
+            ['SRR0000001', 'SRR0000002'],
+            working_dir=tmp_path,
+            backend='ncbi',
+            attempts=1,
+            core_count=1,
+            retry_policy=RetryPolicy(deferred_retries=0),
+        )
+    ]
+
+    successful, failed = sorted(results, key=lambda result: result.accession)
+    assert successful.success and successful.read_count == 1 and successful.elapsed > 0
+    assert [file.path for file in successful.files] == [
+        tmp_path / 'SRR0000001' / 'SRR0000001.fastq.gz'
+    ]
+    assert successful.size == (tmp_path / 'SRR0000001' / 'SRR0000001.fastq.gz').stat().st_size
+    assert not failed.success and failed.files == [] and 'fasterq-dump' in failed.error
+
+
+async def test_fetch_invalid_accession(tmp_path):
+    with pytest.raises(ValueError):
+        async for _ in fastqheat.fetch(['not an accession'], working_dir=tmp_path):
+            pass
@@ -0,0 +1,123 @@
+import threading
+
+import pytest
+
+from fastqheat.backend import accessions as accessions_module
+from fastqheat.backend.accessions import AccessionSource
+from fastqheat.backend.common import BaseDownloadClient
+from fastqheat.exceptions import ENAClientError
+from fastqheat.utility import prefetch
+
+STUDIES = {'SRP000001': ['SRR0000011', 'SRR0000012']}
+
+
+class FakeENAClient:
+    resolved: list = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_srr_ids_from_srp(self, term):
+        self.resolved.append(term)
+        if term not in STUDIES:
+            raise ENAClientError(f"ENA API returned no data for the accession: {term}")
+        return STUDIES[term]
+
+
+@pytest.fixture(autouse=True)
+def fake_ena_client(mocker):
+    FakeENAClient.resolved = []
+    mocker.patch.object(accessions_module, "ENAClient", FakeENAClient)
+
+
+def test_accession_source(tmp_path):
+    accession_file = tmp_path / 'accessions.txt'
+    accession_file.write_text("SRR0000002\n\nSRP000001\nSRP000002\nERR0000003\n")
+    source = AccessionSource(terms=['SRR0000001'], files=[accession_file])
+
+    source.validate()
+    assert list(source) == ['SRR0000001', 'SRR0000002', 'SRR0000011', 'SRR0000012', 'ERR0000003']
+    # the source can be iterated again
+    assert len(list(source)) == 5
+
+
+def test_studies_are_resolved_lazily():
+    runs = iter(AccessionSource(terms=['SRR0000001', 'SRP000001']))
+
+    assert next(runs) == 'SRR0000001'
+    assert FakeENAClient.resolved == []
+    assert next(runs) == 'SRR0000011'
+    assert FakeENAClient.resolved == ['SRP000001']
+
+
+def test_unknown_pattern(tmp_path):
+    accession_file = tmp_path / 'accessions.txt'
+    accession_file.write_text("SRR0000001\nfoo\n")
+
+    with pytest.raises(ValueError, match="foo"):
+        AccessionSource(files=[accession_file]).validate()
+
+
+def test_prefetch_is_bounded():
+    produced = []
+
+    def produce():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    items = prefetch(produce(), maxsize=5)
+    assert next(items) == 0
+    threading.Event().wait(0.1)
+    # one item has been consumed, 5 are in the queue and one is waiting to be put there
+    assert len(produced) <= 7
+    assert list(items) == list(range(1, 100))
+
+
+def test_prefetch_reraises_errors():
+    def produce():
+        yield 1
+        raise ValueError("broken input")
+
+    items = prefetch(produce(), maxsize=5)
+    assert next(items) == 1
+    with pytest.raises(ValueError, match="broken input"):
+        next(items)
+
+
+class RecordingDownloadClient(BaseDownloadClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.first_download_started = threading.Event()
+        self.downloaded = []
+
+    def download_one_accession(self, accession):
+        self.first_download_started.set()
+        self.downloaded.append(accession)
+
+
+def test_download_starts_before_the_input_is_read(tmp_path):
+    client = RecordingDownloadClient(tmp_path, 1, 0, skip_check=False)
+    started_early = []
+
+    def slow_source():
+        yield 'SRR0000001'
+        started_early.append(client.first_download_started.wait(timeout=5))
+        yield 'SRR0000002'
+
+    successful = client.download_accession_list(slow_source())
+
+    assert successful == 2
+    assert started_early == [True]
+    assert client.downloaded == ['SRR0000001', 'SRR0000002']
+    assert client.num_accessions == 2
+
+
+def test_studies_are_resolved_once(tmp_path):
+    """Accessions read by the download are kept, the source is not iterated again."""
+    client = RecordingDownloadClient(tmp_path, 1, 0, skip_check=False)
+
+    assert client.download_accession_list(AccessionSource(terms=['SRR0000001', 'SRP000001'])) == 3
+
+    assert client.accessions == ['SRR0000001', 'SRR0000011', 'SRR0000012']
+    assert FakeENAClient.resolved == ['SRP000001']
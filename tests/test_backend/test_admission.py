@@ -0,0 +1,108 @@
+import concurrent.futures
+import threading
+
+import pytest
+
+from fastqheat.backend.admission import DiskSpaceAdmission
+from fastqheat.backend.common import BaseDownloadClient
+from fastqheat.backend.scheduler import WorkItem
+from fastqheat.exceptions import InsufficientDiskSpaceError
+from fastqheat.utility import format_size, parse_size
+
+
+@pytest.fixture
+def admission(tmp_path, mocker):
+    admission = DiskSpaceAdmission(tmp_path, min_free_space=100, multiplier=2, poll_interval=5)
+    mocker.patch.object(admission, "_get_free_space", return_value=1000)
+    return admission
+
+
+def test_reserve_and_release(admission):
+    with admission.reserve(WorkItem('SRR1', 0, size=200)):
+        assert admission._reserved == 400
+    assert admission._reserved == 0
+
+
+def test_run_that_never_fits_fails(admission):
+    with pytest.raises(InsufficientDiskSpaceError):
+        with admission.reserve(WorkItem('SRR1', 0, size=500)):
+            pass
+
+
+def test_run_waits_for_space(admission):
+    """A run that does not fit next to a run in progress starts once that run is done."""
+    started = threading.Event()
+    first_done = threading.Event()
+    order = []
+
+    def second_run():
+        started.wait()
+        with admission.reserve(WorkItem('SRR2', 1, size=300)):
+            order.append('SRR2')
+
+    thread = threading.Thread(target=second_run)
+    thread.start()
+    with admission.reserve(WorkItem('SRR1', 0, size=300)):
+        started.set()
+        thread.join(timeout=0.2)
+        assert thread.is_alive()  # 1000 - 600 reserved - 100 min free < 600 needed
+        order.append('SRR1')
+        first_done.set()
+    thread.join(timeout=5)
+
+    assert order == ['SRR1', 'SRR2']
+
+
+def test_unknown_size_is_admitted(admission):
+    with admission.reserve(WorkItem('SRR1', 0, size=None)):
+        assert admission._reserved == 0
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [("100", 100), ("1K", 1024), ("1.5G", int(1.5 * 1024**3)), ("2TB", 2 * 1024**4)],
+)
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+def test_format_size():
+    assert format_size(512) == "512"
+    assert format_size(1536) == "1.5K"
+    assert format_size(3 * 1024**3) == "3.0G"
+
+
+class VerifyingClient(BaseDownloadClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.verification_future = concurrent.futures.Future()
+
+    def download_one_accession(self, accession):
+        return self.verification_future
+
+
+def test_space_is_reserved_until_verified(tmp_path, mocker):
+    """Space of a run is released once its verification (e.g. NCBI compression) is done."""
+    client = VerifyingClient(tmp_path, 1, 0, skip_check=False, min_free_space=100)
+    admission = client.disk_space_admission
+    mocker.patch.object(admission, "_get_free_space", return_value=1000)
+    admission.poll_interval = 5
+
+    result = client._download_item(WorkItem('SRR1', 0, size=600))
+    assert result is client.verification_future
+    assert admission._reserved == 600
+
+    admitted = threading.Event()
+
+    def second_run():
+        with admission.reserve(WorkItem('SRR2', 1, size=600)):
+            admitted.set()
+
+    thread = threading.Thread(target=second_run)
+    thread.start()
+    assert not admitted.wait(timeout=0.2)
+
+    client.verification_future.set_result(None)
+    thread.join(timeout=5)
+    assert admitted.is_set()
+    assert admission._reserved == 0
@@ -0,0 +1,118 @@
+import contextlib
+import os
+
+import pytest
+
+from fastqheat.backend.bandwidth import BandwidthBudget, TokenBucket, parse_bandwidth
+from fastqheat.config import config
+
+
+class FakeClock:
+    """Clock for TokenBucket which only moves forward when the bucket sleeps."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("300m", 300_000_000),
+        ("1.5G", 1_500_000_000),
+        ("500k", 500_000),
+        ("1000", 1000),
+        ("unlimited", None),
+        ("0", None),
+        ("0m", None),
+        ("0k", None),
+        ("0.0", None),
+        (" 0.0G ", None),
+    ],
+)
+def test_parse_bandwidth(value, expected):
+    assert parse_bandwidth(value) == expected
+
+
+@pytest.mark.parametrize("value", ["fast", "10mb", "-5m"])
+def test_parse_bandwidth_invalid(value):
+    with pytest.raises(ValueError):
+        parse_bandwidth(value)
+
+
+def test_token_bucket_keeps_average_rate():
+    """Consuming 10 seconds worth of tokens takes ~10 seconds minus the initial burst."""
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1000, clock=clock, sleep=clock.sleep)
+
+    for _ in range(110):
+        bucket.consume(100)
+
+    # 1000 tokens of initial capacity + 1000 tokens/second for 10 seconds
+    assert clock.now == pytest.approx(10.0)
+
+
+def test_budget_splits_between_sessions():
+    """Aspera sessions get a fixed share of the budget, HTTP streams share the rest."""
+    budget = BandwidthBudget(max_bandwidth=800_000_000, max_sessions=4)
+
+    with budget.session(BandwidthBudget.ASPERA) as first_rate:
+        assert first_rate == "200000k"
+        with budget.session(BandwidthBudget.HTTP), budget.session(BandwidthBudget.HTTP):
+            with budget.session(BandwidthBudget.ASPERA) as second_rate:
+                assert second_rate == "200000k"
+                # two Aspera sessions take half of the budget, the rest is in bytes
+                assert budget._http_bucket.rate == 50_000_000
+        assert budget._http_bucket.rate == 75_000_000
+
+
+def test_aspera_sessions_stay_within_budget():
+    """Sessions started one after another do not exceed the budget together."""
+    budget = BandwidthBudget(max_bandwidth=300_000_000, max_sessions=3)
+
+    with contextlib.ExitStack() as stack:
+        rates = [stack.enter_context(budget.session(BandwidthBudget.ASPERA)) for _ in range(3)]
+        assert sum(parse_bandwidth(rate) for rate in rates) <= 300_000_000
+        # a new budget applies to new sessions, running ones keep their rate
+        budget.set_max_bandwidth(600_000_000)
+        assert rates == ["100000k"] * 3
+    with budget.session(BandwidthBudget.ASPERA) as rate:
+        assert rate == "200000k"
+
+
+def test_budget_unlimited():
+    budget = BandwidthBudget()
+    with budget.session(BandwidthBudget.ASPERA) as rate:
+        assert rate == config.DEFAULT_ASPERA_RATE
+    with budget.session(BandwidthBudget.HTTP):
+        assert budget._http_bucket is None
+
+
+def test_budget_control_file(tmp_path):
+    """The control file overrides the initial budget and is re-read when modified."""
+    control_file = tmp_path / "bandwidth"
+    control_file.write_text("100m\n")
+
+    budget = BandwidthBudget(max_bandwidth=300_000_000, control_file=control_file)
+    assert budget.max_bandwidth == 100_000_000
+
+    control_file.write_text("unlimited\n")
+    os.utime(control_file, (0, 0))  # make sure mtime differs on coarse-grained filesystems
+    budget._poll_control_file(force=True)
+    assert budget.max_bandwidth is None
+
+    control_file.write_text("100m\n")
+    os.utime(control_file, (1, 1))
+    budget._poll_control_file(force=True)
+    assert budget.max_bandwidth == 100_000_000
+
+    # zero with a suffix means no limit too, it does not stall the transfers
+    control_file.write_text("0m\n")
+    os.utime(control_file, (2, 2))
+    budget._poll_control_file(force=True)
+    assert budget.max_bandwidth is None
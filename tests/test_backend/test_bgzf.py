@@ -0,0 +1,82 @@
+import gzip
+import struct
+import zlib
+
+import pytest
+
+from fastqheat.backend import bgzf
+
+
+def _fastq(reads):
+    return b''.join(
+        f"@read{number}\n{'ACGT' * (number % 40 + 1)}\n+\n{'F' * 4 * (number % 40 + 1)}\n".encode()
+        for number in range(reads)
+    )
+
+
+@pytest.fixture
+def fastq_file(tmp_path):
+    path = tmp_path / 'SRR0000001.fastq'
+    path.write_bytes(_fastq(5000))
+    return path
+
+
+def test_compressed_file_is_gzip(fastq_file, tmp_path):
+    target = tmp_path / 'SRR0000001.fastq.gz'
+
+    bgzf.compress_file(fastq_file, target, threads=3)
+
+    assert gzip.decompress(target.read_bytes()) == fastq_file.read_bytes()
+    assert target.read_bytes().endswith(bgzf.EOF_BLOCK)
+
+
+def test_block_index(fastq_file, tmp_path):
+    target = tmp_path / 'SRR0000001.fastq.gz'
+
+    bgzf.compress_file(fastq_file, target, threads=2)
+
+    index = (tmp_path / 'SRR0000001.fastq.gz.gzi').read_bytes()
+    (entries,) = struct.unpack_from('<Q', index)
+    offsets = list(struct.iter_unpack('<2Q', index[8:]))
+    assert len(offsets) == entries > 1
+    # every entry is the start of a block, the last block starts after all the others
+    blocks = -(-len(_fastq(5000)) // bgzf.BLOCK_SIZE)
+    assert entries == blocks - 1
+    compressed = target.read_bytes()
+    for compressed_offset, uncompressed_offset in offsets:
+        data = zlib.decompressobj(31).decompress(compressed[compressed_offset:])
+        assert data == _fastq(5000)[uncompressed_offset : uncompressed_offset + len(data)]
+
+
+@pytest.mark.parametrize("size", [100, bgzf.BLOCK_SIZE, bgzf.BLOCK_SIZE + 100])
+def test_block_index_layout_of_bgzip(tmp_path, size):
+    """Like `bgzip --index`: no entry for the first block, one for every next block."""
+    data = (b"@r\nACGT\n+\nFFFF\n" * (size // 15 + 1))[:size]
+    source = tmp_path / 'SRR0000001.fastq'
+    source.write_bytes(data)
+    target = tmp_path / 'SRR0000001.fastq.gz'
+
+    bgzf.compress_file(source, target)
+
+    expected = struct.pack('<Q', 0)
+    if size > bgzf.BLOCK_SIZE:
+        first_block = bgzf.compress_block(data[: bgzf.BLOCK_SIZE])
+        expected = struct.pack('<Q', 1) + struct.pack('<2Q', len(first_block), bgzf.BLOCK_SIZE)
+    assert (tmp_path / 'SRR0000001.fastq.gz.gzi').read_bytes() == expected
+
+
+def test_read_index(fastq_file, tmp_path):
+    target = tmp_path / 'SRR0000001.fastq.gz'
+
+    bgzf.compress_file(fastq_file, target, read_index_interval=700)
+
+    compressed = target.read_bytes()
+    lines = (tmp_path / 'SRR0000001.fastq.gz.fqi').read_text().splitlines()
+    assert lines[0] == "read\tvirtual_offset"
+    assert [int(line.split()[0]) for line in lines[1:]] == list(range(0, 5000, 700))
+    for line in lines[1:]:
+        read, offset = map(int, line.split())
+        block_offset, offset_in_block = offset >> 16, offset & 0xFFFF
+        # decompress from the block, without reading the file from the start
+        data = zlib.decompressobj(31).decompress(compressed[block_offset:])
+        assert data[offset_in_block:].startswith(f"@read{read}\n".encode())
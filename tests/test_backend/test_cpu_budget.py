@@ -0,0 +1,37 @@
+import threading
+
+import pytest
+
+from fastqheat.backend.cpu_budget import CpuBudget
+
+
+def test_reserve_gives_what_is_left():
+    budget = CpuBudget(8)
+
+    with budget.reserve(6) as first, budget.reserve(6) as second:
+        assert (first, second) == (6, 2)
+        assert budget.available == 0
+
+    assert budget.available == 8
+
+
+def test_reserve_waits_for_a_free_thread():
+    budget = CpuBudget(1)
+    reserved = threading.Event()
+
+    def reserve():
+        with budget.reserve(1):
+            reserved.set()
+
+    with budget.reserve(1):
+        thread = threading.Thread(target=reserve)
+        thread.start()
+        assert not reserved.wait(0.1)
+
+    assert reserved.wait(1)
+    thread.join()
+
+
+def test_invalid_budget():
+    with pytest.raises(ValueError):
+        CpuBudget(0)
@@ -0,0 +1,149 @@
+import hashlib
+import importlib
+import os
+
+from fastqheat.backend.download_cache import CacheStats, DownloadCache
+from fastqheat.backend.ena.download import ENADownloadClient, TransportType
+from fastqheat.backend.state import StateStore
+
+# fastqheat.backend.ena.download attribute is shadowed by the download() function
+download_module = importlib.import_module("fastqheat.backend.ena.download")
+
+
+def _add(cache, tmp_path, data):
+    path = tmp_path / f"{len(data)}.fastq.gz"
+    path.write_bytes(data)
+    md5 = hashlib.md5(data).hexdigest()
+    cache.add(md5, path)
+    return md5
+
+
+def test_materialize_hard_link(tmp_path):
+    cache = DownloadCache(tmp_path / "cache")
+    md5 = _add(cache, tmp_path, b"reads")
+    target = tmp_path / "project" / "SRR1" / "SRR1.fastq.gz"
+
+    assert cache.materialize(md5, target)
+    assert not cache.materialize("0" * 32, tmp_path / "missing.fastq.gz")
+
+    assert target.read_bytes() == b"reads"
+    assert target.stat().st_nlink == 3
+    assert cache.stats == CacheStats(hits=1, misses=1, bytes_saved=5)
+    assert cache.total_stats() == cache.stats
+
+
+def test_materialize_falls_back_to_symlink(tmp_path, mocker):
+    cache = DownloadCache(tmp_path / "cache")
+    md5 = _add(cache, tmp_path, b"reads")
+    mocker.patch.object(os, "link", side_effect=PermissionError("Operation not permitted"))
+    mocker.patch.object(DownloadCache, "_reflink", side_effect=OSError("Not supported"))
+    target = tmp_path / "SRR1.fastq.gz"
+
+    assert cache.materialize(md5, target)
+
+    assert target.is_symlink()
+    assert target.read_bytes() == b"reads"
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    cache = DownloadCache(tmp_path / "cache", max_size=10)
+    first = _add(cache, tmp_path, b"1234")
+    second = _add(cache, tmp_path, b"12345")
+    # the first file becomes the most recently used one
+    assert cache.materialize(first, tmp_path / "first.fastq.gz")
+
+    _add(cache, tmp_path, b"123456")
+
+    assert not cache.materialize(second, tmp_path / "second.fastq.gz")
+    assert cache.materialize(first, tmp_path / "first.fastq.gz")
+    assert cache.size() == 10
+
+
+def test_damaged_file_is_not_taken(tmp_path):
+    md5 = _add(DownloadCache(tmp_path / "cache"), tmp_path, b"reads")
+    # damaged in the shared cache after it has been added, with the size kept
+    path = tmp_path / "cache" / "objects" / md5[:2] / md5
+    path.chmod(0o644)
+    path.write_bytes(b"reeds")
+    # another process, the file has not been checked by it yet
+    cache = DownloadCache(tmp_path / "cache")
+
+    assert not cache.materialize(md5, tmp_path / "SRR1.fastq.gz")
+
+    assert not (tmp_path / "SRR1.fastq.gz").exists()
+    assert not path.exists()
+    assert cache.size() == 0
+    assert cache.stats == CacheStats(hits=0, misses=1)
+
+
+def test_file_is_checked_once_per_process(tmp_path, mocker):
+    md5 = _add(DownloadCache(tmp_path / "cache"), tmp_path, b"reads")
+    cache = DownloadCache(tmp_path / "cache")
+    hash_file = mocker.spy(DownloadCache, "_md5")
+
+    assert cache.materialize(md5, tmp_path / "first.fastq.gz")
+    assert cache.materialize(md5, tmp_path / "second.fastq.gz")
+
+    assert hash_file.call_count == 1
+
+
+FILES = {
+    'SRR0000001_1.fastq.gz': b'@r1\nACGT\n+\nFFFF\n',
+    'SRR0000001_2.fastq.gz': b'@r2\nTT\n+\nFF\n',
+}
+
+
+class FakeENAClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_urls_and_md5s(self, accession, ftp=False, aspera=False):
+        urls = [f"http://ftp.sra.ebi.ac.uk/vol1/fastq/{name}" for name in FILES]
+        return urls, [hashlib.md5(data).hexdigest() for data in FILES.values()]
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.data
+
+
+def test_ena_runs_shared_between_working_directories(tmp_path, mocker):
+    """The second project gets verified files from the cache without downloading them."""
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+    requests_get = mocker.patch.object(
+        download_module.requests,
+        "get",
+        side_effect=lambda url, stream: FakeResponse(FILES[url.split('/')[-1]]),
+    )
+    cache = DownloadCache(tmp_path / "cache")
+
+    for project in ["first", "second"]:
+        (tmp_path / project).mkdir()
+        client = ENADownloadClient(
+            tmp_path / project,
+            attempts=1,
+            attempts_interval=0,
+            skip_check=False,
+            transport=TransportType.ftp,
+            aspera_ssh_path="key",
+            download_cache=cache,
+        )
+        assert client.download_accession_list(['SRR0000001']) == 1
+        assert client.state_store.states() == {'SRR0000001': StateStore.VERIFIED}
+
+    assert requests_get.call_count == 2
+    for name, data in FILES.items():
+        assert (tmp_path / "second" / "SRR0000001" / name).read_bytes() == data
+    assert cache.stats == CacheStats(hits=2, misses=2, bytes_saved=sum(map(len, FILES.values())))
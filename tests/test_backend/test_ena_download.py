@@ -0,0 +1,251 @@
+import hashlib
+import importlib
+import time
+from pathlib import Path
+
+import pytest
+
+from fastqheat.backend.ena.download import ENADownloadClient, TransportType
+from fastqheat.backend.retry import RetryPolicy
+from fastqheat.backend.state import StateStore
+
+# fastqheat.backend.ena.download attribute is shadowed by the download() function
+download_module = importlib.import_module("fastqheat.backend.ena.download")
+
+FILES = {
+    'SRR0000001': ['SRR0000001_1.fastq.gz', 'SRR0000001_2.fastq.gz'],
+    'SRR0000002': ['SRR0000002.fastq.gz'],
+}
+
+
+def _content(file_name):
+    return f"@{file_name}\nACGT\n+\nFFFF\n".encode()
+
+
+def _md5(file_name):
+    return hashlib.md5(_content(file_name)).hexdigest()
+
+
+class FakeENAClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_urls_and_md5s(self, accession, ftp=False, aspera=False):
+        urls = [f"fasp.sra.ebi.ac.uk:/vol1/fastq/{accession}/{name}" for name in FILES[accession]]
+        return urls, [_md5(name) for name in FILES[accession]]
+
+    def get_all_urls_and_md5s(self, accession):
+        aspera_urls, md5s = self.get_urls_and_md5s(accession, aspera=True)
+        ftp_urls = [
+            f"http://ftp.sra.ebi.ac.uk/vol1/fastq/{accession}/{name}" for name in FILES[accession]
+        ]
+        return aspera_urls, ftp_urls, md5s
+
+
+def fake_ascp(command, check):
+    """Put every file of the --file-list into the target directory."""
+    file_list = next(arg for arg in command if arg.startswith('--file-list='))
+    file_list = Path(file_list.split('=', 1)[1])
+    target_directory = Path(command[-1])
+    for remote_path in file_list.read_text().splitlines():
+        file_name = remote_path.split('/')[-1]
+        (target_directory / file_name).write_bytes(_content(file_name))
+
+
+@pytest.fixture
+def client(tmp_path, mocker):
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+    return ENADownloadClient(
+        tmp_path,
+        attempts=1,
+        attempts_interval=0,
+        skip_check=False,
+        transport=TransportType.binary,
+        aspera_ssh_path="key",
+        aspera_batch_size=2,
+        aspera_sessions=2,
+    )
+
+
+def test_aspera_batches(client, tmp_path, mocker):
+    """Files are transferred in batches and moved to the directories of their accessions."""
+    run = mocker.patch.object(download_module.subprocess, "run", side_effect=fake_ascp)
+
+    successful = client.download_accession_list(['SRR0000001', 'SRR0000002'])
+
+    assert successful == 2
+    assert run.call_count == 2  # 3 files in batches of 2
+    for accession, file_names in FILES.items():
+        for file_name in file_names:
+            assert (tmp_path / accession / file_name).read_bytes() == _content(file_name)
+    assert not (tmp_path / '.aspera_staging').exists()
+
+
+def test_aspera_batch_failure(client, tmp_path, mocker):
+    """Accessions with files from a failed session are reported as failed."""
+
+    def fail_second_batch(command, check):
+        if Path(command[-1]).name == 'batch_1':
+            raise download_module.subprocess.CalledProcessError(1, command)
+        fake_ascp(command, check)
+
+    mocker.patch.object(download_module.subprocess, "run", side_effect=fail_second_batch)
+
+    successful = client.download_accession_list(['SRR0000001', 'SRR0000002'])
+
+    assert successful == 1
+    failed_list = client.failed_output_writer.path_to_file.read_text().split()
+    assert failed_list == ['SRR0000002']
+
+
+def test_auto_transport_falls_back_to_http(tmp_path, mocker):
+    """Files are downloaded via HTTP when ascp fails, the accession does not fail."""
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+    run = mocker.patch.object(
+        download_module.subprocess,
+        "run",
+        side_effect=download_module.subprocess.CalledProcessError(1, "ascp"),
+    )
+    client = ENADownloadClient(
+        tmp_path,
+        attempts=2,
+        attempts_interval=0,
+        skip_check=False,
+        transport=TransportType.auto,
+        aspera_ssh_path="key",
+    )
+
+    def fake_download_file(url, file_path, md5=None):
+        return file_path.write_bytes(_content(url.split('/')[-1]))
+
+    mocker.patch.object(client, "_download_file", side_effect=fake_download_file)
+    client._download_functions[TransportType.ftp] = client._download_file
+
+    successful = client.download_accession_list(['SRR0000001', 'SRR0000002'])
+
+    assert successful == 2
+    # Aspera is probed on the first file (2 attempts) and is not chosen afterwards
+    assert run.call_count == 2
+    assert (tmp_path / 'SRR0000002' / 'SRR0000002.fastq.gz').read_bytes() == _content(
+        'SRR0000002.fastq.gz'
+    )
+
+
+def test_resume(tmp_path, mocker):
+    """Completed accessions are skipped, downloaded ones are only checked."""
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+    state_store = StateStore(tmp_path)
+    state_store.start('SRR0000001')
+    state_store.advance('SRR0000001', StateStore.VERIFIED)
+    state_store.start('SRR0000002')
+    state_store.advance('SRR0000002', StateStore.DOWNLOADED)
+    (tmp_path / 'SRR0000002').mkdir()
+    (tmp_path / 'SRR0000002' / 'SRR0000002.fastq.gz').write_bytes(_content('SRR0000002.fastq.gz'))
+
+    client = ENADownloadClient(
+        tmp_path,
+        attempts=1,
+        attempts_interval=0,
+        skip_check=False,
+        transport=TransportType.binary,
+        aspera_ssh_path="key",
+        resume=True,
+    )
+    run = mocker.patch.object(download_module.subprocess, "run")
+
+    successful = client.download_accession_list(['SRR0000001', 'SRR0000002'])
+
+    assert successful == 2
+    run.assert_not_called()
+    assert state_store.get('SRR0000002').state == StateStore.VERIFIED
+    assert state_store.get('SRR0000002').attempts == 2
+
+
+def test_checks_overlap_with_downloads(tmp_path, mocker):
+    """A file is checked while the next one is downloaded, failures go to the right accession."""
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+    client = ENADownloadClient(
+        tmp_path,
+        attempts=1,
+        attempts_interval=0,
+        skip_check=False,
+        transport=TransportType.ftp,
+        aspera_ssh_path="key",
+        retry_policy=RetryPolicy(deferred_retries=0),
+    )
+    events = []
+
+    def fake_download_file(url, file_path, md5=None):
+        file_name = url.split('/')[-1]
+        events.append(f"download {file_name}")
+        # the second file of SRR0000001 is corrupted
+        content = b"corrupted" if file_name == 'SRR0000001_2.fastq.gz' else _content(file_name)
+        file_path.write_bytes(content)
+
+    def slow_check(file_path, md5):
+        time.sleep(0.1)
+        events.append(f"checked {file_path.name}")
+        return hashlib.md5(file_path.read_bytes()).hexdigest() == md5
+
+    client._download_function = fake_download_file
+    mocker.patch.object(download_module, "check_md5_checksum", side_effect=slow_check)
+
+    successful = client.download_accession_list(['SRR0000001', 'SRR0000002'])
+
+    assert successful == 1
+    assert events.index("download SRR0000002.fastq.gz") < events.index(
+        "checked SRR0000001_2.fastq.gz"
+    )
+    failed_list = client.failed_output_writer.path_to_file.read_text().split()
+    assert failed_list == ['SRR0000001']
+    assert client.state_store.get('SRR0000001').state == StateStore.FAILED
+    assert client.state_store.get('SRR0000002').state == StateStore.VERIFIED
+
+
+class BrokenResponse:
+    """Response that sends some data and then breaks, or sends it all."""
+
+    def __init__(self, data, broken):
+        self.data = data
+        self.broken = broken
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.data[:4]
+        if self.broken:
+            raise download_module.requests.exceptions.ConnectionError("Connection lost")
+        yield self.data[4:]
+
+
+@pytest.mark.parametrize("skip_check", [False, True])
+def test_md5_of_written_files_is_not_left_behind(tmp_path, mocker, skip_check):
+    """A failed re-download does not leave the md5 of an earlier download for the check."""
+    client = ENADownloadClient(
+        tmp_path,
+        attempts=1,
+        attempts_interval=0,
+        skip_check=skip_check,
+        transport=TransportType.ftp,
+        aspera_ssh_path="key",
+    )
+    responses = iter([False, True])
+    mocker.patch.object(
+        download_module.requests,
+        "get",
+        side_effect=lambda url, stream: BrokenResponse(b"@r\nACGT\n+\nFFFF\n", next(responses)),
+    )
+    file_path = tmp_path / 'SRR0000001.fastq.gz'
+
+    assert client._download_file("http://ftp.sra.ebi.ac.uk/SRR0000001.fastq.gz", file_path) == 15
+    assert (file_path in client._written) is not skip_check
+    with pytest.raises(download_module.requests.exceptions.ConnectionError):
+        client._download_file("http://ftp.sra.ebi.ac.uk/SRR0000001.fastq.gz", file_path)
+    assert file_path not in client._written
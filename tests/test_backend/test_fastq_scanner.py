@@ -0,0 +1,81 @@
+import pytest
+
+from fastqheat.backend.fastq_scanner import FastqScanner
+from fastqheat.backend.ncbi.check import AccessionChecker
+from fastqheat.exceptions import ValidationError
+
+
+def _records(*lengths, start=0):
+    return ''.join(
+        f"@read{number}\n{'A' * length}\n+\n{'F' * length}\n"
+        for number, length in enumerate(lengths, start=start)
+    )
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024])
+def test_stats(tmp_path, chunk_size):
+    path = tmp_path / 'SRR0000001.fastq'
+    path.write_text(_records(10, 12, 10, 0))
+
+    stats = FastqScanner(path, chunk_size=chunk_size).scan()
+
+    assert (stats.reads, stats.bases) == (4, 32)
+    assert stats.lengths == {10: 2, 12: 1, 0: 1}
+
+
+def test_last_record_without_newline(tmp_path):
+    path = tmp_path / 'SRR0000001.fastq'
+    path.write_text(_records(5, 5).rstrip('\n'))
+
+    assert FastqScanner(path, chunk_size=4).scan().reads == 2
+
+
+@pytest.mark.parametrize(
+    'content, error',
+    [
+        (_records(5, 5)[:-8], "record 2 is truncated"),
+        (_records(5) + "@read1\nAAAAA\n+\nFFF\n", "record 2 is malformed"),
+        (_records(5) + "read1\nAAAAA\n+\nFFFFF\n", "record 2 is malformed"),
+    ],
+)
+def test_broken_records(tmp_path, content, error):
+    path = tmp_path / 'SRR0000001.fastq'
+    path.write_text(content)
+
+    with pytest.raises(ValidationError, match=error):
+        FastqScanner(path, chunk_size=16).scan()
+
+
+@pytest.fixture
+def checker(tmp_path, mocker):
+    checker = AccessionChecker(
+        tmp_path, attempts=1, attempts_interval=0, core_count=1, zipped=False
+    )
+    mocker.patch.object(checker.ena_client, 'get_read_and_base_count', return_value=(3, 60))
+    (tmp_path / 'SRR0000001').mkdir()
+    return checker
+
+
+def test_check_paired_run(tmp_path, checker):
+    directory = tmp_path / 'SRR0000001'
+    (directory / 'SRR0000001_1.fastq').write_text(_records(10, 10))
+    (directory / 'SRR0000001_2.fastq').write_text(_records(10, 10))
+    (directory / 'SRR0000001.fastq').write_text(_records(20))
+
+    assert checker.check_accession('SRR0000001')
+
+
+def test_check_mismatched_mates(tmp_path, checker):
+    directory = tmp_path / 'SRR0000001'
+    (directory / 'SRR0000001_1.fastq').write_text(_records(10, 10, 10))
+    (directory / 'SRR0000001_2.fastq').write_text(_records(10, 10))
+
+    with pytest.raises(ValidationError, match="different numbers of reads"):
+        checker.check_accession('SRR0000001')
+
+
+def test_check_base_count(tmp_path, checker):
+    (tmp_path / 'SRR0000001' / 'SRR0000001.fastq').write_text(_records(10, 10, 10))
+
+    with pytest.raises(ValidationError, match="Loaded 30 bases, but described 60 bases"):
+        checker.check_accession('SRR0000001')
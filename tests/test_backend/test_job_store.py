@@ -0,0 +1,110 @@
+import concurrent.futures
+
+import pytest
+
+from fastqheat.backend.job_store import SQLiteJobStore
+from fastqheat.backend.scheduler import InputOrderPolicy, LargestFirstPolicy, WorkItem
+
+
+def _items(*sizes):
+    return [
+        WorkItem(accession=f'SRR{index:07d}', index=index, size=size)
+        for index, size in enumerate(sizes)
+    ]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / 'jobs.sqlite'
+
+
+def test_claim_order(path):
+    job_store = SQLiteJobStore(path, node_id='node')
+    assert job_store.add(_items(10, 30, 20), LargestFirstPolicy()) == 3
+
+    claimed = []
+    while (item := job_store.next()) is not None:
+        claimed.append(item)
+        job_store.done(item)
+
+    assert [item.size for item in claimed] == [30, 20, 10]
+    assert job_store.summary() == {'pending': 0, 'claimed': 0, 'done': 3, 'failed': 0}
+
+
+def test_add_is_idempotent(path):
+    """Nodes started with the same input do not add accessions twice."""
+    first = SQLiteJobStore(path, node_id='first')
+    second = SQLiteJobStore(path, node_id='second')
+    first.add(_items(1, 2), InputOrderPolicy())
+
+    assert second.missing(['SRR0000001', 'SRR0000002', 'SRR0000003']) == [
+        'SRR0000002',
+        'SRR0000003',
+    ]
+    assert second.add(_items(1, 2, 3), InputOrderPolicy()) == 1
+    assert second.summary()['pending'] == 3
+
+
+def test_failed_accessions(path):
+    job_store = SQLiteJobStore(path, node_id='node')
+    job_store.add(_items(1, 2), InputOrderPolicy())
+
+    job_store.done(job_store.next(), success=False)
+    job_store.done(job_store.next(), success=True)
+
+    assert job_store.next() is None
+    assert job_store.summary() == {'pending': 0, 'claimed': 0, 'done': 1, 'failed': 1}
+
+
+def test_expired_lease_is_reclaimed(path):
+    dead = SQLiteJobStore(path, node_id='dead', lease_duration=-1)
+    alive = SQLiteJobStore(path, node_id='alive')
+    dead.add(_items(1), InputOrderPolicy())
+    item = dead.next()
+
+    reclaimed = alive.next()
+    assert reclaimed.accession == item.accession
+    alive.done(reclaimed)
+    # the late result of the dead node does not override the state
+    dead.done(item, success=False)
+
+    assert alive.summary()['done'] == 1
+
+
+def test_node_waits_for_claims_of_other_nodes(path):
+    """A node that has drained the queue takes over the claims of a node that dies later."""
+    dying = SQLiteJobStore(path, node_id='dying', lease_duration=0.5)
+    alive = SQLiteJobStore(path, node_id='alive', poll_interval=0.05)
+    dying.add(_items(1, 2, 3), InputOrderPolicy())
+    claimed = dying.next()
+
+    while (item := alive.next()) is not None and item.accession != claimed.accession:
+        alive.done(item)
+
+    # the queue had been drained before the lease of the dying node expired
+    assert item is not None and item.accession == claimed.accession
+    alive.done(item)
+    assert alive.next() is None
+    assert alive.summary() == {'pending': 0, 'claimed': 0, 'done': 3, 'failed': 0}
+
+
+def test_nodes_do_not_claim_the_same_accession(path):
+    items = _items(*range(50))
+    job_stores = [
+        SQLiteJobStore(path, node_id=f'node{index}', poll_interval=0.05) for index in range(4)
+    ]
+    job_stores[0].add(items, InputOrderPolicy())
+
+    def work(job_store):
+        claimed = []
+        while (item := job_store.next()) is not None:
+            claimed.append(item.accession)
+            job_store.done(item)
+        return claimed
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(job_stores)) as executor:
+        claimed = [
+            accession for accessions in executor.map(work, job_stores) for accession in accessions
+        ]
+
+    assert sorted(claimed) == [item.accession for item in items]
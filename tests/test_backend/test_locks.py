@@ -0,0 +1,134 @@
+import hashlib
+import importlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from fastqheat.backend.ena.download import ENADownloadClient, TransportType
+from fastqheat.backend.locks import RunLocks
+from fastqheat.backend.state import StateStore
+from fastqheat.exceptions import RunLockedError
+
+# fastqheat.backend.ena.download attribute is shadowed by the download() function
+download_module = importlib.import_module("fastqheat.backend.ena.download")
+
+# pid 1 is always alive, it stands for another FastqHeat process on this host
+OTHER_PID = 1
+
+
+def _lock_by_other_process(run_locks, accession, pid=OTHER_PID):
+    path = run_locks.path(accession)
+    path.write_text(json.dumps({'host': socket.gethostname(), 'pid': pid, 'started': 0}))
+    return path
+
+
+def test_lock_and_release(tmp_path):
+    run_locks = RunLocks(tmp_path)
+
+    assert run_locks.try_acquire('SRR1') is None
+    assert run_locks.path('SRR1').is_file()
+    run_locks.release('SRR1')
+
+    assert not run_locks.path('SRR1').exists()
+
+
+def test_locked_by_another_process(tmp_path):
+    run_locks = RunLocks(tmp_path)
+    _lock_by_other_process(run_locks, 'SRR1')
+
+    assert run_locks.try_acquire('SRR1') == f"{socket.gethostname()}:{OTHER_PID}"
+    with pytest.raises(RunLockedError):
+        run_locks.acquire('SRR1', wait=False)
+
+
+def test_lock_of_dead_process_is_broken(tmp_path):
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    run_locks = RunLocks(tmp_path)
+    _lock_by_other_process(run_locks, 'SRR1', pid=process.pid)
+
+    assert run_locks.try_acquire('SRR1') is None
+    assert json.loads(run_locks.path('SRR1').read_text())['pid'] == os.getpid()
+    assert [path.name for path in run_locks.directory.iterdir()] == ['SRR1.lock']
+
+
+def test_lock_without_heartbeat_is_broken(tmp_path):
+    run_locks = RunLocks(tmp_path, stale_timeout=60)
+    path = _lock_by_other_process(run_locks, 'SRR1')
+    os.utime(path, (time.time() - 120, time.time() - 120))
+
+    assert run_locks.try_acquire('SRR1') is None
+
+
+def test_wait_for_lock(tmp_path):
+    run_locks = RunLocks(tmp_path, poll_interval=0.01)
+    path = _lock_by_other_process(run_locks, 'SRR1')
+    threading.Timer(0.1, path.unlink).start()
+
+    run_locks.acquire('SRR1')
+
+    assert run_locks.try_acquire('SRR1') is not None  # held by this process now
+
+
+FILES = {'SRR0000001.fastq.gz': b'@r1\nACGT\n+\nFFFF\n'}
+
+
+class FakeENAClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_urls_and_md5s(self, accession, ftp=False, aspera=False):
+        urls = [f"http://ftp.sra.ebi.ac.uk/vol1/fastq/{name}" for name in FILES]
+        return urls, [hashlib.md5(data).hexdigest() for data in FILES.values()]
+
+
+@pytest.fixture
+def requests_get(mocker):
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+    return mocker.patch.object(download_module.requests, "get")
+
+
+def _make_client(tmp_path, wait_for_locked_runs):
+    client = ENADownloadClient(
+        tmp_path,
+        attempts=1,
+        attempts_interval=0,
+        skip_check=False,
+        transport=TransportType.ftp,
+        aspera_ssh_path="key",
+        wait_for_locked_runs=wait_for_locked_runs,
+    )
+    client.run_locks.poll_interval = 0.01
+    return client
+
+
+def test_run_downloaded_by_another_process_is_reused(tmp_path, requests_get):
+    """The client waits for the other process and takes its verified run instead of fetching it."""
+    client = _make_client(tmp_path, wait_for_locked_runs=True)
+    path = _lock_by_other_process(client.run_locks, 'SRR0000001')
+
+    def finish_other_process():
+        client.state_store.start('SRR0000001')
+        client.state_store.advance('SRR0000001', StateStore.VERIFIED)
+        path.unlink()
+
+    threading.Timer(0.1, finish_other_process).start()
+
+    assert client.download_accession_list(['SRR0000001']) == 1
+    requests_get.assert_not_called()
+    assert client.state_store.get('SRR0000001').attempts == 1
+
+
+def test_locked_run_is_skipped(tmp_path, requests_get):
+    client = _make_client(tmp_path, wait_for_locked_runs=False)
+    _lock_by_other_process(client.run_locks, 'SRR0000001')
+
+    assert client.download_accession_list(['SRR0000001']) == 0
+    requests_get.assert_not_called()
+    assert not client.failed_output_writer.path_to_file.exists()
@@ -0,0 +1,114 @@
+import importlib
+import threading
+import time
+from pathlib import Path
+
+from fastqheat.backend.ncbi.download import NCBIDownloadClient
+
+# fastqheat.backend.ncbi.download attribute is shadowed by the download() function
+download_module = importlib.import_module("fastqheat.backend.ncbi.download")
+
+
+def test_ncbi_jobs_share_the_budget(tmp_path, mocker):
+    threads_in_use = 0
+    max_threads_in_use = 0
+    lock = threading.Lock()
+
+    def fake_run(command, check):
+        nonlocal threads_in_use, max_threads_in_use
+        if command[0] == 'fasterq-dump':
+            threads = int(command[command.index('--threads') + 1])
+            Path(command[3], f'{command[1]}.fastq').write_text("@read\nACGT\n+\nFFFF\n")
+        else:
+            threads = int(command[command.index('--processes') + 1])
+        with lock:
+            threads_in_use += threads
+            max_threads_in_use = max(max_threads_in_use, threads_in_use)
+        time.sleep(0.05)
+        with lock:
+            threads_in_use -= threads
+
+    mocker.patch.object(download_module.subprocess, "run", side_effect=fake_run)
+    client = NCBIDownloadClient(
+        tmp_path, attempts=1, attempts_interval=0, skip_check=True, core_count=4, jobs=3
+    )
+
+    accessions = [f'SRR{index:07d}' for index in range(6)]
+    assert client.download_accession_list(accessions) == len(accessions)
+    assert max_threads_in_use <= 4
+    assert client.cpu_budget.available == 4
+
+
+def test_ncbi_prefetch(tmp_path, mocker):
+    commands = []
+
+    def fake_run(command, check):
+        commands.append([str(arg) for arg in command])
+        if command[0] == 'prefetch':
+            run_directory = Path(command[3], command[1])
+            run_directory.mkdir()
+            (run_directory / f'{command[1]}.sra').write_bytes(b'sra')
+        elif command[0] == 'fasterq-dump':
+            accession = Path(command[1]).stem
+            Path(command[3], f'{accession}.fastq').write_text("@read\nACGT\n+\nFFFF\n")
+
+    mocker.patch.object(download_module.subprocess, "run", side_effect=fake_run)
+    client = NCBIDownloadClient(
+        tmp_path, attempts=1, attempts_interval=0, skip_check=True, core_count=2, prefetch=True
+    )
+
+    assert client.download_accession_list(['SRR0000001', 'SRR0000002']) == 2
+
+    sra_path = tmp_path / '.sra_cache' / 'SRR0000001' / 'SRR0000001.sra'
+    assert ['fasterq-dump', str(sra_path)] in [command[:2] for command in commands]
+    assert list((tmp_path / '.sra_cache').iterdir()) == []
+    assert client.state_store.get('SRR0000002').state == 'compressed'
+
+
+def test_ncbi_scratch_directory(tmp_path, mocker):
+    output_directory, scratch_directory = tmp_path / 'output', tmp_path / 'scratch'
+    output_directory.mkdir()
+
+    def fake_run(command, check):
+        if command[0] == 'fasterq-dump':
+            assert command[command.index('--temp') + 1] == str(scratch_directory / command[1])
+            Path(command[3], f'{command[1]}.fastq').write_text("@read\nACGT\n+\nFFFF\n")
+        elif command[0] == 'pigz':
+            for path in command[3:]:
+                path.with_name(f'{path.name}.gz').write_bytes(path.read_bytes())
+                path.unlink()
+
+    mocker.patch.object(download_module.subprocess, "run", side_effect=fake_run)
+    client = NCBIDownloadClient(
+        output_directory,
+        attempts=1,
+        attempts_interval=0,
+        skip_check=True,
+        core_count=2,
+        scratch_directory=scratch_directory,
+    )
+
+    assert client.download_accession_list(['SRR0000001']) == 1
+
+    assert [path.name for path in (output_directory / 'SRR0000001').iterdir()] == [
+        'SRR0000001.fastq.gz'
+    ]
+    assert list(scratch_directory.iterdir()) == []
+
+
+def test_ncbi_bgzf_compression(tmp_path, mocker):
+    def fake_run(command, check):
+        Path(command[3], f'{command[1]}_1.fastq').write_text("@read\nACGT\n+\nFFFF\n")
+
+    mocker.patch.object(download_module.subprocess, "run", side_effect=fake_run)
+    client = NCBIDownloadClient(
+        tmp_path, attempts=1, attempts_interval=0, skip_check=True, core_count=2, compression='bgzf'
+    )
+
+    assert client.download_accession_list(['SRR0000001']) == 1
+
+    assert sorted(path.name for path in (tmp_path / 'SRR0000001').iterdir()) == [
+        'SRR0000001_1.fastq.gz',
+        'SRR0000001_1.fastq.gz.fqi',
+        'SRR0000001_1.fastq.gz.gzi',
+    ]
@@ -0,0 +1,107 @@
+import functools
+import importlib
+import subprocess
+import threading
+
+import pytest
+import requests
+
+from fastqheat.backend.common import BaseDownloadClient
+from fastqheat.backend.retry import ErrorKind, RetryPolicy, classify_error, retry_on
+from fastqheat.backend.scheduler import Scheduler
+from fastqheat.exceptions import ENAClientError, ValidationError
+
+common_module = importlib.import_module("fastqheat.backend.common")
+
+
+def _http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def _ena_client_error(cause):
+    try:
+        raise ENAClientError("An error occurred") from cause
+    except ENAClientError as err:
+        return err
+
+
+@pytest.mark.parametrize(
+    'error, kind',
+    [
+        (requests.ConnectionError(), ErrorKind.transient),
+        (subprocess.CalledProcessError(1, 'ascp'), ErrorKind.transient),
+        (_http_error(429), ErrorKind.throttled),
+        (_http_error(503), ErrorKind.throttled),
+        (_http_error(404), ErrorKind.permanent),
+        (_ena_client_error(_http_error(502)), ErrorKind.throttled),
+        (ENAClientError("ENA API returned no data"), ErrorKind.permanent),
+        (ValidationError("failed md5 check"), ErrorKind.checksum),
+        (FileNotFoundError(), ErrorKind.permanent),
+    ],
+)
+def test_classify_error(error, kind):
+    assert classify_error(error) == kind
+
+
+def test_permanent_errors_are_not_retried():
+    calls = []
+
+    @retry_on(requests.RequestException, attempts=3, attempts_interval=0)
+    def get():
+        calls.append(1)
+        raise _http_error(404)
+
+    with pytest.raises(requests.HTTPError):
+        get()
+    assert len(calls) == 1
+
+
+def test_retry_delay_grows():
+    policy = RetryPolicy(deferred_retries=3, interval=10, max_interval=30)
+
+    assert 5 <= policy.delay(0) <= 10
+    assert 10 <= policy.delay(1) <= 20
+    assert 15 <= policy.delay(5) <= 30
+    assert policy.should_defer(ErrorKind.throttled, 2)
+    assert not policy.should_defer(ErrorKind.throttled, 3)
+    assert not policy.should_defer(ErrorKind.permanent, 0)
+
+
+class FlakyDownloadClient(BaseDownloadClient):
+    """SRR1 fails with a transient error the first time, SRR2 does not exist."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.downloaded = []
+        self._lock = threading.Lock()
+
+    def download_one_accession(self, accession):
+        with self._lock:
+            self.downloaded.append(accession)
+            attempt = self.downloaded.count(accession)
+        if accession == 'SRR1' and attempt == 1:
+            raise _http_error(503)
+        if accession == 'SRR2':
+            raise ENAClientError("ENA API returned no data for the accession: SRR2")
+
+
+def test_transient_failures_are_deferred(tmp_path, mocker):
+    client = FlakyDownloadClient(
+        tmp_path, 1, 0, skip_check=False, retry_policy=RetryPolicy(interval=60)
+    )
+    # the deferred accession is due once the others have been downloaded, not earlier
+    mocker.patch.object(
+        common_module,
+        "Scheduler",
+        functools.partial(Scheduler, clock=lambda: 3600.0 if 'SRR3' in client.downloaded else 0.0),
+    )
+
+    successful = client.download_accession_list(['SRR1', 'SRR2', 'SRR3'])
+
+    assert successful == 2
+    # SRR1 is retried after the other accessions, SRR2 fails straight away
+    assert client.downloaded == ['SRR1', 'SRR2', 'SRR3', 'SRR1']
+    assert client.state_store.get('SRR1').attempts == 2
+    assert client.state_store.get('SRR2').state == 'failed'
@@ -0,0 +1,149 @@
+import gzip
+import hashlib
+import importlib
+import json
+
+import pytest
+
+from fastqheat.backend.ena.download import ENADownloadClient, TransportType
+from fastqheat.backend.sampling import SampleLimits, fastq_head
+from fastqheat.backend.state import StateStore
+from fastqheat.exceptions import ValidationError
+
+# fastqheat.backend.ena.download attribute is shadowed by the download() function
+download_module = importlib.import_module("fastqheat.backend.ena.download")
+
+
+def _records(name, count, length=4):
+    return b"".join(
+        f"@{name}.{i}\n{'A' * length}\n+\n{'F' * length}\n".encode() for i in range(count)
+    )
+
+
+def test_fastq_head():
+    data = _records('r', 5)
+    chunks = [data[i : i + 7] for i in range(0, len(data), 7)]
+
+    assert b"".join(fastq_head(chunks, 2)) == _records('r', 2)
+    assert b"".join(fastq_head(chunks)) == data
+    assert b"".join(fastq_head([data[:-3]], cut_off=True)) == _records('r', 4)
+    assert b"".join(fastq_head([data.rstrip(b"\n")])) == data
+    with pytest.raises(ValidationError):
+        list(fastq_head([data[:-3]]))
+    with pytest.raises(ValidationError):
+        list(fastq_head([b"not\na\nfastq\nfile\n"]))
+
+
+FILES = {
+    'SRR0000001_1.fastq.gz': gzip.compress(_records('SRR0000001/1', 1000, length=100)),
+    'SRR0000001_2.fastq.gz': gzip.compress(_records('SRR0000001/2', 1000, length=150)),
+}
+
+
+class FakeENAClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_urls(self, accession, ftp=False, aspera=False):
+        return [f"http://ftp.sra.ebi.ac.uk/vol1/fastq/{name}" for name in FILES]
+
+    def get_urls_and_md5s(self, accession, ftp=False, aspera=False):
+        return self.get_urls(accession), [hashlib.md5(data).hexdigest() for data in FILES.values()]
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+        self.sent = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closed = True
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.data), 100):
+            self.sent += len(self.data[start : start + 100])
+            yield self.data[start : start + 100]
+
+
+@pytest.fixture
+def responses(mocker):
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+    responses = {}
+
+    def get(url, stream, headers=None):
+        name = url.split('/')[-1]
+        responses[name] = FakeResponse(FILES[name])
+        return responses[name]
+
+    mocker.patch.object(download_module.requests, "get", side_effect=get)
+    return responses
+
+
+def _client(tmp_path, **kwargs):
+    return ENADownloadClient(
+        tmp_path,
+        attempts=1,
+        attempts_interval=0,
+        skip_check=False,
+        transport=TransportType.ftp,
+        aspera_ssh_path="key",
+        **kwargs,
+    )
+
+
+def _sample(tmp_path, **limits):
+    client = _client(tmp_path, sample=SampleLimits(**limits))
+    assert client.download_accession_list(['SRR0000001']) == 1
+    assert client.state_store.states() == {'SRR0000001': StateStore.DOWNLOADED}
+    return json.loads((tmp_path / 'SRR0000001' / 'SRR0000001.manifest.json').read_text())
+
+
+def test_sample_first_reads(tmp_path, responses):
+    """The transfer stops after the reads, mates get the same reads, output is valid gzip."""
+    manifest = _sample(tmp_path, max_reads=10)
+
+    for mate, length in [(1, 100), (2, 150)]:
+        path = tmp_path / 'SRR0000001' / f'SRR0000001_{mate}.fastq.gz'
+        assert gzip.decompress(path.read_bytes()) == _records(f'SRR0000001/{mate}', 10, length)
+        response = responses[path.name]
+        assert response.closed and response.sent < len(response.data)
+    assert manifest['max_reads'] == 10
+    assert [file['reads'] for file in manifest['files'].values()] == [10, 10]
+
+
+def test_sample_first_bytes_keeps_pairs_in_sync(tmp_path, responses):
+    manifest = _sample(tmp_path, max_bytes=1000)
+
+    files = manifest['files']
+    reads = files['SRR0000001_1.fastq.gz']['reads']
+    assert reads > 0
+    assert files['SRR0000001_1.fastq.gz']['transferred_bytes'] == 1000
+    assert files['SRR0000001_2.fastq.gz']['reads'] == reads
+    path = tmp_path / 'SRR0000001' / 'SRR0000001_2.fastq.gz'
+    assert gzip.decompress(path.read_bytes()) == _records('SRR0000001/2', reads, 150)
+
+
+def test_full_download_replaces_sample(tmp_path, responses):
+    """A run downloaded whole after a sample of it is not downloaded again on resume."""
+    _sample(tmp_path, max_reads=10)
+
+    assert _client(tmp_path).download_accession_list(['SRR0000001']) == 1
+
+    directory = tmp_path / 'SRR0000001'
+    assert sorted(path.name for path in directory.iterdir()) == sorted(FILES)
+    for name, data in FILES.items():
+        assert (directory / name).read_bytes() == data
+
+    requests_get = download_module.requests.get
+    requests_get.reset_mock()
+    client = _client(tmp_path, resume=True)
+    assert client.download_accession_list(['SRR0000001']) == 1
+    requests_get.assert_not_called()
+    assert client.state_store.states() == {'SRR0000001': StateStore.VERIFIED}
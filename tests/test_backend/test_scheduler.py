@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+
+from fastqheat.backend import common as common_module
+from fastqheat.backend.common import BaseDownloadClient, get_run_sizes
+from fastqheat.backend.ena import ena_api_client
+from fastqheat.backend.retry import RetryPolicy
+from fastqheat.backend.scheduler import (
+    LargestFirstPolicy,
+    Scheduler,
+    WorkItem,
+    get_scheduling_policy,
+)
+from fastqheat.exceptions import ENAClientError, ValidationError
+
+SIZES = {'SRR1': 10, 'SRR2': 90_000, 'SRR3': None, 'SRR4': 500}
+
+
+class FakeENAClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_fastq_bytes(self, accession):
+        if SIZES[accession] is None:
+            raise ENAClientError
+        return [SIZES[accession] // 2, SIZES[accession] - SIZES[accession] // 2]
+
+
+def _drain(scheduler):
+    accessions = []
+    while (item := scheduler.next()) is not None:
+        accessions.append(item.accession)
+        scheduler.done(item)
+    return accessions
+
+
+@pytest.mark.parametrize(
+    ("policy", "expected"),
+    [
+        ("input", ['SRR1', 'SRR2', 'SRR3', 'SRR4']),
+        ("largest-first", ['SRR2', 'SRR4', 'SRR1', 'SRR3']),
+        ("smallest-first", ['SRR1', 'SRR4', 'SRR2', 'SRR3']),
+    ],
+)
+def test_scheduling_policies(policy, expected):
+    """Runs are ordered by policy, runs of unknown size go last."""
+    scheduler = Scheduler.from_accessions(list(SIZES), get_scheduling_policy(policy), SIZES)
+
+    assert _drain(scheduler) == expected
+
+
+def test_get_run_sizes(mocker):
+    mocker.patch.object(ena_api_client, "ENAClient", FakeENAClient)
+
+    assert get_run_sizes(list(SIZES), attempts=1, attempts_interval=0) == SIZES
+
+
+def test_input_order_does_not_request_sizes(tmp_path, mocker):
+    get_run_sizes = mocker.patch.object(common_module, "get_run_sizes")
+    client = FakeDownloadClient(
+        tmp_path, 1, 0, skip_check=False, retry_policy=RetryPolicy(deferred_retries=0)
+    )
+
+    client.download_accession_list(list(SIZES))
+
+    get_run_sizes.assert_not_called()
+
+
+def test_scheduler_tracks_bytes_in_flight():
+    items = [WorkItem('SRR1', 0, 100), WorkItem('SRR2', 1, 200)]
+    scheduler = Scheduler(items, LargestFirstPolicy())
+
+    first = scheduler.next()
+    scheduler.next()
+    assert scheduler._bytes_in_flight == 300
+    scheduler.done(first)
+    assert scheduler._bytes_in_flight == 100
+
+
+class FakeDownloadClient(BaseDownloadClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.downloaded = []
+        self.threads = set()
+        self._lock = threading.Lock()
+
+    def download_one_accession(self, accession):
+        with self._lock:
+            self.threads.add(threading.current_thread().name)
+            self.downloaded.append(accession)
+        time.sleep(0.01)
+        if accession == 'SRR3':
+            raise ValidationError("broken")
+
+
+def test_concurrent_download(tmp_path):
+    """All accessions are downloaded by several workers, failures are reported."""
+    client = FakeDownloadClient(
+        tmp_path, 1, 0, skip_check=False, jobs=3, retry_policy=RetryPolicy(deferred_retries=0)
+    )
+    accessions = [f'SRR{i}' for i in range(20)]
+
+    successful = client.download_accession_list(accessions)
+
+    assert successful == 19
+    assert sorted(client.downloaded) == sorted(accessions)
+    assert len(client.threads) > 1
+    assert client.failed_output_writer.path_to_file.read_text() == "SRR3\n"
+
+
+def test_deferred_items_are_due_first():
+    now = [0.0]
+    scheduler = Scheduler(
+        [WorkItem('SRR1', 0), WorkItem('SRR2', 1), WorkItem('SRR3', 2)],
+        LargestFirstPolicy(),
+        clock=lambda: now[0],
+    )
+
+    first = scheduler.next()
+    scheduler.defer(first, 10)
+    assert scheduler.next().accession == 'SRR2'  # the deferred item is not due yet
+
+    now[0] = 10
+    assert scheduler.next() is first
+    assert scheduler.next().accession == 'SRR3'
+    assert scheduler.next() is None
+
+
+def test_scheduler_waits_for_deferred_items():
+    scheduler = Scheduler([WorkItem('SRR1', 0)], LargestFirstPolicy())
+    scheduler.defer(scheduler.next(), 0.05)
+
+    start = time.monotonic()
+    assert scheduler.next().accession == 'SRR1'
+    assert time.monotonic() - start >= 0.05
@@ -0,0 +1,251 @@
+import concurrent.futures
+import gzip
+import hashlib
+import importlib
+import json
+
+import pytest
+
+from fastqheat.backend.ena.download import ENADownloadClient, TransportType
+from fastqheat.backend.ncbi.download import NCBIDownloadClient
+from fastqheat.backend.retry import RetryPolicy
+from fastqheat.backend.sharding import FastqWriter, ShardLayout, shard_path
+from fastqheat.backend.sinks import LocalSink
+from fastqheat.backend.state import StateStore
+from fastqheat.config import config
+from fastqheat.exceptions import ValidationError
+
+# fastqheat.backend.ena.download attribute is shadowed by the download() function
+download_module = importlib.import_module("fastqheat.backend.ena.download")
+
+
+def _records(name, first, count):
+    return b"".join(f"@{name}.{i}\nACGT\n+\nFFFF\n".encode() for i in range(first, first + count))
+
+
+@pytest.fixture
+def small_shards(mocker):
+    # blocks of 3 reads, every few records make a separate gzip member
+    mocker.patch.object(config, 'SHARD_BLOCK_READS', 3)
+    mocker.patch.object(config, 'SHARD_MEMBER_SIZE', 50)
+
+
+def _write(tmp_path, layout, records):
+    lines = _records('r', 0, records).split(b'\n')[:-1]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        with FastqWriter(LocalSink(tmp_path), 'r.fastq.gz', layout, executor, 2) as writer:
+            for start in range(0, len(lines), 8):
+                writer.write(lines[start : start + 8])
+    return writer.shards()
+
+
+def test_shards_in_turn(tmp_path, small_shards):
+    shards = _write(tmp_path, ShardLayout(shards=3), 10)
+
+    assert [shard['reads'] for shard in shards] == [4, 3, 3]
+    # blocks 0, 3 / 1 / 2 of 3 reads
+    expected = [
+        _records('r', 0, 3) + _records('r', 9, 1),
+        _records('r', 3, 3),
+        _records('r', 6, 3),
+    ]
+    for shard, data in zip(shards, expected):
+        path = tmp_path / shard['file']
+        assert shard['file'] == shard_path('r.fastq.gz', shard['shard'])
+        assert gzip.decompress(path.read_bytes()) == data
+        assert shard['md5'] == hashlib.md5(path.read_bytes()).hexdigest()
+
+
+def test_shards_of_reads(tmp_path, small_shards):
+    shards = _write(tmp_path, ShardLayout(reads_per_shard=4), 10)
+
+    assert [shard['file'] for shard in shards] == [
+        'r.shard0000.fastq.gz',
+        'r.shard0001.fastq.gz',
+        'r.shard0002.fastq.gz',
+    ]
+    data = b"".join(gzip.decompress((tmp_path / shard['file']).read_bytes()) for shard in shards)
+    assert data == _records('r', 0, 10)
+    assert [shard['reads'] for shard in shards] == [4, 4, 2]
+
+
+class CountingSink(LocalSink):
+    """Counts the files that are open at the same time."""
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.open_files = 0
+        self.max_open_files = 0
+
+    def _make_writer(self, relative_path):
+        writer = super()._make_writer(relative_path)
+        self.open_files += 1
+        self.max_open_files = max(self.max_open_files, self.open_files)
+        commit = writer.commit
+
+        def counted_commit():
+            self.open_files -= 1
+            commit()
+
+        writer.commit = counted_commit
+        return writer
+
+
+def test_completed_shards_are_closed(tmp_path, small_shards):
+    sink = CountingSink(tmp_path)
+    lines = _records('r', 0, 20).split(b'\n')[:-1]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        with FastqWriter(sink, 'r.fastq.gz', ShardLayout(reads_per_shard=2), executor, 2) as writer:
+            for start in range(0, len(lines), 12):
+                writer.write(lines[start : start + 12])
+
+    assert len(writer.shards()) == 10
+    assert (sink.open_files, sink.max_open_files) == (0, 1)
+    data = b"".join(
+        gzip.decompress((tmp_path / shard['file']).read_bytes()) for shard in writer.shards()
+    )
+    assert data == _records('r', 0, 20)
+
+
+def test_empty_shards_are_valid_gzip(tmp_path, small_shards):
+    shards = _write(tmp_path, ShardLayout(shards=4), 2)
+
+    assert [shard['reads'] for shard in shards] == [2, 0, 0, 0]
+    assert gzip.decompress((tmp_path / shards[3]['file']).read_bytes()) == b''
+
+
+FILES = {
+    f'SRR0000001_{mate}.fastq.gz': gzip.compress(_records(f'SRR0000001/{mate}', 0, 20))
+    for mate in (1, 2)
+}
+
+
+class FakeENAClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_urls_and_md5s(self, accession, ftp=False, aspera=False):
+        names = list(FILES)
+        urls = [f"http://ftp.sra.ebi.ac.uk/vol1/fastq/{name}" for name in names]
+        return urls, [hashlib.md5(FILES[name]).hexdigest() for name in names]
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.data), 30):
+            yield self.data[start : start + 30]
+
+
+def _ena_client(tmp_path, mocker, files, shard_layout=ShardLayout(shards=2), **kwargs):
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+    mocker.patch.object(
+        download_module.requests,
+        "get",
+        side_effect=lambda url, stream, headers=None: FakeResponse(files[url.split('/')[-1]]),
+    )
+    return ENADownloadClient(
+        tmp_path,
+        attempts=1,
+        attempts_interval=0,
+        skip_check=False,
+        transport=TransportType.ftp,
+        aspera_ssh_path="key",
+        retry_policy=RetryPolicy(deferred_retries=0),
+        shard_layout=shard_layout,
+        **kwargs,
+    )
+
+
+def test_ena_run_sharded_while_downloaded(tmp_path, mocker, small_shards):
+    client = _ena_client(tmp_path, mocker, FILES)
+
+    assert client.download_accession_list(['SRR0000001']) == 1
+    assert client.state_store.states() == {'SRR0000001': StateStore.VERIFIED}
+
+    directory = tmp_path / 'SRR0000001'
+    index = json.loads((directory / 'SRR0000001.shards.json').read_text())
+    assert index['layout'] == {'shards': 2, 'reads_per_shard': None, 'block_reads': 3}
+    assert not (directory / 'SRR0000001_1.fastq.gz').exists()
+    for shard in range(2):
+        # shards of both mates with the same number hold the same pairs
+        spots = [
+            gzip.decompress((directory / files[shard]['file']).read_bytes()).split(b'\n')[0::4]
+            for files in index['files'].values()
+        ]
+        assert [header.split(b'.')[-1] for header in spots[0]] == [
+            header.split(b'.')[-1] for header in spots[1]
+        ]
+    assert [sum(shard['reads'] for shard in shards) for shards in index['files'].values()] == [
+        20,
+        20,
+    ]
+
+
+def test_ena_sharded_run_is_checked(tmp_path, mocker, small_shards):
+    corrupted = {**FILES, 'SRR0000001_2.fastq.gz': gzip.compress(_records('SRR0000001/X', 0, 20))}
+    client = _ena_client(tmp_path, mocker, corrupted)
+
+    assert client.download_accession_list(['SRR0000001']) == 0
+    assert 'md5 check' in client.state_store.get('SRR0000001').last_error
+    # neither mate leaves shards behind
+    assert not any((tmp_path / 'SRR0000001').iterdir())
+
+
+def test_ena_run_split_in_another_way(tmp_path, mocker, small_shards):
+    """Files of an earlier layout are removed, the run is not downloaded again on resume."""
+    directory = tmp_path / 'SRR0000001'
+    for layout in [ShardLayout(shards=2), ShardLayout(reads_per_shard=5)]:
+        client = _ena_client(tmp_path, mocker, FILES, layout, resume=True)
+        assert client.download_accession_list(['SRR0000001']) == 1
+
+        index = json.loads((directory / 'SRR0000001.shards.json').read_text())
+        assert index['layout'] == layout.describe()
+        names = [shard['file'] for shards in index['files'].values() for shard in shards]
+        assert len(names) == 2 * (layout.shards or 4)
+        assert sorted(path.name for path in directory.glob('*.fastq.gz')) == sorted(names)
+
+    client = _ena_client(tmp_path, mocker, FILES, None, resume=True)
+    assert client.download_accession_list(['SRR0000001']) == 1
+    assert sorted(path.name for path in directory.iterdir()) == sorted(FILES)
+
+    client = _ena_client(tmp_path, mocker, FILES, None, resume=True)
+    assert client.download_accession_list(['SRR0000001']) == 1
+    download_module.requests.get.assert_not_called()
+
+
+def test_ncbi_fastq_files_sharded(tmp_path, small_shards):
+    for mate in (1, 2):
+        (tmp_path / f'SRR0000001_{mate}.fastq').write_bytes(_records(f'SRR0000001/{mate}', 0, 7))
+    fastq_files = list(tmp_path.glob('*.fastq'))
+
+    NCBIDownloadClient._shard(
+        fastq_files, 'SRR0000001', tmp_path, ShardLayout(reads_per_shard=5), threads=2
+    )
+
+    index = json.loads((tmp_path / 'SRR0000001.shards.json').read_text())
+    assert sorted(index['files']) == ['SRR0000001_1.fastq.gz', 'SRR0000001_2.fastq.gz']
+    assert [shard['reads'] for shard in index['files']['SRR0000001_2.fastq.gz']] == [5, 2]
+    assert not any(tmp_path.glob('*.fastq'))
+    path = tmp_path / 'SRR0000001_1.shard0001.fastq.gz'
+    assert gzip.decompress(path.read_bytes()) == _records('SRR0000001/1', 5, 2)
+
+
+def test_ncbi_truncated_fastq_is_not_sharded(tmp_path):
+    (tmp_path / 'SRR0000001.fastq').write_bytes(_records('SRR0000001', 0, 3)[:-3])
+
+    with pytest.raises(ValidationError):
+        NCBIDownloadClient._shard(
+            [tmp_path / 'SRR0000001.fastq'], 'SRR0000001', tmp_path, ShardLayout(shards=2), 2
+        )
@@ -0,0 +1,225 @@
+import base64
+import hashlib
+import http.server
+import importlib
+import re
+import threading
+import urllib.parse
+
+import pytest
+
+from fastqheat.backend.ena.download import ENADownloadClient, TransportType
+from fastqheat.backend.results import FileResult
+from fastqheat.backend.s3 import S3Client
+from fastqheat.backend.sinks import LocalSink, S3Sink
+from fastqheat.backend.state import StateStore
+from fastqheat.exceptions import ValidationError
+
+# fastqheat.backend.ena.download attribute is shadowed by the download() function
+download_module = importlib.import_module("fastqheat.backend.ena.download")
+
+
+class FakeS3Handler(http.server.BaseHTTPRequestHandler):
+    """Just enough of the S3 API (path-style) for uploads, like a local MinIO."""
+
+    def do_PUT(self):
+        key, query = self._parse()
+        body = self._body()
+        if 'uploadId' in query:
+            upload = self.server.uploads[query['uploadId']]
+            upload[int(query['partNumber'])] = body
+            self._reply(headers={'ETag': f'"{hashlib.md5(body).hexdigest()}"'})
+        else:
+            self.server.objects[key] = body
+            self._reply()
+
+    def do_POST(self):
+        key, query = self._parse()
+        body = self._body()
+        if 'uploads' in query:
+            upload_id = f"upload-{len(self.server.uploads)}"
+            self.server.uploads[upload_id] = {}
+            self._reply(
+                f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId>"
+                "</InitiateMultipartUploadResult>"
+            )
+            return
+        parts = self.server.uploads.pop(query['uploadId'])
+        numbers = [int(number) for number in re.findall(rb'<PartNumber>(\d+)<', body)]
+        self.server.objects[key] = b''.join(parts[number] for number in numbers)
+        self._reply("<CompleteMultipartUploadResult></CompleteMultipartUploadResult>")
+
+    def do_DELETE(self):
+        _, query = self._parse()
+        self.server.uploads.pop(query['uploadId'])
+        self._reply(status=204)
+
+    def _parse(self):
+        parsed = urllib.parse.urlparse(self.path)
+        assert self.headers['Authorization'].startswith("AWS4-HMAC-SHA256 Credential=key/")
+        return parsed.path.lstrip('/'), dict(urllib.parse.parse_qsl(parsed.query, True))
+
+    def _body(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        assert self.headers['Content-MD5'] == base64.b64encode(hashlib.md5(body).digest()).decode()
+        return body
+
+    def _reply(self, body='', status=200, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def s3_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeS3Handler)
+    server.objects = {}
+    server.uploads = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def s3_sink(s3_server):
+    client = S3Client(
+        endpoint_url=f"http://127.0.0.1:{s3_server.server_port}",
+        access_key="key",
+        secret_key="secret",
+    )
+    return S3Sink("s3://bucket/runs", client=client, part_size=10)
+
+
+def test_s3_multipart_upload(s3_server, s3_sink):
+    data = bytes(range(35))
+
+    with s3_sink.open('SRR1/SRR1.fastq.gz') as writer:
+        for start in range(0, len(data), 4):
+            writer.write(data[start : start + 4])
+
+    assert s3_server.objects == {'bucket/runs/SRR1/SRR1.fastq.gz': data}
+    assert not s3_server.uploads
+    assert writer.md5 == hashlib.md5(data).hexdigest()
+    assert writer.size == 35
+
+
+def test_s3_small_file_single_request(s3_server, s3_sink):
+    with s3_sink.open('SRR1/SRR1.fastq.gz') as writer:
+        writer.write(b'small')
+
+    assert s3_server.objects == {'bucket/runs/SRR1/SRR1.fastq.gz': b'small'}
+
+
+def test_s3_upload_aborted_on_error(s3_server, s3_sink):
+    with pytest.raises(RuntimeError):
+        with s3_sink.open('SRR1/SRR1.fastq.gz') as writer:
+            writer.write(bytes(30))
+            raise RuntimeError("Connection lost")
+
+    assert not s3_server.objects
+    assert not s3_server.uploads
+
+
+@pytest.mark.parametrize("size", [5, 30])
+def test_s3_corrupted_file_is_not_committed(s3_server, s3_sink, size):
+    """A file that fails its md5 check does not appear under its key, uploaded in parts or not."""
+    with pytest.raises(ValidationError):
+        with s3_sink.open('SRR1/SRR1.fastq.gz', md5=hashlib.md5(b'expected').hexdigest()) as writer:
+            writer.write(bytes(size))
+
+    assert not s3_server.objects
+    assert not s3_server.uploads
+
+
+def test_local_sink_removes_aborted_files(tmp_path):
+    with pytest.raises(ValidationError):
+        with LocalSink(tmp_path).open('SRR1/SRR1.fastq.gz', md5='0' * 32) as writer:
+            writer.write(b'data')
+
+    assert not (tmp_path / 'SRR1' / 'SRR1.fastq.gz').exists()
+
+
+def test_local_sink(tmp_path):
+    with LocalSink(tmp_path).open('SRR1/SRR1.fastq.gz') as writer:
+        writer.write(b'data')
+
+    assert (tmp_path / 'SRR1' / 'SRR1.fastq.gz').read_bytes() == b'data'
+
+
+FILES = {
+    'SRR0000001_1.fastq.gz': b'@r1\nACGT\n+\nFFFF\n',
+    'SRR0000001_2.fastq.gz': b'@r2\nTT\n+\nFF\n',
+}
+
+
+class FakeENAClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_urls_and_md5s(self, accession, ftp=False, aspera=False):
+        urls = [f"http://ftp.sra.ebi.ac.uk/vol1/fastq/{name}" for name in FILES]
+        return urls, [hashlib.md5(data).hexdigest() for data in FILES.values()]
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.data), 7):
+            yield self.data[start : start + 7]
+
+
+def test_ena_download_to_s3(tmp_path, mocker, s3_server, s3_sink):
+    """Files are uploaded while they are downloaded and checked by their md5, not saved."""
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+    mocker.patch.object(
+        download_module.requests,
+        "get",
+        side_effect=lambda url, stream: FakeResponse(FILES[url.split('/')[-1]]),
+    )
+    client = ENADownloadClient(
+        tmp_path,
+        attempts=1,
+        attempts_interval=0,
+        skip_check=False,
+        transport=TransportType.ftp,
+        aspera_ssh_path="key",
+        sink=s3_sink,
+    )
+    results = []
+    client.on_result = results.append
+
+    assert client.download_accession_list(['SRR0000001']) == 1
+
+    [result] = results
+    assert result.success
+    assert result.files == [
+        FileResult(
+            path=f's3://bucket/runs/SRR0000001/{name}',
+            size=len(data),
+            md5=hashlib.md5(data).hexdigest(),
+        )
+        for name, data in FILES.items()
+    ]
+    assert s3_server.objects == {
+        f'bucket/runs/SRR0000001/{name}': data for name, data in FILES.items()
+    }
+    assert not (tmp_path / 'SRR0000001').exists()
+    assert client.state_store.states() == {'SRR0000001': StateStore.VERIFIED}
@@ -0,0 +1,73 @@
+import pytest
+
+from fastqheat.backend.scheduler import WorkItem
+from fastqheat.backend.state import StateStore
+
+
+@pytest.fixture
+def state_store(tmp_path):
+    return StateStore(tmp_path)
+
+
+def test_lifecycle(state_store):
+    state_store.resolve([WorkItem(accession='SRR1', index=0, size=100)])
+    assert state_store.get('SRR1').state == StateStore.RESOLVED
+
+    state_store.start('SRR1')
+    state_store.fail('SRR1', 'connection reset')
+    state_store.start('SRR1')
+    state_store.advance('SRR1', StateStore.DOWNLOADED, nbytes=90)
+    state_store.advance('SRR1', StateStore.VERIFIED)
+
+    record = state_store.get('SRR1')
+    assert record.state == StateStore.VERIFIED
+    assert record.attempts == 2
+    assert record.size == 100
+    assert record.bytes == 90
+    assert record.last_error == 'connection reset'
+    assert state_store.get('SRR2') is None
+
+
+def test_resolve_keeps_state(state_store):
+    """Accessions queued again keep the state left by a previous run."""
+    state_store.start('SRR1')
+    state_store.advance('SRR1', StateStore.DOWNLOADED)
+
+    state_store.resolve([WorkItem(accession='SRR1', index=0, size=100)])
+
+    record = state_store.get('SRR1')
+    assert record.state == StateStore.DOWNLOADED
+    assert record.size == 100
+
+
+def test_resumed_stage_is_kept(state_store):
+    """An accession interrupted again after it has been resumed is resumed from the same stage."""
+    state_store.start('SRR1')
+    state_store.advance('SRR1', StateStore.DOWNLOADED)
+    state_store.start('SRR2')
+    state_store.fail('SRR2', 'connection reset')
+
+    state_store.start('SRR1', StateStore.DOWNLOADED)
+    state_store.start('SRR2', StateStore.FAILED)
+
+    assert state_store.states() == {'SRR1': StateStore.DOWNLOADED, 'SRR2': StateStore.DOWNLOADING}
+    assert state_store.get('SRR1').attempts == 2
+
+
+def test_state_survives_reopening(tmp_path):
+    StateStore(tmp_path).start('SRR1')
+    assert StateStore(tmp_path).summary() == {StateStore.DOWNLOADING: 1}
+
+
+@pytest.mark.parametrize(
+    'state, stage, expected',
+    [
+        (None, StateStore.DOWNLOADED, False),
+        (StateStore.DOWNLOADING, StateStore.DOWNLOADED, False),
+        (StateStore.DOWNLOADED, StateStore.DOWNLOADED, True),
+        (StateStore.COMPRESSED, StateStore.VERIFIED, True),
+        (StateStore.FAILED, StateStore.RESOLVED, False),
+    ],
+)
+def test_reached(state, stage, expected):
+    assert StateStore.reached(state, stage) is expected
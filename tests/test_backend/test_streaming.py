@@ -0,0 +1,215 @@
+import gzip
+import hashlib
+import importlib
+import os
+import threading
+
+import pytest
+import requests
+
+from fastqheat.backend.ena.download import ENADownloadClient, TransportType
+from fastqheat.backend.state import StateStore
+from fastqheat.backend.streaming import StreamTargets, gunzip, interleave
+from fastqheat.exceptions import ValidationError
+
+# fastqheat.backend.ena.download attribute is shadowed by the download() function
+download_module = importlib.import_module("fastqheat.backend.ena.download")
+
+
+def _records(name, count):
+    return b"".join(f"@{name}.{i}\nACGT\n+\nFFFF\n".encode() for i in range(count))
+
+
+FILES = {
+    'SRR0000001_1.fastq.gz': gzip.compress(_records('SRR0000001/1', 3)),
+    'SRR0000001_2.fastq.gz': gzip.compress(_records('SRR0000001/2', 3)),
+    'SRR0000002.fastq.gz': gzip.compress(_records('SRR0000002', 2)),
+}
+RUNS = {
+    'SRR0000001': ['SRR0000001_1.fastq.gz', 'SRR0000001_2.fastq.gz'],
+    'SRR0000002': ['SRR0000002.fastq.gz'],
+}
+
+
+class FakeENAClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_urls_and_md5s(self, accession, ftp=False, aspera=False):
+        urls = [f"http://ftp.sra.ebi.ac.uk/vol1/fastq/{name}" for name in RUNS[accession]]
+        return urls, [hashlib.md5(FILES[name]).hexdigest() for name in RUNS[accession]]
+
+
+class FakeResponse:
+    def __init__(self, data, status_code, break_after=None):
+        self.data = data
+        self.status_code = status_code
+        self.break_after = break_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.data), 10):
+            if self.break_after is not None and start >= self.break_after:
+                raise requests.ConnectionError("Connection reset")
+            yield self.data[start : start + 10]
+
+
+@pytest.fixture
+def requests_get(mocker):
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+
+    def get(url, stream, headers):
+        start = int(headers['Range'][6:-1]) if headers else 0
+        return FakeResponse(FILES[url.split('/')[-1]][start:], 206 if start else 200)
+
+    return mocker.patch.object(download_module.requests, "get", side_effect=get)
+
+
+def _make_client(tmp_path, targets, interleave=False):
+    return ENADownloadClient(
+        tmp_path,
+        attempts=2,
+        attempts_interval=0,
+        skip_check=False,
+        transport=TransportType.binary,
+        aspera_ssh_path="key",
+        stream_targets=StreamTargets(targets),
+        interleave=interleave,
+    )
+
+
+def _read_fifos(paths):
+    """Start reading the named pipes, return the function that returns what has been read."""
+    contents = {}
+
+    def read(path):
+        with open(path, 'rb') as fifo:
+            contents[path] = fifo.read()
+
+    threads = [threading.Thread(target=read, args=(path,), daemon=True) for path in paths]
+    for thread in threads:
+        thread.start()
+
+    def result():
+        for thread in threads:
+            thread.join()
+        return [contents[path] for path in paths]
+
+    return result
+
+
+def _make_fifos(tmp_path, *names):
+    paths = [str(tmp_path / name) for name in names]
+    for path in paths:
+        os.mkfifo(path)
+    return paths
+
+
+def test_gunzip_concatenated_members():
+    data = gzip.compress(b"first\n") + gzip.compress(b"second\n")
+    chunks = [data[i : i + 7] for i in range(0, len(data), 7)]
+
+    assert b"".join(gunzip(chunks)) == b"first\nsecond\n"
+
+    with pytest.raises(ValidationError):
+        list(gunzip([data[:-5]]))
+
+
+def test_interleave():
+    first, second = _records('a', 3), _records('b', 3)
+    chunks = [first[:5], first[5:]], [second[i : i + 3] for i in range(0, len(second), 3)]
+
+    interleaved = b"".join(interleave(*chunks)).decode().splitlines()
+
+    assert [line for line in interleaved if line.startswith('@')] == [
+        '@a.0',
+        '@b.0',
+        '@a.1',
+        '@b.1',
+        '@a.2',
+        '@b.2',
+    ]
+    with pytest.raises(ValidationError):
+        list(interleave([first], [_records('b', 2)]))
+
+
+def test_stream_mates_to_two_fifos(tmp_path, requests_get):
+    """Mates are written to their FIFOs at the same time, the run is checked on the fly."""
+    fifos = _make_fifos(tmp_path, "r1.fifo", "r2.fifo")
+    read = _read_fifos(fifos)
+    client = _make_client(tmp_path, fifos)
+
+    successful = client.download_accession_list(['SRR0000001'])
+    client.stream_targets.close()
+
+    assert successful == 1
+    assert read() == [FILES['SRR0000001_1.fastq.gz'], FILES['SRR0000001_2.fastq.gz']]
+    assert not (tmp_path / 'SRR0000001').exists()
+    assert client.state_store.states() == {'SRR0000001': StateStore.VERIFIED}
+
+
+def test_stream_interleaved_runs(tmp_path, requests_get):
+    """Runs are decompressed one after another, mates are interleaved."""
+    fifo = _make_fifos(tmp_path, "reads.fifo")
+    read = _read_fifos(fifo)
+    client = _make_client(tmp_path, fifo, interleave=True)
+
+    successful = client.download_accession_list(['SRR0000001', 'SRR0000002'])
+    client.stream_targets.close()
+
+    assert successful == 2
+    headers = [line for line in read()[0].decode().splitlines() if line.startswith('@')]
+    assert headers == [
+        '@SRR0000001/1.0',
+        '@SRR0000001/2.0',
+        '@SRR0000001/1.1',
+        '@SRR0000001/2.1',
+        '@SRR0000001/1.2',
+        '@SRR0000001/2.2',
+        '@SRR0000002.0',
+        '@SRR0000002.1',
+    ]
+
+
+def test_stream_resumes_broken_connection(tmp_path, requests_get):
+    """A broken transfer is continued from the last byte, nothing is written twice."""
+    data = FILES['SRR0000002.fastq.gz']
+    responses = iter([FakeResponse(data, 200, break_after=20)])
+    default = requests_get.side_effect
+    requests_get.side_effect = lambda url, **kwargs: next(responses, None) or default(url, **kwargs)
+    fifo = _make_fifos(tmp_path, "reads.fifo")
+    read = _read_fifos(fifo)
+    client = _make_client(tmp_path, fifo)
+
+    assert client.download_accession_list(['SRR0000002']) == 1
+    client.stream_targets.close()
+
+    assert read() == [data]
+    assert requests_get.call_args.kwargs['headers'] == {'Range': 'bytes=20-'}
+
+
+def test_stream_md5_mismatch(tmp_path, requests_get, mocker):
+    """A run that fails the check is reported at the end of its stream and not streamed again."""
+    mocker.patch.object(
+        FakeENAClient,
+        "get_urls_and_md5s",
+        return_value=(["http://host/SRR0000002.fastq.gz"], ["0"]),
+    )
+    fifo = _make_fifos(tmp_path, "reads.fifo")
+    read = _read_fifos(fifo)
+    client = _make_client(tmp_path, fifo)
+
+    assert client.download_accession_list(['SRR0000002']) == 0
+    client.stream_targets.close()
+
+    assert read() == [FILES['SRR0000002.fastq.gz']]
+    assert requests_get.call_count == 1
+    assert client.failed_output_writer.path_to_file.read_text().split() == ['SRR0000002']
@@ -0,0 +1,121 @@
+import gzip
+import importlib
+import json
+
+from fastqheat.backend.ena.download import ENADownloadClient, TransportType
+from fastqheat.backend.transforms import ReadTransforms, RecordFilter
+
+# fastqheat.backend.ena.download attribute is shadowed by the download() function
+download_module = importlib.import_module("fastqheat.backend.ena.download")
+
+
+def _record(name, length):
+    return [f"@{name} length={length}".encode(), b"A" * length, f"+{name}".encode(), b"F" * length]
+
+
+def _lines(name, lengths):
+    return [line for i, length in enumerate(lengths) for line in _record(f"{name}.{i}", length)]
+
+
+def test_length_filter_keeps_mates_in_sync():
+    record_filter = RecordFilter(ReadTransforms(min_length=5), key='SRR1')
+
+    first, second = record_filter([_lines('1', [6, 4, 8]), _lines('2', [6, 9, 3])])
+
+    assert first == _lines('1', [6])
+    assert second == _lines('2', [6])
+    assert (record_filter.records_in, record_filter.records_out) == (3, 1)
+
+
+def test_subsampling_is_deterministic():
+    lines = _lines('r', [5] * 1000)
+
+    kept = RecordFilter(ReadTransforms(fraction=0.1, seed=7), key='SRR1')([lines])[0]
+
+    assert 50 < len(kept) // 4 < 150
+    assert kept == RecordFilter(ReadTransforms(fraction=0.1, seed=7), key='SRR1')([lines])[0]
+    assert kept != RecordFilter(ReadTransforms(fraction=0.1, seed=8), key='SRR1')([lines])[0]
+
+
+def test_strip_quality_headers():
+    lines = _lines('r', [5, 6])
+
+    stripped = RecordFilter(ReadTransforms(strip_quality_headers=True), key='SRR1')([lines])[0]
+
+    assert stripped[2::4] == [b'+', b'+']
+    assert stripped[1::4] == lines[1::4]
+
+
+def _fastq(name, lengths):
+    return b"\n".join(_lines(name, lengths)) + b"\n"
+
+
+LENGTHS = {1: [10 + i % 50 for i in range(2000)], 2: [60 - i % 50 for i in range(2000)]}
+FILES = {
+    f'SRR0000001_{mate}.fastq.gz': gzip.compress(_fastq(f'SRR0000001/{mate}', lengths))
+    for mate, lengths in LENGTHS.items()
+}
+
+
+class FakeENAClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_urls(self, accession, ftp=False, aspera=False):
+        return [f"http://ftp.sra.ebi.ac.uk/vol1/fastq/{name}" for name in FILES]
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.data), 1000):
+            yield self.data[start : start + 1000]
+
+
+def test_ena_run_filtered_while_downloaded(tmp_path, mocker):
+    mocker.patch.object(download_module, "ENAClient", FakeENAClient)
+    mocker.patch.object(
+        download_module.requests,
+        "get",
+        side_effect=lambda url, stream, headers: FakeResponse(FILES[url.split('/')[-1]]),
+    )
+    client = ENADownloadClient(
+        tmp_path,
+        attempts=1,
+        attempts_interval=0,
+        skip_check=False,
+        transport=TransportType.ftp,
+        aspera_ssh_path="key",
+        transforms=ReadTransforms(min_length=20, fraction=0.5, strip_quality_headers=True),
+    )
+
+    assert client.download_accession_list(['SRR0000001']) == 1
+
+    directory = tmp_path / 'SRR0000001'
+    mates = [
+        gzip.decompress((directory / f'SRR0000001_{mate}.fastq.gz').read_bytes()).splitlines()
+        for mate in (1, 2)
+    ]
+    # the same spots are kept in both mates, all reads are long enough
+    spots = [[line.split()[0].split(b'.')[-1] for line in mate[::4]] for mate in mates]
+    assert spots[0] == spots[1]
+    assert all(len(line) >= 20 for mate in mates for line in mate[1::4])
+    assert set(mates[0][2::4]) == {b'+'}
+
+    manifest = json.loads((directory / 'SRR0000001.manifest.json').read_text())
+    assert manifest['transforms']['min_length'] == 20
+    for file in manifest['files'].values():
+        assert file['derived']
+        assert file['source_reads'] == 2000
+        assert file['reads'] == len(mates[0]) // 4
@@ -0,0 +1,41 @@
+from fastqheat.backend.ena.transport import TransportSelector, TransportType
+
+
+def test_selector_probes_every_transport_first():
+    selector = TransportSelector([TransportType.binary, TransportType.ftp], reprobe_interval=0)
+
+    assert selector.choose() == TransportType.binary
+    selector.record_success(TransportType.binary, nbytes=1000, seconds=1)
+    assert selector.choose() == TransportType.ftp
+    selector.record_success(TransportType.ftp, nbytes=5000, seconds=1)
+
+    assert selector.choose() == TransportType.ftp
+    assert selector.fallbacks(TransportType.ftp) == [TransportType.binary]
+
+
+def test_selector_reprobes_runner_up():
+    selector = TransportSelector([TransportType.binary, TransportType.ftp], reprobe_interval=3)
+    selector.record_success(TransportType.binary, nbytes=5000, seconds=1)
+    selector.record_success(TransportType.ftp, nbytes=1000, seconds=1)
+
+    chosen = [selector.choose() for _ in range(6)]
+
+    assert chosen == [TransportType.binary, TransportType.binary, TransportType.ftp] * 2
+
+
+def test_selector_avoids_failed_transport():
+    selector = TransportSelector([TransportType.binary, TransportType.ftp], reprobe_interval=0)
+    selector.record_success(TransportType.binary, nbytes=5000, seconds=1)
+    selector.record_success(TransportType.ftp, nbytes=1000, seconds=1)
+
+    selector.record_failure(TransportType.binary)
+
+    assert selector.choose() == TransportType.ftp
+
+
+def test_selector_smooths_throughput():
+    selector = TransportSelector([TransportType.ftp], smoothing=0.5)
+    selector.record_success(TransportType.ftp, nbytes=1000, seconds=1)
+    selector.record_success(TransportType.ftp, nbytes=3000, seconds=1)
+
+    assert selector._throughput[TransportType.ftp] == 2000
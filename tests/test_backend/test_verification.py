@@ -0,0 +1,50 @@
+import concurrent.futures
+import threading
+
+import pytest
+
+from fastqheat.backend.verification import VerificationStage, all_of
+
+
+def test_all_of_reports_the_first_error():
+    first, second = concurrent.futures.Future(), concurrent.futures.Future()
+    on_success = []
+    result = all_of([first, second], on_success=lambda: on_success.append(True))
+
+    second.set_exception(ValueError("second"))
+    assert not result.done()
+    first.set_exception(ValueError("first"))
+
+    with pytest.raises(ValueError, match="first"):
+        result.result()
+    assert on_success == []
+
+
+def test_all_of_calls_on_success():
+    on_success = []
+    future = concurrent.futures.Future()
+    result = all_of([future], on_success=lambda: on_success.append(True))
+
+    future.set_result(None)
+
+    assert result.result() is None
+    assert on_success == [True]
+    assert all_of([]).done()
+
+
+def test_submit_waits_while_the_queue_is_full():
+    verification = VerificationStage(workers=1, queue_size=1)
+    release = threading.Event()
+    verification.submit(release.wait)
+    verification.submit(release.wait)
+
+    third_submitted = threading.Event()
+
+    def submit_third():
+        verification.submit(lambda: None)
+        third_submitted.set()
+
+    threading.Thread(target=submit_third).start()
+    assert not third_submitted.wait(0.1)
+    release.set()
+    assert third_submitted.wait(5)
@@ -0,0 +1,52 @@
+import pstats
+import subprocess
+import sys
+import threading
+
+from fastqheat.profiling import Profiler
+
+
+def _busy_function():
+    return sum(i * i for i in range(10_000))
+
+
+def test_profiler_writes_stats_and_summary(tmp_path):
+    """Profiler dumps loadable pstats data and a summary file next to it."""
+    output_path = tmp_path / "run.prof"
+
+    with Profiler(output_path, top=5):
+        _busy_function()
+
+    stats = pstats.Stats(str(output_path))
+    assert any(func[2] == "_busy_function" for func in stats.stats)
+
+    summary = (tmp_path / "run.prof.txt").read_text()
+    assert "In-process CPU time" in summary
+    assert "Waiting for external tools" in summary
+
+
+def test_profiler_reports_subprocess_wait_separately(tmp_path):
+    """Time spent in subprocess.run is attributed to the launched program."""
+    output_path = tmp_path / "run.prof"
+    program = [sys.executable, "-c", "import time; time.sleep(0.2)"]
+
+    with Profiler(output_path) as profiler:
+        subprocess.run(program, check=True)
+
+    assert subprocess.run is not profiler._timed_run
+    program_name = profiler._subprocess_wall.keys()
+    assert list(program_name) == [sys.executable.split("/")[-1]]
+    assert profiler._subprocess_wall[sys.executable.split("/")[-1]] >= 0.2
+
+
+def test_profiler_covers_threads(tmp_path):
+    """Functions executed in threads started during profiling are included in the stats."""
+    output_path = tmp_path / "run.prof"
+
+    with Profiler(output_path):
+        thread = threading.Thread(target=_busy_function)
+        thread.start()
+        thread.join()
+
+    stats = pstats.Stats(str(output_path))
+    assert any(func[2] == "_busy_function" for func in stats.stats)
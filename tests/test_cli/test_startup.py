@@ -0,0 +1,77 @@
+import json
+import os
+import subprocess
+import sys
+
+import click
+import pytest
+
+from fastqheat.click_utils import BinaryCache, check_binary_available
+
+# modules of the backends, none of them is needed for `--help` or argument errors
+HEAVY_MODULES = ("requests", "aiohttp", "aiocsv", "aiofiles", "backoff", "asyncio", "sqlite3")
+
+
+def test_cli_does_not_import_backends():
+    code = (
+        "import sys, fastqheat.__main__; "
+        f"print([name for name in {HEAVY_MODULES!r} if name in sys.modules])"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+
+    assert output.strip() == "[]"
+
+
+@pytest.fixture
+def fake_binary(tmp_path, monkeypatch):
+    """A program on PATH that records its runs, and an empty binary cache."""
+    bin_directory = tmp_path / "bin"
+    bin_directory.mkdir()
+    binary = bin_directory / "fake-tool"
+    runs = tmp_path / "runs"
+    binary.write_text(f"#!/bin/sh\necho run >> {runs}\necho 'fake-tool 1.2'\n")
+    binary.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_directory}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    def run_count():
+        return len(runs.read_text().splitlines()) if runs.exists() else 0
+
+    return binary, run_count
+
+
+def test_binary_check_is_cached(fake_binary):
+    binary, run_count = fake_binary
+
+    assert check_binary_available("fake-tool") == "fake-tool 1.2"
+    assert check_binary_available("fake-tool") == "fake-tool 1.2"
+    assert run_count() == 1
+
+    # the binary has changed
+    binary.write_text(binary.read_text().replace("1.2", "1.3"))
+    assert check_binary_available("fake-tool") == "fake-tool 1.3"
+    assert run_count() == 2
+
+
+def test_binary_check_failures_are_not_cached(fake_binary):
+    binary, run_count = fake_binary
+    binary.write_text(binary.read_text() + "exit 1\n")
+
+    for _ in range(2):
+        with pytest.raises(click.UsageError):
+            check_binary_available("fake-tool")
+    assert run_count() == 2
+
+
+def test_corrupt_binary_cache_is_ignored(fake_binary):
+    _, run_count = fake_binary
+    cache_path = BinaryCache.default_path()
+    cache_path.parent.mkdir(parents=True)
+    cache_path.write_text("{not json")
+
+    assert check_binary_available("fake-tool") == "fake-tool 1.2"
+    assert check_binary_available("fake-tool") == "fake-tool 1.2"
+    assert run_count() == 1
+    assert len(json.loads(cache_path.read_text())) == 1
@@ -4,6 +4,7 @@ from requests.exceptions import RequestException
 
 from fastqheat.backend.ena.ena_api_client import ENAClient
 from fastqheat.config import config
+from fastqheat.exceptions import ValidationError
 from tests.fixtures import MockResponse
 
 accession_response = [
@@ -178,6 +179,21 @@ def test_get_read_count(mocker):
     assert get_args["params"]["fields"] == "read_count"
 
 
+def test_get_read_and_base_count(mocker):
+    ena_client = ENAClient()
+
+    mock = mocker.patch.object(
+        requests,
+        "get",
+        return_value=MockResponse(
+            json=[{'run_accession': 'SRR7969986', 'read_count': '344516', 'base_count': ''}]
+        ),
+    )
+
+    assert ena_client.get_read_and_base_count(term="SRR7969986") == (344516, None)
+    assert mock.call_args_list[0][1]["params"]["fields"] == "read_count,base_count"
+
+
 def test_backoff_on_get(mocker):
     """Tests if ENAClient._get() retries on RequestError."""
 
@@ -189,3 +205,68 @@ def test_backoff_on_get(mocker):
     ena_client._get_json(params={"whatever": ""})
 
     assert mock.call_count == config.DEFAULT_MAX_ATTEMPTS
+
+
+def test_get_all_urls_and_md5s(mocker):
+    """Tests get_all_urls_and_md5s() returns links for both transports in the same order."""
+    ena_client = ENAClient()
+
+    mock = mocker.patch.object(
+        requests,
+        "get",
+        return_value=MockResponse(
+            json=[
+                {
+                    'run_accession': 'SRR7969986',
+                    'fastq_aspera': 'fasp.sra.ebi.ac.uk:/vol1/fastq/SRR796/006/SRR7969986/SRR7969986_1.fastq.gz;fasp.sra.ebi.ac.uk:/vol1/fastq/SRR796/006/SRR7969986/SRR7969986_2.fastq.gz',  # noqa: E501 line too long
+                    'fastq_ftp': 'ftp.sra.ebi.ac.uk/vol1/fastq/SRR796/006/SRR7969986/SRR7969986_1.fastq.gz;ftp.sra.ebi.ac.uk/vol1/fastq/SRR796/006/SRR7969986/SRR7969986_2.fastq.gz',  # noqa: E501 line too long
+                    'fastq_md5': '73242af9842bb15738713d57d4c45b28;152fffe3389fff996f983160eb213d86',  # noqa: E501 line too long
+                }
+            ]
+        ),
+    )
+
+    aspera_urls, ftp_urls, md5s = ena_client.get_all_urls_and_md5s(term="SRR7969986")
+
+    get_args = mock.call_args_list[0][1]
+    assert get_args["params"]["fields"] == "fastq_aspera,fastq_ftp,fastq_md5"
+
+    assert aspera_urls == [
+        'fasp.sra.ebi.ac.uk:/vol1/fastq/SRR796/006/SRR7969986/SRR7969986_1.fastq.gz',
+        'fasp.sra.ebi.ac.uk:/vol1/fastq/SRR796/006/SRR7969986/SRR7969986_2.fastq.gz',
+    ]
+    assert ftp_urls == [
+        'http://ftp.sra.ebi.ac.uk/vol1/fastq/SRR796/006/SRR7969986/SRR7969986_1.fastq.gz',
+        'http://ftp.sra.ebi.ac.uk/vol1/fastq/SRR796/006/SRR7969986/SRR7969986_2.fastq.gz',
+    ]
+    assert md5s == ['73242af9842bb15738713d57d4c45b28', '152fffe3389fff996f983160eb213d86']
+
+
+@pytest.mark.parametrize(
+    'fastq_aspera',
+    [
+        # the second mate is missing for one transport
+        'fasp.sra.ebi.ac.uk:/vol1/fastq/SRR7969986_1.fastq.gz',
+        'fasp.sra.ebi.ac.uk:/vol1/fastq/SRR7969986_1.fastq.gz;',
+        '',
+    ],
+)
+def test_get_all_urls_and_md5s_of_other_files(mocker, fastq_aspera):
+    """Files are not matched when the transports list different numbers of them."""
+    mocker.patch.object(
+        requests,
+        "get",
+        return_value=MockResponse(
+            json=[
+                {
+                    'run_accession': 'SRR7969986',
+                    'fastq_aspera': fastq_aspera,
+                    'fastq_ftp': 'ftp.sra.ebi.ac.uk/vol1/fastq/SRR7969986_1.fastq.gz;ftp.sra.ebi.ac.uk/vol1/fastq/SRR7969986_2.fastq.gz',  # noqa: E501 line too long
+                    'fastq_md5': '73242af9842bb15738713d57d4c45b28;152fffe3389fff996f983160eb213d86',  # noqa: E501 line too long
+                }
+            ]
+        ),
+    )
+
+    with pytest.raises(ValidationError):
+        ENAClient().get_all_urls_and_md5s(term="SRR7969986")